@@ -3,3 +3,12 @@ from django.apps import AppConfig
 
 class ModelsConfig(AppConfig):
     name = 'global_resources'
+
+    def ready(self):
+        # connect the signal receivers
+        from . import signals  # noqa: F401
+
+        # time the queries of every database connection (see querylog.py)
+        from django.db.backends.signals import connection_created
+        from .querylog import install_cursor_wrapper
+        connection_created.connect(install_cursor_wrapper)
@@ -0,0 +1,133 @@
+"""
+Avatar thumbnails.
+
+Avatars used to be served as uploaded, so a 4 MB photo was downloaded for every 50px
+avatar down the stream. Now an uploaded avatar is decoded once, cropped to a square and
+resized into the fixed sizes in settings.AVATAR_SIZES (twice the CSS size of each place it
+shows up, for high-DPI screens), encoded as JPEG plus WebP (when Pillow supports it).
+
+Thumbnails are stored under the content hash of the original image:
+
+    avatars/<hash>/<size name>.<jpg|webp>
+
+so a thumbnail URL never changes its content and can be cached by browsers forever, and
+users sharing an image (e.g. the default avatar) share the thumbnails too. UserExtended
+keeps the hash (avatar_hash) to build the URLs with; see UserExtended.avatar_html().
+
+Use `python manage.py backfill_avatars` to generate the thumbnails of existing avatars.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.0.0
+"""
+import functools
+import hashlib
+import io
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+try:
+    from PIL import features
+    WEBP_SUPPORTED = features.check_module('webp')
+except ImportError:
+    # very old Pillow without the features module
+    WEBP_SUPPORTED = False
+
+
+# length of the content hashes in thumbnail paths
+HASH_LENGTH = 20
+
+
+def thumbnail_name(avatar_hash, size_name, extension):
+    """
+    :return: storage name of an avatar thumbnail
+    """
+    return 'avatars/{0}/{1}.{2}'.format(avatar_hash, size_name, extension)
+
+
+def thumbnail_url(avatar_hash, size_name, extension):
+    """
+    :return: URL of an avatar thumbnail
+    """
+    return default_storage.url(thumbnail_name(avatar_hash, size_name, extension))
+
+
+def _to_rgb(image):
+    # JPEG has no alpha channel; put transparent images on a white background
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        return background
+    return image.convert('RGB')
+
+
+def _encode(image, image_format):
+    buffer = io.BytesIO()
+    if image_format == 'JPEG':
+        _to_rgb(image).save(buffer, 'JPEG', quality=settings.AVATAR_QUALITY, optimize=True, progressive=True)
+    else:
+        image.save(buffer, 'WEBP', quality=settings.AVATAR_QUALITY, method=6)
+    return buffer.getvalue()
+
+
+def make_thumbnails(source):
+    """
+    Generate and store the thumbnails of an avatar image, unless they already exist.
+
+    :param source: a file object of the original image, e.g. an uploaded file or a FieldFile
+    :return: a tuple of (content hash of the image, whether WebP thumbnails were made)
+    :raise IOError: if the image can't be decoded
+    """
+    source.seek(0)
+    data = source.read()
+    source.seek(0)
+    avatar_hash = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+    formats = [('JPEG', 'jpg')] + ([('WEBP', 'webp')] if WEBP_SUPPORTED else [])
+    missing = [(size_name, pixels, image_format, extension)
+               for size_name, pixels in settings.AVATAR_SIZES.items()
+               for image_format, extension in formats
+               if not default_storage.exists(thumbnail_name(avatar_hash, size_name, extension))]
+    if not missing:
+        return avatar_hash, WEBP_SUPPORTED
+
+    image = Image.open(io.BytesIO(data))
+    if hasattr(ImageOps, 'exif_transpose'):
+        # turn photos taken sideways upright (Pillow 6.0+)
+        image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'P') else 'RGB')
+
+    resized = {}
+    for size_name, pixels, image_format, extension in missing:
+        if pixels not in resized:
+            # crop the center square and scale it down; avatars are shown as circles
+            resized[pixels] = ImageOps.fit(image, (pixels, pixels), Image.LANCZOS)
+        default_storage.save(thumbnail_name(avatar_hash, size_name, extension),
+                             ContentFile(_encode(resized[pixels], image_format)))
+
+    return avatar_hash, WEBP_SUPPORTED
+
+
+def make_stored_thumbnails(name):
+    """
+    Generate and store the thumbnails of an avatar image already in the storage.
+
+    :param name: storage name of the image
+    :return: see make_thumbnails
+    :raise IOError: if the image can't be read or decoded
+    """
+    with default_storage.open(name, 'rb') as source:
+        return make_thumbnails(source)
+
+
+@functools.lru_cache(maxsize=None)
+def default_thumbnails(name):
+    """
+    Like make_stored_thumbnails, for the default avatar every new user starts with; the
+    result is remembered by this process, so the image is only read once.
+    """
+    return make_stored_thumbnails(name)
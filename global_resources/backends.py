@@ -0,0 +1,106 @@
+"""
+An authentication backend that remembers the authenticated users.
+
+AuthenticationMiddleware loads request.user through the backend's get_user() on every
+request, which with polling clients (the message / comment APIs, ...) was most of the
+database queries of the site; and the views then load request.user.ext on top of that.
+CachedModelBackend is the default ModelBackend (logging in is unchanged), except that
+get_user() loads the user together with their UserExtended, and keeps a copy of both in
+the memory of the process for up to settings.AUTH_USER_CACHE_TIMEOUT seconds.
+
+Each user has a version stamp in the default cache, which is replaced whenever their User
+or UserExtended row changes (a profile edit, a password change, logging in / out, their
+counters, ...; see signals.py). A remembered user is only used while their stamp is
+unchanged, so every process sees the change on its next request as long as the default
+cache is shared (CACHE_URL). With the per-process cache, the change only reaches the
+process it was made in right away, and the others within the timeout.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.0.0
+"""
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+
+
+# user id -> (time it expires, version stamp, pickled user with their UserExtended)
+_users = OrderedDict()
+_lock = threading.Lock()
+
+
+def _version_key(user_id):
+    return 'auth-user-version-{0}'.format(user_id)
+
+
+def _current_version(user_id):
+    """
+    :return: the version stamp of a user, starting a new one if it's not in the cache
+             (e.g. it has been evicted)
+    """
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def _bump(user_ids):
+    cache.set_many({_version_key(user_id): uuid.uuid4().hex for user_id in user_ids}, None)
+    with _lock:
+        for user_id in user_ids:
+            _users.pop(user_id, None)
+
+
+def invalidate(user_ids):
+    """
+    Forget the remembered copies of the given users, in every process. This is done now,
+    and again once the transaction commits, so that a copy loaded by another request from
+    the not yet committed data doesn't stick around.
+
+    :param user_ids: an iterable of user ids
+    """
+    user_ids = list(user_ids)
+    if user_ids:
+        _bump(user_ids)
+        transaction.on_commit(lambda: _bump(user_ids))
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend with a short-lived per-process cache of the users it loads for the
+    sessions; see the module docstring.
+    """
+
+    def get_user(self, user_id):
+        user_id = int(user_id)
+        # read the version before the database, so that a copy is never newer than its version
+        version = _current_version(user_id)
+
+        with _lock:
+            entry = _users.get(user_id)
+        if entry is not None and entry[0] > time.time() and entry[1] == version:
+            # every request gets a copy of its own to change as it likes
+            return pickle.loads(entry[2])
+
+        try:
+            user = User._default_manager.select_related('ext').get(pk=user_id)
+        except User.DoesNotExist:
+            return None
+        if not self.user_can_authenticate(user):
+            return None
+
+        with _lock:
+            _users[user_id] = (time.time() + settings.AUTH_USER_CACHE_TIMEOUT, version, pickle.dumps(user))
+            _users.move_to_end(user_id)
+            while len(_users) > settings.AUTH_USER_CACHE_SIZE:
+                _users.popitem(last=False)
+        return user
@@ -0,0 +1,131 @@
+"""
+Queues of new messages / comments waiting to be broadcast to the WebSocket streams.
+
+Rendering a message card and sending it to every stream used to happen right inside
+Message.save(), i.e. inside the request (and its database transaction) that posted the
+message. Now Message.save() only puts the id of the message onto a channel once the
+transaction commits, and the publish_messages consumer (see consumers.py), run by the
+`runworker` process, takes it from there. Whatever has piled up in the queue by the time
+the consumer runs is published together as one frame.
+
+New comments go through a queue of their own in the same way, to be pushed to the sockets
+subscribed to their messages (see publish_comments in consumers.py).
+
+Items are queued by the processes serving the requests and taken off by the worker, so
+neither knows the depth of a queue by itself. Each counts what it did
+(broadcast_enqueued_total / broadcast_drained_total, to be subtracted across processes
+by the metrics backend), and the broadcast_queue_depth gauge is read from the channel
+layer itself when the metrics are scraped, if it supports that (see report_queue_depth).
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.1.0
+"""
+import logging
+import time
+
+from channels import DEFAULT_CHANNEL_LAYER, Channel, channel_layers
+
+from .metrics import metrics
+
+
+# for printing debugging info to console
+logger = logging.getLogger(__name__)
+
+
+# name of the channel the queued messages are sent to
+QUEUE_CHANNEL = 'grumblr.broadcast'
+# name of the channel the queued comments are sent to
+COMMENT_QUEUE_CHANNEL = 'grumblr.broadcast.comments'
+# queue names used as metric labels
+QUEUE_NAMES = {QUEUE_CHANNEL: 'messages', COMMENT_QUEUE_CHANNEL: 'comments'}
+
+
+def _send(channel, item_id):
+    """
+    Put an item onto a queue channel. If the queue is full (e.g. the worker is down), the
+    item is dropped rather than failing the request that has already committed it; clients
+    still get it on their next page load.
+    """
+    queue = QUEUE_NAMES[channel]
+    channel = Channel(channel)
+    try:
+        channel.send({'id': item_id, 'queued_at': time.time()})
+    except channel.channel_layer.ChannelFull:
+        logger.warning('Broadcast queue %s is full; dropped item %s', queue, item_id)
+        metrics.inc('broadcast_dropped_total', queue=queue)
+        return
+    metrics.inc('broadcast_enqueued_total', queue=queue)
+
+
+def enqueue(message_id):
+    """
+    Queue a message to be broadcast to the streams.
+    Call it after the message has been committed to the database.
+
+    :param message_id: id of the message
+    """
+    _send(QUEUE_CHANNEL, message_id)
+
+
+def enqueue_comment(comment_id):
+    """
+    Queue a comment to be pushed to the comment streams.
+    Call it after the comment has been committed to the database.
+
+    :param comment_id: id of the comment
+    """
+    _send(COMMENT_QUEUE_CHANNEL, comment_id)
+
+
+def drain(first, channel_layer, batch_size, channel=QUEUE_CHANNEL):
+    """
+    Take more queued items off the channel without waiting, up to a batch.
+
+    :param first: content of the queued item the consumer was invoked with
+    :param channel_layer: the channel layer to receive from
+    :param batch_size: maximum number of queued items to return
+    :param channel: name of the queue channel
+    :return: a list of the contents of the queued items, including the first one
+    """
+    batch = [first]
+    while len(batch) < batch_size:
+        received, content = channel_layer.receive([channel], block=False)
+        if received is None:
+            break
+        batch.append(content)
+
+    metrics.inc('broadcast_drained_total', len(batch), queue=QUEUE_NAMES[channel])
+    return batch
+
+
+def report_queue_depth():
+    """
+    Set the broadcast_queue_depth gauge of each queue to the number of items waiting in it,
+    as reported by the channel layer. Only channel layers with the ASGI "statistics"
+    extension (e.g. the Redis one) report it; otherwise the gauge is left out.
+    """
+    channel_layer = channel_layers[DEFAULT_CHANNEL_LAYER].channel_layer
+    if 'statistics' not in getattr(channel_layer, 'extensions', ()):
+        return
+    for channel, queue in QUEUE_NAMES.items():
+        try:
+            depth = channel_layer.channel_statistics(channel)['messages_pending']
+        except Exception:
+            logger.exception('Cannot get the depth of broadcast queue %s', queue)
+            continue
+        metrics.set_gauge('broadcast_queue_depth', depth, queue=queue)
+
+
+def record_published(batch, channel=QUEUE_CHANNEL):
+    """
+    Record the publish latency (time from enqueue to publish) of a batch of queued items.
+
+    :param batch: a list of the contents of the queued items
+    :param channel: name of the queue channel
+    """
+    queue = QUEUE_NAMES[channel]
+    now = time.time()
+    for content in batch:
+        metrics.observe('broadcast_publish_latency_seconds', now - content['queued_at'], queue=queue)
+    metrics.inc('broadcast_batches_total', queue=queue)
+    metrics.inc('broadcast_items_total', len(batch), queue=queue)
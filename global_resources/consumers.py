@@ -2,31 +2,250 @@
 Defines how consumers (those who listen to the channel) interacts with the
 grumbles (messages) stream channel.
 
+Every consumer can be profiled on demand by staff users (see profiling.py).
+
 Author: Stephen Xie <[redacted]@cmu.edu>
 """
+import json
+import logging
+
 from channels import Group
+from channels.auth import channel_session_user, channel_session_user_from_http
+from channels.sessions import channel_session
+from django.conf import settings
+
+from . import stream_shards, subscriptions
+from .broadcast import COMMENT_QUEUE_CHANNEL, drain, record_published
+from .metrics import metrics
+from .models import Comment, Message
+from .profiling import profiled_consumer
+
 
+# for printing debugging info to console
+logger = logging.getLogger(__name__)
 
+
+@profiled_consumer
 def connect_global_stream(message):
     """
-    When the user opens a WebSocket to a global stream, adds them to the
-    group for that stream so they receive new message updates.
+    When the user opens a WebSocket to a global stream, adds them to one of the
+    shard groups of that stream so they receive new message updates.
 
     The updates are actually sent in the Message model on save.
     """
     # accept the incoming connection
     message.reply_channel.send({'accept': True})
-    # add the reply_channel of this connection to the global_stream group,
-    # so that it can receive updates sent to the group (all group members
-    # will be able to get the same message)
-    Group('global_stream').add(message.reply_channel)
+    # add the reply_channel of this connection to its shard of the global_stream group,
+    # so that it can receive updates sent to the group (all members of all shards
+    # will be able to get the same message); see stream_shards.py
+    stream_shards.add(message.reply_channel)
+    metrics.inc('ws_connects_total', stream='global')
+
+
+@profiled_consumer
+def receive_global_stream(message):
+    """
+    Handles the heartbeats the clients send over the global stream, which keep their
+    sockets from being pruned from the shard groups (see stream_shards.py).
+    """
+    try:
+        frame = json.loads(message.content.get('text') or '{}')
+    except ValueError:
+        return
+    if isinstance(frame, dict) and frame.get('type') == 'heartbeat':
+        stream_shards.add(message.reply_channel)
 
 
+@profiled_consumer
 def disconnect_global_stream(message):
     """
-    Removes the user from the global_stream group when they disconnect.
+    Removes the user from its shard of the global_stream group when they disconnect.
 
     Channels will auto-cleanup eventually, but it can take a while, and having old
-    entries cluttering up the group will reduce performance.
+    entries cluttering up the group will reduce performance; sockets whose disconnect
+    never arrives are pruned when they stop sending heartbeats.
+    """
+    stream_shards.discard(message.reply_channel)
+    metrics.inc('ws_disconnects_total', stream='global')
+
+
+@profiled_consumer
+@channel_session_user_from_http
+def connect_following_stream(message):
+    """
+    When the user opens a WebSocket to the following stream, subscribes it to the
+    users they're following, so that it receives their new messages.
+
+    The updates are actually sent in the Message model on save; follow / unfollow
+    changes the subscriptions of open connections on the fly (see subscriptions.py).
+    """
+    if not message.user.is_authenticated:
+        # the following stream is personal; reject anonymous connections
+        message.reply_channel.send({'close': True})
+        return
+
+    message.reply_channel.send({'accept': True})
+    subscriptions.connect(message.reply_channel, message.user.id)
+    metrics.inc('ws_connects_total', stream='following')
+
+
+@profiled_consumer
+@channel_session_user
+def receive_following_stream(message):
+    """
+    Handles the heartbeats the clients send over the following stream, which keep their
+    sockets from being pruned from the groups (see subscriptions.py).
+    """
+    try:
+        frame = json.loads(message.content.get('text') or '{}')
+    except ValueError:
+        return
+    if isinstance(frame, dict) and frame.get('type') == 'heartbeat' and message.user.is_authenticated:
+        subscriptions.connect(message.reply_channel, message.user.id)
+
+
+@profiled_consumer
+@channel_session_user
+def disconnect_following_stream(message):
+    """
+    Removes the connection from the groups of the following stream when it's closed.
     """
-    Group('global_stream').discard(message.reply_channel)
+    if message.user.is_authenticated:
+        subscriptions.disconnect(message.reply_channel, message.user.id)
+    metrics.inc('ws_disconnects_total', stream='following')
+
+
+@profiled_consumer
+def publish_messages(message):
+    """
+    Broadcasts newly posted messages to the streams. Invoked for each message id queued
+    by Message.save() (see broadcast.py); any other ids queued up by then are taken off
+    the queue and published in the same frames.
+
+    Frames are JSON objects of the form {"messages": [{"id", "author", "html"}, ...]}.
+    """
+    batch = drain(message.content, message.channel_layer, settings.BROADCAST_BATCH_SIZE)
+
+    # oldest first, so that clients prepending them to the stream end up with the newest on top
+    messages = Message.load_cards(list(Message.objects.filter(id__in=[content['id'] for content in batch])
+                                       .select_related('user').order_by('date', 'id')))
+    if messages:
+        payloads = [{'id': msg.id, 'author': msg.user.username, 'html': msg.html} for msg in messages]
+
+        # send the messages to the shards of the group; all consumers (aka "listeners") to that group
+        # will be notified
+        stream_shards.publish({'text': json.dumps({'messages': payloads})})
+
+        # one frame per author to the following stream sockets subscribed to them (see subscriptions.py)
+        frames = {}
+        for msg, payload in zip(messages, payloads):
+            frames.setdefault(msg.user_id, []).append(payload)
+        for author_id, author_payloads in frames.items():
+            subscriptions.publish(author_id, {'text': json.dumps({'messages': author_payloads})})
+        metrics.inc('ws_group_sends_total', len(frames), group='following')
+
+    record_published(batch)
+    logger.debug('Published %d of %d queued messages', len(messages), len(batch))
+
+
+def comments_group(message_id):
+    """
+    Name of the group of sockets subscribed to the comments of the given message.
+    """
+    return 'comments-{0}'.format(message_id)
+
+
+@profiled_consumer
+@channel_session_user_from_http
+def connect_comments_stream(message):
+    """
+    When the user opens a WebSocket to the comments stream, accepts it with no
+    subscriptions; the client then subscribes to the messages currently on its screen.
+    """
+    if not message.user.is_authenticated:
+        message.reply_channel.send({'close': True})
+        return
+
+    message.reply_channel.send({'accept': True})
+    message.channel_session['comment_subscriptions'] = []
+    metrics.inc('ws_connects_total', stream='comments')
+
+
+@profiled_consumer
+@channel_session
+def receive_comments_stream(message):
+    """
+    Handles subscription changes sent by the client, as JSON text frames of the form
+    {"subscribe": [message ids], "unsubscribe": [message ids]}. Each socket can be
+    subscribed to at most settings.COMMENT_SUBSCRIPTIONS_PER_SOCKET messages at a time;
+    subscriptions over the limit are rejected with an {"error": ...} frame.
+    """
+    try:
+        request = json.loads(message.content['text'])
+        subscribe = [int(msg_id) for msg_id in request.get('subscribe', [])]
+        unsubscribe = [int(msg_id) for msg_id in request.get('unsubscribe', [])]
+    except (KeyError, TypeError, ValueError, AttributeError):
+        message.reply_channel.send({'text': json.dumps({'error': 'Malformed subscription request.'})})
+        return
+
+    subscriptions = message.channel_session.get('comment_subscriptions', [])
+
+    for msg_id in unsubscribe:
+        if msg_id in subscriptions:
+            subscriptions.remove(msg_id)
+            Group(comments_group(msg_id)).discard(message.reply_channel)
+
+    rejected = []
+    for msg_id in subscribe:
+        if msg_id in subscriptions:
+            continue
+        if len(subscriptions) >= settings.COMMENT_SUBSCRIPTIONS_PER_SOCKET:
+            rejected.append(msg_id)
+            continue
+        subscriptions.append(msg_id)
+        Group(comments_group(msg_id)).add(message.reply_channel)
+
+    message.channel_session['comment_subscriptions'] = subscriptions
+
+    if rejected:
+        message.reply_channel.send({'text': json.dumps({
+            'error': 'Too many subscriptions; at most {0} are allowed per socket.'.format(
+                settings.COMMENT_SUBSCRIPTIONS_PER_SOCKET),
+            'rejected': rejected
+        })})
+
+
+@profiled_consumer
+@channel_session
+def disconnect_comments_stream(message):
+    """
+    Removes the socket from the groups of all the messages it was subscribed to.
+    """
+    for msg_id in message.channel_session.get('comment_subscriptions', []):
+        Group(comments_group(msg_id)).discard(message.reply_channel)
+    metrics.inc('ws_disconnects_total', stream='comments')
+
+
+@profiled_consumer
+def publish_comments(message):
+    """
+    Pushes newly posted comments to the sockets subscribed to their messages. Invoked
+    for each comment id queued by Comment.save() (see broadcast.py); any other ids queued
+    up by then are published along with it, one frame per message.
+
+    Frames are JSON objects of the form {"comments": [{"id", "message_id", "html"}, ...]}.
+    """
+    batch = drain(message.content, message.channel_layer, settings.BROADCAST_BATCH_SIZE,
+                  channel=COMMENT_QUEUE_CHANNEL)
+
+    comments = Comment.load_cards(list(Comment.objects.filter(id__in=[content['id'] for content in batch])
+                                       .order_by('date', 'id')))
+    frames = {}
+    for comment in comments:
+        frames.setdefault(comment.message_id, []).append(
+            {'id': comment.id, 'message_id': comment.message_id, 'html': comment.html})
+    for msg_id, payloads in frames.items():
+        Group(comments_group(msg_id)).send({'text': json.dumps({'comments': payloads})})
+        metrics.inc('ws_group_sends_total', group='comments')
+
+    record_published(batch, channel=COMMENT_QUEUE_CHANNEL)
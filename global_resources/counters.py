@@ -0,0 +1,84 @@
+"""
+Reconciliation of the denormalized counters (UserExtended.message_count / follower_count /
+following_count and Message.comment_count).
+
+The counters are kept up to date by the signal receivers in signals.py, but they can
+still drift, e.g. after rows are changed with raw SQL or bulk operations that send no
+signals. reconcile() recounts them from the source tables and fixes the rows that are
+off, in batches of primary keys so that a large table isn't locked all at once.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.1.1
+"""
+from django.apps import apps as global_apps
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from . import follow_graph
+
+
+def _count(queryset, group_by):
+    # a correlated subquery counting the rows of the queryset (already filtered on OuterRef),
+    # or 0 if there are none
+    return Coalesce(Subquery(queryset.order_by().values(group_by).annotate(count=Count('*')).values('count'),
+                             output_field=IntegerField()), 0)
+
+
+def get_counters(apps=global_apps):
+    """
+    Get the denormalized counters along with expressions computing their actual values.
+
+    :param apps: the app registry to take the models from (the historical one in migrations)
+    :return: a list of (model, counter field name, expression) tuples
+    """
+    Message = apps.get_model('global_resources', 'Message')
+    Comment = apps.get_model('global_resources', 'Comment')
+    UserExtended = apps.get_model('global_resources', 'UserExtended')
+    # rows of the follow relation: userextended_id follows user_id
+    Follow = UserExtended._meta.get_field('following').remote_field.through
+
+    return [
+        (UserExtended, 'message_count', _count(Message.objects.filter(user_id=OuterRef('pk')), 'user')),
+        (UserExtended, 'follower_count', _count(Follow.objects.filter(user_id=OuterRef('pk')), 'user')),
+        (UserExtended, 'following_count',
+         _count(Follow.objects.filter(userextended_id=OuterRef('pk')), 'userextended')),
+        (Message, 'comment_count', _count(Comment.objects.filter(message_id=OuterRef('pk')), 'message')),
+    ]
+
+
+def reconcile(apps=global_apps, batch_size=1000, dry_run=False):
+    """
+    Recount the denormalized counters and fix the ones that have drifted.
+
+    :param apps: the app registry to take the models from (the historical one in migrations)
+    :param batch_size: number of primary keys checked per batch
+    :param dry_run: only count the drifted rows, without fixing them
+    :return: a list of (model name, counter field name, number of drifted rows) tuples
+    """
+    results = []
+    for model, field, actual in get_counters(apps):
+        drifted = 0
+        last = None
+        while True:
+            # walk the table by ranges of primary keys (keyset style), rather than loading them all
+            keys = model.objects.order_by('pk')
+            if last is not None:
+                keys = keys.filter(pk__gt=last)
+            pks = list(keys.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            last = pks[-1]
+
+            batch = model.objects.filter(pk__gte=pks[0], pk__lte=last)
+            with transaction.atomic():
+                off = list(batch.annotate(actual=actual).exclude(**{field: F('actual')})
+                           .values_list('pk', flat=True))
+                if off and not dry_run:
+                    model.objects.filter(pk__in=off).update(**{field: actual})
+            drifted += len(off)
+        results.append((model.__name__, field, drifted))
+        if field == 'follower_count' and drifted and not dry_run:
+            # fixed follower counts may have crossed the fan-out limit
+            follow_graph.invalidate_fan_out_on_read()
+    return results
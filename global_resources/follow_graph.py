@@ -0,0 +1,228 @@
+"""
+Cached lookups on the follow graph (UserExtended.following and its reverse, followed_by).
+
+The ids of the users a user is following, and of the users following them, are kept in
+the default cache as compact arrays of 32-bit integers (sorted, so that they can be paged
+through by id), and a decoded copy of the most recently used ones in the memory of the
+process as frozensets, so that is_following(a, b) is a set lookup instead of a query.
+
+Each user has a version stamp in the default cache, replaced whenever a follow relation
+of theirs changes (m2m_changed; see signals.py), as in backends.py: a cached id set is only
+used while its user's stamp is unchanged. Changes made through the m2m managers of the
+relation (add / remove / clear, from either side) are picked up right away by every
+process if the default cache is shared (CACHE_URL), otherwise by the process they were
+made in, and by the others within settings.FOLLOW_GRAPH_CACHE_TIMEOUT.
+
+The ids of the users over the fan-out limit (settings.TIMELINE_FANOUT_LIMIT, see
+TimelineEntry) are cached the same way, so that the following view finds the authors to
+merge on read without a join on every poll.
+
+Note: models.py depends on this module, so the models are looked up lazily.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.0.1
+"""
+import threading
+import time
+import uuid
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+
+# the two directions of the relation
+FOLLOWING = 'following'
+FOLLOWERS = 'followers'
+# type code of the cached id arrays; user ids (AutoField) are 32-bit integers
+ID_TYPECODE = 'i'
+# cache key of the ids of the users over the fan-out limit
+FAN_OUT_ON_READ_KEY = 'follow-graph-fan-out-on-read'
+
+# (relation, user id) -> (time it expires, version stamp, sorted id array, frozenset of the ids)
+_sets = OrderedDict()
+_lock = threading.Lock()
+# total number of ids held in _sets
+_size = 0
+
+
+def _user_extended_model():
+    return apps.get_model('global_resources', 'UserExtended')
+
+
+def _version_key(user_id):
+    return 'follow-graph-version-{0}'.format(user_id)
+
+
+def _ids_key(relation, user_id, version):
+    return 'follow-graph-{0}-{1}-{2}'.format(relation, user_id, version)
+
+
+def _current_version(user_id):
+    # the version stamp of a user, starting a new one if it's not in the cache (e.g. it has been evicted)
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def _load_ids(relation, user_id):
+    # the sorted ids of one side of a user's relations, from the database
+    # from the primary even in views reading from a replica (see routers.py), as the cache is shared
+    follows = _user_extended_model().following.through.objects.using(DEFAULT_DB_ALIAS)
+    if relation == FOLLOWING:
+        # rows of the relation: userextended_id (the follower's user id) follows user_id
+        ids = follows.filter(userextended_id=user_id).values_list('user_id', flat=True)
+    else:
+        ids = follows.filter(user_id=user_id).values_list('userextended_id', flat=True)
+    return array(ID_TYPECODE, sorted(ids))
+
+
+def _forget(key):
+    # drop a local copy; must hold _lock
+    global _size
+    entry = _sets.pop(key, None)
+    if entry is not None:
+        _size -= len(entry[2])
+
+
+def _get(relation, user_id):
+    """
+    :return: a tuple of (sorted id array, frozenset of the ids) of one side of a user's relations
+    """
+    global _size
+    user_id = int(user_id)
+    # read the version before the data, so that a copy is never newer than its version
+    version = _current_version(user_id)
+
+    with _lock:
+        entry = _sets.get((relation, user_id))
+        if entry is not None and entry[0] > time.time() and entry[1] == version:
+            _sets.move_to_end((relation, user_id))
+            return entry[2], entry[3]
+
+    key = _ids_key(relation, user_id, version)
+    packed = cache.get(key)
+    if packed is not None:
+        ids = array(ID_TYPECODE)
+        ids.frombytes(packed)
+    else:
+        ids = _load_ids(relation, user_id)
+        cache.set(key, ids.tobytes(), settings.FOLLOW_GRAPH_CACHE_TIMEOUT)
+    members = frozenset(ids)
+
+    with _lock:
+        _forget((relation, user_id))
+        _sets[(relation, user_id)] = (time.time() + settings.FOLLOW_GRAPH_CACHE_TIMEOUT, version, ids, members)
+        _size += len(ids)
+        # keep the most recently used ones, but at least the one just loaded
+        while _size > settings.FOLLOW_GRAPH_CACHE_IDS and len(_sets) > 1:
+            _forget(next(iter(_sets)))
+    return ids, members
+
+
+def following_ids(user_id):
+    """
+    :return: a frozenset of the ids of the users the given user is following
+    """
+    return _get(FOLLOWING, user_id)[1]
+
+
+def follower_ids(user_id):
+    """
+    :return: a frozenset of the ids of the users following the given user
+    """
+    return _get(FOLLOWERS, user_id)[1]
+
+
+def is_following(follower_id, user_id):
+    """
+    :return: whether the user with id follower_id is following the user with id user_id
+    """
+    return int(user_id) in following_ids(follower_id)
+
+
+def get_id_page(relation, user_id, after_id=None, size=20):
+    """
+    Get a page of the ids on one side of a user's relations, in ascending order.
+
+    :param relation: FOLLOWING or FOLLOWERS
+    :param user_id: the user whose relations are paged through
+    :param after_id: the last id of the previous page (excluded), or None for the first page
+    :param size: maximum number of ids in the page
+    :return: a tuple of (list of ids, whether there're more after them)
+    """
+    ids = _get(relation, user_id)[0]
+    start = bisect_right(ids, after_id) if after_id is not None else 0
+    return list(ids[start:start + size]), start + size < len(ids)
+
+
+def _bump(user_ids):
+    cache.set_many({_version_key(user_id): uuid.uuid4().hex for user_id in user_ids}, None)
+    with _lock:
+        for user_id in user_ids:
+            _forget((FOLLOWING, user_id))
+            _forget((FOLLOWERS, user_id))
+
+
+def invalidate(user_ids):
+    """
+    Forget the cached id sets of the given users, in every process. This is done now, and
+    again once the transaction commits, so that a set loaded by another request from the
+    not yet committed data doesn't stick around.
+
+    :param user_ids: an iterable of user ids
+    """
+    user_ids = {int(user_id) for user_id in user_ids}
+    if user_ids:
+        _bump(user_ids)
+        transaction.on_commit(lambda: _bump(user_ids))
+
+
+def fan_out_on_read_ids():
+    """
+    :return: a frozenset of the ids of the users with more followers than the fan-out limit
+             (settings.TIMELINE_FANOUT_LIMIT), whose messages are merged into the timelines on read
+    """
+    packed = cache.get(FAN_OUT_ON_READ_KEY)
+    if packed is None:
+        ids = array(ID_TYPECODE, _user_extended_model().objects.using(DEFAULT_DB_ALIAS)
+                    .filter(follower_count__gt=settings.TIMELINE_FANOUT_LIMIT).values_list('user_id', flat=True))
+        cache.set(FAN_OUT_ON_READ_KEY, ids.tobytes(), settings.FOLLOW_GRAPH_CACHE_TIMEOUT)
+    else:
+        ids = array(ID_TYPECODE)
+        ids.frombytes(packed)
+    return frozenset(ids)
+
+
+def check_fan_out_limit(user_ids, delta):
+    """
+    Forget the cached users over the fan-out limit if any of the given users has just crossed
+    it, after their follower counts have been changed by delta.
+
+    :return: a list of the ids of the users who have just crossed the limit
+    """
+    limit = settings.TIMELINE_FANOUT_LIMIT
+    # the counts that have just crossed the limit, upwards or downwards
+    low, high = (limit, limit + delta) if delta > 0 else (limit + delta, limit)
+    if not user_ids or not delta:
+        return []
+    crossed = list(_user_extended_model().objects.filter(pk__in=list(user_ids), follower_count__gt=low,
+                                                         follower_count__lte=high).values_list('pk', flat=True))
+    if crossed:
+        invalidate_fan_out_on_read()
+    return crossed
+
+
+def invalidate_fan_out_on_read():
+    """
+    Forget the cached users over the fan-out limit, now and once the transaction commits.
+    """
+    cache.delete(FAN_OUT_ON_READ_KEY)
+    transaction.on_commit(lambda: cache.delete(FAN_OUT_ON_READ_KEY))
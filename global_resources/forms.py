@@ -2,12 +2,15 @@
 Forms used by the site for validating user input.
 
 Author: Stephen Xie <[redacted]@cmu.edu>
-Version: 1.2.0
+Version: 1.3.0
 """
 from django import forms
+from django.contrib.auth.forms import PasswordResetForm
 from django.contrib.auth.models import User
+from django.template import loader
 
 from .models import Message, UserExtended, Comment
+from .outbox import queue_mail
 
 
 class UserLoginForm(forms.Form):
@@ -370,3 +373,21 @@ class UserExtInfoForm(forms.ModelForm):
                 }
             )
         }
+
+
+class OutboxPasswordResetForm(PasswordResetForm):
+    """
+    The built-in password reset form, except that the reset emails are queued in the
+    outbox (see outbox.py) instead of being sent within the request.
+    """
+
+    def send_mail(self, subject_template_name, email_template_name,
+                  context, from_email, to_email, html_email_template_name=None):
+        # same as PasswordResetForm.send_mail, with queue_mail() in place of the actual sending
+        subject = loader.render_to_string(subject_template_name, context)
+        # email subject *must not* contain newlines
+        subject = ''.join(subject.splitlines())
+        body = loader.render_to_string(email_template_name, context)
+        html_body = loader.render_to_string(html_email_template_name, context) if html_email_template_name else None
+
+        queue_mail(subject, body, from_email, [to_email], html_message=html_body)
@@ -0,0 +1,85 @@
+"""
+A cache of pre-rendered HTML fragments (message / comment cards).
+
+Rendering a message card touches the author, the author's avatar and every comment
+(each with its own author and avatar), so it's a lot of work to be repeated on every
+API call or broadcast. Rendered cards are kept in the default cache under the key
+(kind, id, version). The version of a card is a random token stored in the cache;
+invalidating a card simply drops its version, so that the next read renders it again
+under a new version while the stale fragment expires on its own.
+
+The cards are invalidated by the signal receivers in signals.py when the message, a
+comment on it, or the name / avatar of a user shown in it changes.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.0.0
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.html import strip_spaces_between_tags
+
+
+MESSAGE_CARD = 'message'
+COMMENT_CARD = 'comment'
+
+
+def _version_key(kind, pk):
+    return 'card-version:{0}:{1}'.format(kind, pk)
+
+
+def _card_key(kind, pk, version):
+    return 'card:{0}:{1}:{2}'.format(kind, pk, version)
+
+
+def get_card(kind, pk, render):
+    """
+    Get a rendered card from the cache, rendering and storing it on a miss.
+
+    :param kind: type of the card, either MESSAGE_CARD or COMMENT_CARD
+    :param pk: id of the message / comment
+    :param render: a function with no arguments that renders the card
+    :return: the HTML code of the card
+    """
+    version_key = _version_key(kind, pk)
+    version = cache.get(version_key)
+    if version is None:
+        version = uuid.uuid4().hex
+        # add() instead of set(), in case someone else has just picked a version
+        if not cache.add(version_key, version, settings.CARD_CACHE_TIMEOUT):
+            version = cache.get(version_key, version)
+
+    card_key = _card_key(kind, pk, version)
+    html = cache.get(card_key)
+    if html is None:
+        # drop the indentation between tags once here, rather than on every response (it was
+        # previously done with {% spaceless %} in the JSON templates)
+        html = strip_spaces_between_tags(render())
+        cache.set(card_key, html, settings.CARD_CACHE_TIMEOUT)
+    return html
+
+
+def get_cached_ids(kind, pks):
+    """
+    Find out which of the given cards are currently in the cache, with two
+    round trips to the cache regardless of the number of cards.
+
+    :param kind: type of the cards, either MESSAGE_CARD or COMMENT_CARD
+    :param pks: ids of the messages / comments
+    :return: a set of ids whose cards are cached
+    """
+    versions = cache.get_many([_version_key(kind, pk) for pk in pks])
+    card_keys = {_card_key(kind, pk, versions[_version_key(kind, pk)]): pk
+                 for pk in pks if _version_key(kind, pk) in versions}
+    return {card_keys[key] for key in cache.get_many(list(card_keys))}
+
+
+def invalidate_cards(kind, pks):
+    """
+    Invalidate the cached cards of the given messages / comments.
+
+    :param kind: type of the cards, either MESSAGE_CARD or COMMENT_CARD
+    :param pks: ids of the messages / comments
+    """
+    cache.delete_many([_version_key(kind, pk) for pk in pks])
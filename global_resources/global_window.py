@@ -0,0 +1,321 @@
+"""
+A cached window of the latest messages of the global stream.
+
+Every client of the global stream asks for the newest page of messages (or the messages
+posted since its last poll), which is always the same handful of rows. The newest
+settings.GLOBAL_WINDOW_SIZE messages are kept in the default cache, newest first, and the
+global message APIs are answered from it whenever the requested page falls inside it.
+
+The window is filled from the database on a miss by a single request at a time (single
+flight): whoever takes the fill lock runs the one query, while the others wait for the
+window to show up in the cache instead of all querying the database at once. After that
+it's kept up to date incrementally, once the change is committed: new messages are added
+by Message.save(), deleted messages are dropped and comment counts are refreshed by the
+signal receivers in signals.py. Updates take the same lock, so that they're not lost to
+a fill or to each other. They run in the commit hooks of the requests, so they don't wait
+for it: an update that can't get the lock right away drops the window altogether, and flags
+it as dirty, so that a fill that read the database before the change committed drops the
+window it has just stored too.
+
+The window is shared by every process through the cache, and each change is applied by the
+process that made it, so a per-process cache (the local memory one, when CACHE_URL isn't
+set) would leave the other processes serving stale windows. It's only used if
+settings.GLOBAL_WINDOW_ENABLED is set (the default when the cache is shared); otherwise the
+global message APIs query the database every time.
+
+Only the message rows are kept; the rendered cards come from the fragment cache
+(see fragments.py).
+
+The global stream also has a version stamp in the default cache, replaced after every
+such change (including the deletion or the new comment count of a message outside the
+window), which the ETag of the global message APIs is made from (see views.py). With a
+per-process cache, a process only sees the changes it made itself in the version stamp, so a
+deletion handled by another process may be answered with 304 Not Modified until that
+process's own stamp changes.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.3.0
+"""
+import logging
+import time
+import uuid
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.dateparse import parse_datetime
+
+from .paging import DIRECTION_NEWER, DIRECTION_OLDER, InvalidCursor, decode_cursor, page_cursors
+
+
+# for printing debugging info to console
+logger = logging.getLogger(__name__)
+
+WINDOW_KEY = 'global-window'
+LOCK_KEY = 'global-window-lock'
+DIRTY_KEY = 'global-window-dirty'
+VERSION_KEY = 'global-window-version'
+
+# how long (in seconds) the lock is held at most, should its holder die before releasing it
+LOCK_TIMEOUT = 10
+# how often (in seconds) a request waiting for the lock checks on it
+LOCK_POLL_INTERVAL = 0.01
+
+
+def _message_model():
+    # models.py depends on this module, so the model is looked up lazily
+    return apps.get_model('global_resources', 'Message')
+
+
+def _field_names():
+    return [field.attname for field in _message_model()._meta.concrete_fields]
+
+
+def _load_row(message_id):
+    # a message as a dictionary of its fields, or None if it doesn't exist
+    return _message_model().objects.using(DEFAULT_DB_ALIAS).filter(id=message_id).values(*_field_names()).first()
+
+
+def _to_messages(rows):
+    Message = _message_model()
+    names = _field_names()
+    return [Message.from_db('default', names, [row[name] for name in names]) for row in rows]
+
+
+def _key(row):
+    return row['date'], row['id']
+
+
+def _acquire():
+    """
+    Take the window lock, if it's free.
+
+    :return: a token to release the lock with, or None if it's held by someone else
+    """
+    token = uuid.uuid4().hex
+    return token if cache.add(LOCK_KEY, token, LOCK_TIMEOUT) else None
+
+
+def _release(token):
+    # not atomic, but the lock only expires on its own if its holder has been stuck for LOCK_TIMEOUT
+    if cache.get(LOCK_KEY) == token:
+        cache.delete(LOCK_KEY)
+
+
+def _fill():
+    """
+    Load the window from the database.
+
+    :return: a dictionary of 'rows' (newest first) and 'complete' (whether the window
+             holds every message there is)
+    """
+    size = settings.GLOBAL_WINDOW_SIZE
+    # from the primary even in views reading from a replica (see routers.py): the window is
+    # shared by every request, and a lagging replica would leave out the newest messages
+    rows = list(_message_model().objects.using(DEFAULT_DB_ALIAS).order_by('-date', '-id').values(*_field_names())[:size])
+    return {'rows': rows, 'complete': len(rows) < size}
+
+
+def get_window():
+    """
+    Get the window from the cache, filling it on a miss with single-flight protection.
+
+    :return: the window (see _fill), or None if the window is disabled, or if it's being filled
+             by someone else and didn't show up within settings.GLOBAL_WINDOW_WAIT seconds (the
+             caller should then query the database on its own)
+    """
+    if not settings.GLOBAL_WINDOW_ENABLED:
+        return None
+
+    window = cache.get(WINDOW_KEY)
+    if window is not None:
+        return window
+
+    deadline = time.time() + settings.GLOBAL_WINDOW_WAIT
+    while True:
+        token = _acquire()
+        if token is not None:
+            try:
+                # someone may have filled it while we were waiting for the lock
+                window = cache.get(WINDOW_KEY)
+                if window is None:
+                    cache.delete(DIRTY_KEY)
+                    window = _fill()
+                    cache.set(WINDOW_KEY, window, settings.GLOBAL_WINDOW_TIMEOUT)
+                    # checked after storing it, so that an update that couldn't take the lock during
+                    # the fill either is seen here, or deletes the window after it has been stored
+                    if cache.get(DIRTY_KEY) is not None:
+                        cache.delete(WINDOW_KEY)
+            finally:
+                _release(token)
+            return window
+
+        time.sleep(LOCK_POLL_INTERVAL)
+        window = cache.get(WINDOW_KEY)
+        if window is not None:
+            return window
+        if time.time() >= deadline:
+            return None
+
+
+def _update(change):
+    """
+    Apply a change to the cached window, if there's one.
+
+    :param change: a function taking the window and modifying it in place
+    """
+    if not settings.GLOBAL_WINDOW_ENABLED:
+        return
+
+    # not waiting for a fill / another update to finish, as this runs in the commit hook of a request
+    token = _acquire()
+    if token is None:
+        # can't tell whether the change would be lost; let the next read fill the window again,
+        # including a fill that is under way (see get_window)
+        logger.info('Global window is locked; dropping the window')
+        cache.set(DIRTY_KEY, True, LOCK_TIMEOUT)
+        cache.delete(WINDOW_KEY)
+        return
+    try:
+        window = cache.get(WINDOW_KEY)
+        if window is not None:
+            change(window)
+            cache.set(WINDOW_KEY, window, settings.GLOBAL_WINDOW_TIMEOUT)
+    finally:
+        _release(token)
+
+
+def get_version():
+    """
+    :return: the version stamp of the global stream, starting a new one if it's not in the
+             cache (e.g. it has been evicted)
+    """
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def _bump_version():
+    # after the change has been applied, so that a response tagged with the new version has the new data
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def add(message_id):
+    """
+    Add a newly committed message to the window.
+
+    :param message_id: id of the message
+    """
+    row = _load_row(message_id)
+    if row is None:
+        return
+
+    def change(window):
+        rows = window['rows']
+        if any(existing['id'] == message_id for existing in rows):
+            return
+        if not window['complete'] and rows and _key(row) < _key(rows[-1]):
+            return  # older than the window (committed late); it's not the newest anyway
+        rows.append(row)
+        rows.sort(key=_key, reverse=True)
+        if len(rows) > settings.GLOBAL_WINDOW_SIZE:
+            del rows[settings.GLOBAL_WINDOW_SIZE:]
+            window['complete'] = False
+
+    _update(change)
+    _bump_version()
+
+
+def discard(message_id):
+    """
+    Drop a deleted message from the window.
+
+    :param message_id: id of the message
+    """
+    def change(window):
+        window['rows'] = [row for row in window['rows'] if row['id'] != message_id]
+
+    _update(change)
+    _bump_version()
+
+
+def refresh(message_id):
+    """
+    Reload a message in the window from the database, e.g. after its comment count changed.
+
+    :param message_id: id of the message
+    """
+    # skip messages that aren't in the window, which is most of them
+    if any(existing['id'] == message_id for existing in (cache.get(WINDOW_KEY) or {}).get('rows', ())):
+        row = _load_row(message_id)
+        if row is not None:
+            def change(window):
+                window['rows'] = [row if existing['id'] == message_id else existing for existing in window['rows']]
+
+            _update(change)
+    # the message may be on a page served from the database
+    _bump_version()
+
+
+def get_page(cursor=None, direction=DIRECTION_OLDER, size=20):
+    """
+    Get a page of messages from the window; see paging.keyset_page for the parameters.
+
+    :return: a tuple of (list of messages, next_cursor, prev_cursor), or None if the page
+             doesn't fall inside the window
+    :raise InvalidCursor: if the cursor or the direction is malformed
+    """
+    if direction not in (DIRECTION_OLDER, DIRECTION_NEWER):
+        raise InvalidCursor('Invalid paging direction: {0}'.format(direction))
+    boundary = decode_cursor(cursor) if cursor else None
+
+    window = get_window()
+    if window is None:
+        return None
+    rows, complete = window['rows'], window['complete']
+
+    if direction == DIRECTION_OLDER or boundary is None:
+        candidates = [row for row in rows if boundary is None or _key(row) < boundary]
+        if len(candidates) > size:
+            page, has_more = candidates[:size], True
+        elif complete:
+            page, has_more = candidates, False
+        else:
+            return None  # the page runs past the end of the window
+    else:
+        if not complete and (not rows or boundary < _key(rows[-1])):
+            return None  # there may be newer rows between the cursor and the window
+        # the rows closest to the cursor, newest first; see paging.keyset_page
+        page, has_more = [row for row in rows if _key(row) > boundary][-size:], True
+
+    messages = _to_messages(page)
+    return (messages,) + page_cursors(messages, has_more, cursor)
+
+
+def get_ranged(from_date, mrange=20):
+    """
+    Get the messages posted after the given time from the window, in chronological order;
+    see Message.get_all_ranged.
+
+    :param from_date: the starting time (excluded), as an ISO 8601 string
+    :param mrange: how many messages will be returned at most
+    :return: a list of messages, or None if they don't fall inside the window
+    """
+    try:
+        from_date = parse_datetime(from_date)
+    except ValueError:
+        from_date = None
+    if from_date is None or from_date.tzinfo is None:
+        return None  # leave the odd formats to the database
+
+    window = get_window()
+    if window is None:
+        return None
+    rows = window['rows']
+    if not window['complete'] and (not rows or rows[-1]['date'] > from_date):
+        return None  # there may be newer messages than from_date behind the window
+
+    return _to_messages(list(reversed([row for row in rows if row['date'] > from_date]))[:mrange])
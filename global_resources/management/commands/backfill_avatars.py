@@ -0,0 +1,43 @@
+"""
+Generate the thumbnails of existing avatars; see avatars.py.
+
+Usage: python manage.py backfill_avatars [--all]
+
+Only avatars without thumbnails are processed, unless --all is given (e.g. after changing
+settings.AVATAR_SIZES). Thumbnails are shared by content, so each distinct image is resized
+only once.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+"""
+from django.core.management.base import BaseCommand
+
+from global_resources import avatars
+from global_resources.models import UserExtended
+
+
+class Command(BaseCommand):
+    help = 'Generate the thumbnails of existing avatars.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='process avatars that already have thumbnails too')
+
+    def handle(self, *args, **options):
+        users = UserExtended.objects.order_by('pk')
+        if not options['all']:
+            users = users.filter(avatar_hash='')
+
+        done = failed = 0
+        for user_ext in users.iterator():
+            try:
+                user_ext.avatar_hash, user_ext.avatar_webp = avatars.make_stored_thumbnails(user_ext.avatar.name)
+            except IOError as e:
+                # e.g. the original file is missing from the storage, or isn't an image
+                self.stderr.write('User {0}: cannot read the avatar ({1})'.format(user_ext.pk, e))
+                failed += 1
+                continue
+
+            # only the thumbnail fields; this also invalidates the cached cards showing the avatar
+            user_ext.save(update_fields=['avatar_hash', 'avatar_webp'])
+            done += 1
+
+        self.stdout.write('Generated thumbnails for {0} avatar(s); {1} failed.'.format(done, failed))
@@ -0,0 +1,248 @@
+"""
+Benchmark the hot API endpoints (post / get messages and comments) through the Django
+test client, at several dataset sizes.
+
+Usage: python manage.py benchmark_api [--sizes 1000,10000] [--iterations 200]
+                                      [--output bench.json] [--baseline baseline.json]
+
+For each size, a throwaway test database is created and filled by generate_dataset with
+that many messages (plus a tenth as many users and twice as many comments, from a fixed
+seed), so runs are reproducible and never touch the real data. Each endpoint is then
+requested --iterations times (after a few warm-up requests) as a well-connected user, and
+reported as JSON: p50 / p95 / p99 latency, database queries per request and bytes per
+response.
+
+The message lists are benchmarked on the keyset paginated endpoints the pages use
+(/api/get-messages/<view>/page/ and /api/get-messages/profile/<user>/page/), both for the
+first page and for a page DEEP_PAGES pages down (reached by following next_cursor), since a
+deep page is where offset pagination used to fall over. The legacy endpoints, which start
+from the epoch, are kept as *_legacy for comparison only.
+
+With --baseline, the results are compared against a report saved from an earlier run
+(e.g. on the main branch); the command fails if an endpoint got slower than the
+tolerance allows (p95 over --tolerance), or takes more queries per request.
+
+Note: the default cache is cleared between sizes, so don't point it at a shared cache in
+use. New messages are broadcast to an in-memory channel layer, so that Redis isn't needed.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+"""
+import io
+import json
+import math
+import time
+
+from asgiref.inmemory import ChannelLayer as InMemoryChannelLayer
+from channels import DEFAULT_CHANNEL_LAYER
+from channels.asgi import ChannelLayerWrapper, channel_layers
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from global_resources.models import Message, UserExtended
+
+
+# seed of the generated datasets
+SEED = 42
+# number of requests to each endpoint before measuring
+WARMUP = 10
+# how many pages down the deep cursor pages are
+DEEP_PAGES = 10
+
+
+def percentile(values, percent):
+    """
+    :return: the given percentile of a list of numbers (nearest-rank method)
+    """
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(percent / 100.0 * len(ordered))) - 1)]
+
+
+def _body(response):
+    # read the response like a browser would; streamed responses are serialized while being read
+    if response.streaming:
+        return b''.join(response.streaming_content)
+    return response.content
+
+
+def _deep_cursor(client, url):
+    """
+    Follow next_cursor from the first page of a paged endpoint.
+
+    :return: the cursor of the page DEEP_PAGES pages down, or of the last page if there are fewer
+    """
+    cursor = None
+    for _ in range(DEEP_PAGES):
+        response = client.get(url, {'cursor': cursor} if cursor else {})
+        next_cursor = json.loads(_body(response).decode('utf-8')).get('next_cursor')
+        if not next_cursor:
+            break
+        cursor = next_cursor
+    return cursor
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the message / comment API endpoints at several dataset sizes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000',
+                            help='comma-separated numbers of messages in the generated datasets')
+        parser.add_argument('--iterations', type=int, default=200, help='measured requests per endpoint')
+        parser.add_argument('--output', help='write the JSON report to this file instead of the console')
+        parser.add_argument('--baseline', help='JSON report of an earlier run to compare against')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='allowed p95 slowdown against the baseline (0.2 = 20%%)')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes must be a comma-separated list of numbers.')
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)
+
+        # broadcasts of the new messages / comments go nowhere
+        channel_layers.set(DEFAULT_CHANNEL_LAYER, ChannelLayerWrapper(
+            channel_layer=InMemoryChannelLayer(capacity=10 ** 9),
+            alias=DEFAULT_CHANNEL_LAYER,
+            routing=settings.CHANNEL_LAYERS[DEFAULT_CHANNEL_LAYER]['ROUTING']))
+
+        # the host name of the test client; the replicas don't get the generated data, and the
+        # benchmark user posts far more often than the rate limits allow
+        with override_settings(ALLOWED_HOSTS=settings.ALLOWED_HOSTS + ['testserver'], DATABASE_REPLICAS=[],
+                               RATE_LIMITS_ENABLED=False):
+            report = {
+                'database': connection.vendor,
+                'iterations': options['iterations'],
+                'seed': SEED,
+                'sizes': [self._run_size(size, options['iterations']) for size in sizes]
+            }
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output + '\n')
+            self.stderr.write('Report written to {0}'.format(options['output']))
+        else:
+            self.stdout.write(output)
+
+        if baseline is not None:
+            regressions = self._compare(report, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError('{0} regression(s) against {1}'.format(regressions, options['baseline']))
+
+    def _run_size(self, size, iterations):
+        self.stderr.write('Benchmarking with {0} messages...'.format(size))
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            # an in-memory test database may outlive its destruction; start from scratch anyway
+            call_command('flush', interactive=False, verbosity=0)
+            cache.clear()
+            call_command('generate_dataset', messages=size, users=max(2, size // 10), comments=size * 2,
+                         seed=SEED, batch_size=5000, stdout=io.StringIO())
+            return {'messages': size, 'endpoints': self._run_endpoints(iterations)}
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            cache.clear()
+
+    def _run_endpoints(self, iterations):
+        # a reader following many users, the busiest author and the most commented recent message
+        reader = UserExtended.objects.order_by('-following_count', 'pk').select_related('user').first().user
+        author = UserExtended.objects.order_by('-message_count', 'pk').select_related('user').first().user
+        recent = Message.objects.order_by('-date', '-id')[:100]
+        message = Message.objects.filter(id__in=recent.values('id')).order_by('-comment_count', '-id').first()
+
+        client = Client()
+        client.force_login(reader)
+
+        paged = {
+            'global': '/api/get-messages/global/page/',
+            'follower': '/api/get-messages/follower/page/',
+            'profile': '/api/get-messages/profile/{0}/page/'.format(author.username)
+        }
+        # found before anything is posted, so that the deep pages hold the same messages throughout
+        deep = {view: _deep_cursor(client, url) for view, url in paged.items()}
+
+        def get_page(view, cursor=None):
+            return lambda: client.get(paged[view], {'cursor': cursor} if cursor else {})
+
+        endpoints = [
+            ('post_message', lambda: client.post('/api/post-message/', {'message': 'Benchmarking again'})),
+            ('get_messages_global', get_page('global')),
+            ('get_messages_global_deep', get_page('global', deep['global'])),
+            ('get_messages_follower', get_page('follower')),
+            ('get_messages_follower_deep', get_page('follower', deep['follower'])),
+            ('get_profile_messages', get_page('profile')),
+            ('get_profile_messages_deep', get_page('profile', deep['profile'])),
+            # the legacy endpoints, for comparison
+            ('get_messages_global_legacy', lambda: client.get('/api/get-messages/')),
+            ('get_messages_follower_legacy', lambda: client.get('/api/get-messages/follower/')),
+            ('get_profile_messages_legacy',
+             lambda: client.get('/api/get-messages/profile/{0}/'.format(author.username))),
+            ('post_comment',
+             lambda: client.post('/api/post-comment/{0}/'.format(message.id), {'content': 'Same here'})),
+            ('get_comments', lambda: client.get('/api/get-comments/{0}/'.format(message.id))),
+        ]
+
+        results = {}
+        for name, request in endpoints:
+            for _ in range(WARMUP):
+                _body(request())
+
+            latencies, queries, sizes, errors = [], [], [], 0
+            for _ in range(iterations):
+                with CaptureQueriesContext(connection) as captured:
+                    start = time.perf_counter()
+                    response = request()
+                    body = _body(response)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                queries.append(len(captured))
+                sizes.append(len(body))
+                if response.status_code >= 400:
+                    errors += 1
+
+            results[name] = {
+                'p50_ms': round(percentile(latencies, 50), 3),
+                'p95_ms': round(percentile(latencies, 95), 3),
+                'p99_ms': round(percentile(latencies, 99), 3),
+                'queries': round(sum(queries) / len(queries), 2),
+                'bytes': int(sum(sizes) / len(sizes)),
+                'errors': errors
+            }
+            self.stderr.write('  {0:<28} p50 {p50_ms:8.2f} ms  p95 {p95_ms:8.2f} ms  p99 {p99_ms:8.2f} ms  '
+                              '{queries:5.1f} queries  {bytes:7d} bytes'.format(name, **results[name]))
+        return results
+
+    def _compare(self, report, baseline, tolerance):
+        """
+        Compare a report against a baseline report, printing the differences.
+
+        :return: the number of regressions
+        """
+        regressions = 0
+        previous_sizes = {entry['messages']: entry['endpoints'] for entry in baseline.get('sizes', [])}
+        for entry in report['sizes']:
+            previous = previous_sizes.get(entry['messages'])
+            if previous is None:
+                self.stderr.write('No baseline for {0} messages'.format(entry['messages']))
+                continue
+            for name, result in sorted(entry['endpoints'].items()):
+                if name not in previous:
+                    continue
+                before = previous[name]
+                slower = result['p95_ms'] > before['p95_ms'] * (1 + tolerance)
+                more_queries = result['queries'] > before['queries']
+                status = 'REGRESSION' if slower or more_queries else 'ok'
+                regressions += status != 'ok'
+                self.stderr.write('{0:>8} messages  {1:<28} p95 {2:8.2f} -> {3:8.2f} ms ({4:+.0%})  '
+                                  'queries {5:5.1f} -> {6:5.1f}  {7}'.format(
+                                      entry['messages'], name, before['p95_ms'], result['p95_ms'],
+                                      result['p95_ms'] / before['p95_ms'] - 1 if before['p95_ms'] else 0,
+                                      before['queries'], result['queries'], status))
+        return regressions
@@ -0,0 +1,62 @@
+"""
+Compare the JSON serializer of the message APIs (serializers.py) against the old
+Django template path (messages_template.json).
+
+Usage: python manage.py benchmark_serializers [--messages 20] [--iterations 200]
+
+Both paths serialize the same latest messages in the database, with the message cards
+already in the fragment cache, so that only the serialization itself is measured.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+"""
+import json
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from global_resources import serializers
+from global_resources.models import Message
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the JSON serializer of the message APIs against the JSON template.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=20, help='number of messages per response')
+        parser.add_argument('--iterations', type=int, default=200, help='number of responses to serialize')
+
+    def handle(self, *args, **options):
+        messages = Message.load_cards(list(Message.objects.order_by('-date', '-id')[:options['messages']]))
+        if not messages:
+            raise CommandError('There are no messages in the database to benchmark with.')
+        for message in messages:
+            message.html  # warm up the fragment cache
+
+        last_updated = timezone.now().isoformat()
+
+        def template_path():
+            return render_to_string('messages_template.json',
+                                    {'messages': messages, 'last_updated': last_updated}).encode('utf-8')
+
+        def serializer_path():
+            return serializers.messages_response(messages, last_updated=last_updated).content
+
+        self.stdout.write('Encoder: {0}; {1} messages per response, {2} iterations'.format(
+            'orjson' if serializers.orjson is not None else 'json', len(messages), options['iterations']))
+
+        results = {}
+        for name, path in (('template', template_path), ('serializer', serializer_path)):
+            body = path()
+            try:
+                json.loads(body.decode('utf-8'))
+                valid = 'valid JSON'
+            except ValueError:
+                valid = 'INVALID JSON'
+            seconds = min(timeit.repeat(path, number=options['iterations'], repeat=3))
+            results[name] = seconds
+            self.stdout.write('{0:>10}: {1:8.3f} ms per response, {2:7d} bytes, {3}'.format(
+                name, seconds * 1000 / options['iterations'], len(body), valid))
+
+        self.stdout.write('Speedup: {0:.1f}x'.format(results['template'] / results['serializer']))
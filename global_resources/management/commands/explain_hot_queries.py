@@ -0,0 +1,94 @@
+"""
+Run EXPLAIN on the hot queries of the message / comment APIs, and fail if any of them
+falls back to a full table scan (i.e. is missing an index).
+
+Usage: python manage.py explain_hot_queries [--verbose-plans]
+
+Supported databases are SQLite (EXPLAIN QUERY PLAN) and PostgreSQL (EXPLAIN). On
+PostgreSQL sequential scans are disabled for the check, since the planner prefers them
+on small tables anyway; a plan that still has one has no index to use instead.
+
+The queries are built for placeholder objects, so the command works on an empty database.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+"""
+import re
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from global_resources.models import Comment, Message, UserExtended
+
+
+# a full scan of a table in an SQLite plan, e.g. "SCAN TABLE global_resources_message" or
+# "SCAN global_resources_message", as opposed to "SCAN ... USING [COVERING] INDEX ..."; the
+# lookahead goes over the whole rest of the line (which may have an alias, "... AS T3 USING ..."),
+# and the \b keeps it from backtracking into the table name
+SQLITE_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)\b(?!.* USING )')
+# a full scan of a table in a PostgreSQL plan, e.g. "Seq Scan on global_resources_message"
+POSTGRESQL_FULL_SCAN = re.compile(r'Seq Scan on (\w+)')
+
+
+def get_hot_queries():
+    """
+    :return: a list of (name, queryset) of the queries to be checked
+    """
+    user = User(pk=0, username='placeholder')
+    user.ext = UserExtended(user=user)
+    message = Message(pk=0, user=user)
+
+    return [
+        ('Message.get_all_ranged', Message.get_all_ranged()),
+        ('Message.get_user_ranged', Message.get_user_ranged(user)),
+        ('Message.get_followers_ranged', Message.get_followers_ranged(user)),
+        ('Comment.get_all_ranged', Comment.get_all_ranged(message)),
+    ]
+
+
+def explain(queryset):
+    """
+    Get the query plan of a queryset on the default database.
+
+    :param queryset: the queryset
+    :return: a list of plan lines, and a list of tables scanned in full
+    """
+    sql, params = queryset.query.sql_with_params()
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            # rows are (id, parent, notused, detail)
+            lines = [row[-1] for row in cursor.fetchall()]
+            full_scans = [match.group(1) for match in map(SQLITE_FULL_SCAN.match, lines) if match]
+        elif connection.vendor == 'postgresql':
+            # only lasts until the end of the transaction
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            lines = [row[0] for row in cursor.fetchall()]
+            full_scans = [table for line in lines for table in POSTGRESQL_FULL_SCAN.findall(line)]
+        else:
+            raise CommandError('EXPLAIN is not supported for the {0} database.'.format(connection.vendor))
+    return lines, full_scans
+
+
+class Command(BaseCommand):
+    help = 'EXPLAIN the hot queries of the message / comment APIs and fail on full table scans.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose-plans', action='store_true', help='print the full query plans')
+
+    def handle(self, *args, **options):
+        failed = []
+        for name, queryset in get_hot_queries():
+            lines, full_scans = explain(queryset)
+            if full_scans:
+                failed.append(name)
+                self.stdout.write(self.style.ERROR('{0}: full scan of {1}'.format(name, ', '.join(full_scans))))
+            else:
+                self.stdout.write(self.style.SUCCESS('{0}: OK'.format(name)))
+            if full_scans or options['verbose_plans']:
+                for line in lines:
+                    self.stdout.write('    ' + line)
+
+        if failed:
+            raise CommandError('{0} of the hot queries fall back to a full table scan.'.format(len(failed)))
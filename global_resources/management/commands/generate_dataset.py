@@ -0,0 +1,330 @@
+"""
+Generate a synthetic dataset (users, follows, messages and comments) for scale testing.
+
+Usage: python manage.py generate_dataset [--users 1000] [--follows 20] [--messages 10000]
+                                         [--comments 20000] [--days 30] [--seed 42]
+
+Shapes the data roughly like a real microblog:
+- who gets followed follows a power law (Zipf), and so does how many users each user
+  follows; the most popular users end up over settings.TIMELINE_FANOUT_LIMIT and are
+  merged into the timelines on read, as they would be in production
+- a few users post most of the messages (Zipf again); messages are spread over the last
+  --days days with a daily cycle (busy evenings, quiet nights)
+- messages of popular users draw more comments, which arrive within hours of the message
+
+Rows are written with bulk inserts in batches, bypassing Message.save() and the signals
+(no broadcasts, no fan-out per message); the counters are then reconciled and the home
+timelines filled with set-based INSERT ... SELECT statements. The same --seed (and the
+same options) gives the same dataset, so benchmark runs on it are comparable.
+
+Every generated user has the username <prefix><number> and the password given by
+--password.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+"""
+import bisect
+import contextlib
+import itertools
+import math
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from global_resources import avatars, counters, global_window
+from global_resources.models import Comment, Message, TimelineEntry, UserExtended
+
+
+FIRST_NAMES = ('Alex', 'Sam', 'Jordan', 'Taylor', 'Casey', 'Riley', 'Morgan', 'Jamie', 'Avery', 'Quinn',
+               'Robin', 'Drew', 'Kai', 'Rowan', 'Sage', 'Emery', 'Noa', 'Ari', 'Remy', 'Dana')
+LAST_NAMES = ('Smith', 'Lee', 'Garcia', 'Chen', 'Patel', 'Kim', 'Nguyen', 'Brown', 'Silva', 'Khan',
+              'Novak', 'Rossi', 'Sato', 'Muller', 'Haddad', 'Okafor', 'Jensen', 'Ivanova', 'Cohen', 'Park')
+WORDS = ('coffee', 'monday', 'again', 'why', 'traffic', 'rain', 'deadline', 'meeting', 'wifi', 'printer',
+         'bus', 'late', 'cold', 'noise', 'queue', 'email', 'bug', 'build', 'exam', 'homework', 'so', 'the',
+         'is', 'broken', 'slow', 'tired', 'hungry', 'ugh', 'seriously', 'today', 'my', 'everything')
+
+# relative number of messages posted in each hour of the day
+HOURLY_ACTIVITY = (3, 2, 1, 1, 1, 2, 4, 6, 8, 9, 9, 10, 11, 10, 9, 9, 10, 12, 14, 16, 17, 15, 11, 6)
+# mean delay (in seconds) between a message and its comments
+COMMENT_DELAY = 60 * 60 * 3
+
+
+def _sentence(rng, max_length):
+    words = rng.sample(WORDS, rng.randint(2, 6))
+    return ' '.join(words).capitalize()[:max_length]
+
+
+@contextlib.contextmanager
+def _keep_dates(*fields):
+    """
+    Let bulk inserts keep the given dates instead of overwriting them with the current
+    time, by switching off auto_now_add of the date fields for the duration.
+    """
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+class Command(BaseCommand):
+    help = 'Generate a synthetic dataset of users, follows, messages and comments for scale testing.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='number of users')
+        parser.add_argument('--follows', type=float, default=20, help='average number of users each user follows')
+        parser.add_argument('--messages', type=int, default=10000, help='number of messages')
+        parser.add_argument('--comments', type=int, default=20000, help='approximate number of comments')
+        parser.add_argument('--days', type=float, default=30, help='the messages span this many days until now')
+        parser.add_argument('--skew', type=float, default=1.1,
+                            help='Zipf exponent of the popularity / activity of the users')
+        parser.add_argument('--seed', type=int, default=42, help='seed of the random generator')
+        parser.add_argument('--prefix', default='synth', help='prefix of the generated usernames')
+        parser.add_argument('--password', default='grumblr', help='password of every generated user')
+        parser.add_argument('--batch-size', type=int, default=5000, help='number of rows per bulk insert')
+        parser.add_argument('--no-timelines', action='store_true', help="don't fill the home timelines")
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError('At least 2 users are needed.')
+        if User.objects.filter(username__startswith=options['prefix']).exists():
+            raise CommandError('There are users named {0}... already; use another --prefix.'.format(options['prefix']))
+
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.now = timezone.now()
+        count = options['users']
+
+        # popularity decides who gets followed and commented on, activity who posts; the ranks
+        # are shuffled so that the popular users aren't simply the first ones, and weighted
+        # under Zipf's law
+        self.popular = list(range(count))
+        self.rng.shuffle(self.popular)
+        self.active = list(range(count))
+        self.rng.shuffle(self.active)
+        self.weights = [1.0 / (rank ** options['skew']) for rank in range(1, count + 1)]
+        self.cum_weights = list(itertools.accumulate(self.weights))
+
+        last_message_id = Message.objects.aggregate(last=Max('id'))['last'] or 0
+
+        user_ids = self._create_users(count, options['prefix'], options['password'])
+        self._create_follows(user_ids, options['follows'])
+        self._create_messages(user_ids, options['messages'], options['comments'], options['days'])
+        self._create_comments(user_ids, last_message_id)
+
+        self.stdout.write('Reconciling the counters...')
+        counters.reconcile(batch_size=self.batch_size)
+        if not options['no_timelines']:
+            self._fill_timelines(last_message_id)
+
+        # the cached window of the global stream doesn't know about the new messages
+        cache.delete(global_window.WINDOW_KEY)
+        self.stdout.write(self.style.SUCCESS('Done.'))
+
+    def _pick(self, ranking, k):
+        # k users drawn from a ranking (a list of user indices) under the Zipf weights
+        return [ranking[rank] for rank in self.rng.choices(range(len(ranking)), cum_weights=self.cum_weights, k=k)]
+
+    def _batches(self, rows):
+        # split an iterable of rows into lists of the batch size
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def _create_users(self, count, prefix, password):
+        """
+        :return: a list of the ids of the new users, by user index
+        """
+        self.stdout.write('Creating {0} users...'.format(count))
+        # hashing is slow on purpose; every user gets the same hash
+        password = make_password(password)
+        rng = self.rng
+
+        def users():
+            for index in range(count):
+                first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+                yield User(username='{0}{1}'.format(prefix, index), password=password, first_name=first_name,
+                           last_name=last_name, email='{0}{1}@example.com'.format(prefix, index),
+                           date_joined=self.now)
+
+        for batch in self._batches(users()):
+            with transaction.atomic():
+                User.objects.bulk_create(batch)
+
+        # bulk_create doesn't return the ids on every database; look them up by username
+        user_ids = [None] * count
+        for user_id, username in User.objects.filter(username__startswith=prefix) \
+                .values_list('id', 'username').iterator():
+            suffix = username[len(prefix):]
+            if suffix.isdigit() and int(suffix) < count:
+                user_ids[int(suffix)] = user_id
+
+        # everyone starts with the default avatar, as in UserExtended.save()
+        avatar = UserExtended._meta.get_field('avatar').default
+        try:
+            avatar_hash, avatar_webp = avatars.default_thumbnails(avatar)
+        except IOError:
+            avatar_hash, avatar_webp = '', False
+        for batch in self._batches(user_ids):
+            with transaction.atomic():
+                UserExtended.objects.bulk_create([
+                    UserExtended(user_id=user_id, age=rng.randint(13, 80), gender=rng.choice('MFO'),
+                                 avatar=avatar, avatar_hash=avatar_hash, avatar_webp=avatar_webp)
+                    for user_id in batch])
+        return user_ids
+
+    def _create_follows(self, user_ids, average):
+        count = len(user_ids)
+        Follow = UserExtended.following.through
+        rng = self.rng
+        # the number of users one follows is Pareto distributed (alpha 2) with the given mean
+        scale = average / 2.0
+
+        def follows():
+            for index in range(count):
+                wanted = min(count - 1, int(rng.paretovariate(2.0) * scale))
+                followees = set()
+                # popular users are drawn over and over; give up on the rest after a few rounds
+                for _ in range(5):
+                    if len(followees) >= wanted:
+                        break
+                    followees.update(self._pick(self.popular, wanted - len(followees) + 2))
+                    followees.discard(index)
+                for followee in sorted(followees)[:wanted]:
+                    yield Follow(userextended_id=user_ids[index], user_id=user_ids[followee])
+
+        self.stdout.write('Creating follows...')
+        total = 0
+        for batch in self._batches(follows()):
+            with transaction.atomic():
+                Follow.objects.bulk_create(batch)
+            total += len(batch)
+        self.stdout.write('  {0} follows'.format(total))
+
+    def _create_messages(self, user_ids, count, comments, days):
+        """
+        Create the messages, in chronological order, with their number of comments decided
+        up front (in comment_count) so that the comments can be created message by message.
+        """
+        self.stdout.write('Creating {0} messages...'.format(count))
+        rng = self.rng
+        hour_weights = list(itertools.accumulate(HOURLY_ACTIVITY))
+
+        # popularity of each user draws comments to their messages; spread the comments so that
+        # there're about the given number in total, given the expected popularity of an author
+        popularity = [0.0] * len(user_ids)
+        for rank, index in enumerate(self.popular):
+            popularity[index] = self.weights[rank]
+        mean_popularity = sum(popularity[index] * self.weights[rank]
+                              for rank, index in enumerate(self.active)) / self.cum_weights[-1]
+        comments_per_popularity = comments / (count * mean_popularity) if count else 0
+
+        # the span ends today (local time); the messages are split evenly between the days
+        day_count = max(1, int(math.ceil(days)))
+        first_day = timezone.localtime(self.now).replace(hour=0, minute=0, second=0, microsecond=0) \
+            - timedelta(days=day_count - 1)
+        quotas = [count // day_count] * day_count
+        for day in rng.sample(range(day_count), count % day_count):
+            quotas[day] += 1
+
+        def dates():
+            # chronological, day by day, with the hours drawn by activity
+            for day, quota in enumerate(quotas):
+                midnight = timezone.localtime(first_day + timedelta(days=day))
+                day_dates = []
+                while len(day_dates) < quota:
+                    hour = bisect.bisect(hour_weights, rng.random() * hour_weights[-1])
+                    date = midnight + timedelta(hours=hour, seconds=rng.random() * 60 * 60)
+                    if date <= self.now:
+                        day_dates.append(date)
+                    elif midnight + timedelta(hours=1) > self.now:
+                        day_dates.append(self.now)  # just past midnight; nothing else fits
+                yield from sorted(day_dates)
+
+        def messages():
+            for date in dates():
+                author = self._pick(self.active, 1)[0]
+                expected = popularity[author] * comments_per_popularity
+                # a whole number of comments with the expected value above
+                comment_count = int(expected) + (1 if rng.random() < expected - math.floor(expected) else 0)
+                yield Message(user_id=user_ids[author], date=date,
+                              message=_sentence(rng, Message._meta.get_field('message').max_length),
+                              comment_count=comment_count)
+
+        with _keep_dates(Message._meta.get_field('date')):
+            for batch in self._batches(messages()):
+                with transaction.atomic():
+                    Message.objects.bulk_create(batch)
+
+    def _create_comments(self, user_ids, last_message_id):
+        """
+        Create the comments of the messages created after the given message id, as many
+        as their comment_count.
+        """
+        self.stdout.write('Creating comments...')
+        rng = self.rng
+        max_length = Comment._meta.get_field('content').max_length
+
+        def comments():
+            after = last_message_id
+            while True:
+                # walk the new messages in batches of ids
+                batch = list(Message.objects.filter(id__gt=after, comment_count__gt=0).order_by('id')
+                             .values_list('id', 'date', 'comment_count')[:self.batch_size])
+                if not batch:
+                    return
+                for message_id, date, comment_count in batch:
+                    for commenter in self._pick(self.active, comment_count):
+                        delay = timedelta(seconds=rng.expovariate(1.0 / COMMENT_DELAY))
+                        yield Comment(message_id=message_id, from_user_id=user_ids[commenter],
+                                      date=min(date + delay, self.now), content=_sentence(rng, max_length))
+                after = batch[-1][0]
+
+        total = 0
+        with _keep_dates(Comment._meta.get_field('date')):
+            for batch in self._batches(comments()):
+                with transaction.atomic():
+                    Comment.objects.bulk_create(batch)
+                total += len(batch)
+        self.stdout.write('  {0} comments'.format(total))
+
+    def _fill_timelines(self, last_message_id):
+        """
+        Fan the new messages out into the home timelines of the followers of their authors,
+        as TimelineEntry.fan_out() would have; authors over the fan-out limit are left out.
+        """
+        self.stdout.write('Filling the home timelines...')
+        Follow = UserExtended.following.through
+        qn = connection.ops.quote_name
+        sql = """
+            INSERT INTO {timeline} ({owner}, {message}, {date})
+            SELECT f.{follower}, m.{id}, m.{date}
+            FROM {messages} m
+            INNER JOIN {follows} f ON f.{followee} = m.{author}
+            INNER JOIN {exts} a ON a.{ext_user} = m.{author}
+            WHERE m.{id} > %s AND m.{id} <= %s AND a.{follower_count} <= %s
+        """.format(timeline=qn(TimelineEntry._meta.db_table), owner=qn('owner_id'), message=qn('message_id'),
+                   date=qn('date'), follower=qn('userextended_id'), id=qn('id'), messages=qn(Message._meta.db_table),
+                   follows=qn(Follow._meta.db_table), followee=qn('user_id'), author=qn('user_id'),
+                   exts=qn(UserExtended._meta.db_table), ext_user=qn('user_id'), follower_count=qn('follower_count'))
+
+        last = Message.objects.aggregate(last=Max('id'))['last'] or 0
+        total = 0
+        with connection.cursor() as cursor:
+            for after in range(last_message_id, last, self.batch_size):
+                with transaction.atomic():
+                    cursor.execute(sql, [after, min(after + self.batch_size, last), settings.TIMELINE_FANOUT_LIMIT])
+                total += cursor.rowcount
+        self.stdout.write('  {0} timeline entries'.format(total))
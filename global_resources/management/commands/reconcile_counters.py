@@ -0,0 +1,25 @@
+"""
+Recount the denormalized counters (messages / followers / following per user, comments
+per message) and fix the ones that have drifted; see counters.py.
+
+Usage: python manage.py reconcile_counters [--batch-size 1000] [--dry-run]
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+"""
+from django.core.management.base import BaseCommand
+
+from global_resources import counters
+
+
+class Command(BaseCommand):
+    help = 'Recount the denormalized message / follower / following / comment counters and fix drifted ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='number of rows checked per batch')
+        parser.add_argument('--dry-run', action='store_true', help='only report drifted counters')
+
+    def handle(self, *args, **options):
+        results = counters.reconcile(batch_size=options['batch_size'], dry_run=options['dry_run'])
+        for model_name, field, drifted in results:
+            self.stdout.write('{0}.{1}: {2} drifted row(s){3}'.format(
+                model_name, field, drifted, ' (not fixed)' if options['dry_run'] and drifted else ''))
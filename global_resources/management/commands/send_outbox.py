@@ -0,0 +1,70 @@
+"""
+Send the emails waiting in the outbox; see outbox.py.
+
+Usage: python manage.py send_outbox [--loop] [--interval 5]
+
+Without --loop, sends whatever is due and exits (e.g. for cron). With --loop, keeps
+sending over one persistent SMTP connection: right after a new email pokes the outbox
+channel, and every --interval seconds otherwise, which picks up the retries of failed
+emails. This is the `mailer` process of the Procfile, which keeps the SMTP traffic out of
+the `runworker` process serving the pages.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+"""
+import time
+
+from channels import DEFAULT_CHANNEL_LAYER, channel_layers
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from global_resources.outbox import OUTBOX_CHANNEL, send_pending
+
+
+# how often (in seconds) the outbox channel is checked for pokes, if the channel layer
+# can't block on it (e.g. the in-memory one)
+POKE_POLL_INTERVAL = 0.5
+
+
+def wait_for_poke(channel_layer, timeout):
+    """
+    Wait until a new email pokes the outbox channel (see outbox.poke), or the timeout is over.
+
+    :return: whether it was poked
+    """
+    deadline = time.time() + timeout
+    while True:
+        # the Redis channel layer blocks for a few seconds here
+        if channel_layer.receive([OUTBOX_CHANNEL], block=True)[0] is not None:
+            # drop the pokes that have piled up; one round sends every email that is due
+            while channel_layer.receive([OUTBOX_CHANNEL], block=False)[0] is not None:
+                pass
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(min(POKE_POLL_INTERVAL, max(0, deadline - time.time())))
+
+
+class Command(BaseCommand):
+    help = 'Send the emails waiting in the outbox.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='keep sending until interrupted')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='seconds between checks with --loop, when no new email comes in')
+        parser.add_argument('--batch-size', type=int, default=None, help='number of emails sent at a time')
+
+    def handle(self, *args, **options):
+        connection = get_connection(fail_silently=False)
+        channel_layer = channel_layers[DEFAULT_CHANNEL_LAYER]
+        try:
+            while True:
+                sent, failed = send_pending(connection, options['batch_size'])
+                if sent or failed or not options['loop']:
+                    self.stdout.write('Sent {0} email(s); {1} failed attempt(s).'.format(sent, failed))
+                if not options['loop']:
+                    break
+                wait_for_poke(channel_layer, options['interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            connection.close()
@@ -0,0 +1,114 @@
+"""
+Report the top offenders of the slow query log; see querylog.py.
+
+Usage: python manage.py slow_query_report [--top 20] [--sort total|count|max|mean]
+                                          [--view get-messages] [--json]
+
+Slow queries are grouped by their shape (the SQL with its literals replaced), and each
+group is reported with its number of occurrences, its total / mean / max duration, the
+views and lines of code it came from, and its latest query plan. The rotated log files
+are read too.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+"""
+import json
+import os
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+SORT_KEYS = ('total', 'count', 'max', 'mean')
+
+
+def _log_files(path):
+    # oldest first, so that the latest plan of each group wins
+    rotated = ['{0}.{1}'.format(path, number) for number in range(settings.SLOW_QUERY_LOG_BACKUPS, 0, -1)]
+    return [name for name in rotated + [path] if os.path.exists(name)]
+
+
+def _where(attribution):
+    if not attribution:
+        return '(unknown)'
+    return '{file}:{line} in {function}'.format(**attribution)
+
+
+def aggregate(paths, view=None):
+    """
+    Group the entries of slow query log files by query shape.
+
+    :param paths: the log files, oldest first
+    :param view: only count the queries of this view
+    :return: a list of dictionaries, one per query shape
+    """
+    groups = {}
+    for path in paths:
+        with open(path, encoding='utf-8') as log_file:
+            for line in log_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash
+                if view is not None and entry.get('view') != view:
+                    continue
+
+                group = groups.get(entry['fingerprint'])
+                if group is None:
+                    group = groups[entry['fingerprint']] = {
+                        'fingerprint': entry['fingerprint'], 'count': 0, 'total': 0.0, 'max': 0.0,
+                        'views': Counter(), 'origins': Counter(), 'entries': Counter(), 'plan': None,
+                        'example': None, 'last_seen': None}
+                group['count'] += 1
+                group['total'] += entry['duration_ms']
+                if entry['duration_ms'] >= group['max']:
+                    group['max'] = entry['duration_ms']
+                    group['example'] = entry['sql']
+                group['views'][entry.get('view') or '(no view)'] += 1
+                group['origins'][_where(entry.get('origin'))] += 1
+                group['entries'][_where(entry.get('entry'))] += 1
+                group['plan'] = entry.get('plan') or group['plan']
+                group['last_seen'] = entry['time']
+
+    for group in groups.values():
+        group['mean'] = group['total'] / group['count']
+    return list(groups.values())
+
+
+class Command(BaseCommand):
+    help = 'Report the top offenders of the slow query log.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20, help='number of query shapes to report')
+        parser.add_argument('--sort', choices=SORT_KEYS, default='total',
+                            help='rank by total / mean / max duration, or by number of occurrences')
+        parser.add_argument('--view', help='only count the queries of this view (URL pattern name)')
+        parser.add_argument('--log', default=None, help='the log file; settings.SLOW_QUERY_LOG by default')
+        parser.add_argument('--json', action='store_true', help='print the report as JSON')
+
+    def handle(self, *args, **options):
+        paths = _log_files(options['log'] or settings.SLOW_QUERY_LOG)
+        if not paths:
+            raise CommandError('No slow query log at {0}.'.format(options['log'] or settings.SLOW_QUERY_LOG))
+
+        groups = sorted(aggregate(paths, options['view']), key=lambda group: group[options['sort']],
+                        reverse=True)[:options['top']]
+
+        if options['json']:
+            for group in groups:
+                for key in ('views', 'origins', 'entries'):
+                    group[key] = dict(group[key].most_common())
+            self.stdout.write(json.dumps(groups, indent=2))
+            return
+
+        for rank, group in enumerate(groups, 1):
+            self.stdout.write(self.style.WARNING(
+                '#{0}  {1} x  total {2:.1f} ms  mean {3:.1f} ms  max {4:.1f} ms  (last {5})'.format(
+                    rank, group['count'], group['total'], group['mean'], group['max'], group['last_seen'])))
+            self.stdout.write('    ' + group['fingerprint'][:500])
+            for title, key in (('views', 'views'), ('from', 'origins'), ('entry', 'entries')):
+                self.stdout.write('    {0}: {1}'.format(title, ', '.join(
+                    '{0} ({1})'.format(name, count) for name, count in group[key].most_common(3))))
+            for line in group['plan'] or []:
+                self.stdout.write('    | ' + line)
+            self.stdout.write('')
@@ -0,0 +1,140 @@
+"""
+A minimal in-process metrics registry (counters, gauges and histograms).
+
+Metrics are kept in the memory of the current process and identified by a name plus
+an optional set of labels, e.g.:
+
+    metrics.inc('broadcast_messages_total')
+    metrics.observe('broadcast_publish_latency_seconds', 0.012)
+
+The metrics are exposed in the Prometheus text format by the /metrics endpoint (see
+metrics_view in views.py). As they live in the memory of each process, every worker
+process reports its own.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.1.0
+"""
+import threading
+
+
+# default upper bounds (in seconds) of the histogram buckets, suited to latencies
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# bucket upper bounds for counts of things, e.g. database queries per request
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+# bucket upper bounds for sizes in bytes
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+class Histogram:
+    """
+    Counts observed values into cumulative buckets, and keeps their count and sum.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+
+
+class Registry:
+    """
+    A thread-safe collection of metrics.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._gauges = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase a counter.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_gauge(self, name, value, **labels):
+        """
+        Increase (or decrease, with a negative value) a gauge.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Set a gauge to the given value.
+        """
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        """
+        Record a value into a histogram.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def get(self, name, **labels):
+        """
+        Get the current value of a counter or gauge, or None if it has never been set.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            return self._counters.get(key, self._gauges.get(key))
+
+    def render(self):
+        """
+        Render all the metrics in the Prometheus text exposition format.
+
+        :return: a string
+        """
+        with self._lock:
+            samples = {}  # name -> (type, list of (suffix, labels, value))
+            for kind, values in (('counter', self._counters), ('gauge', self._gauges)):
+                for (name, labels), value in values.items():
+                    samples.setdefault(name, (kind, []))[1].append(('', labels, value))
+            for (name, labels), histogram in self._histograms.items():
+                lines = samples.setdefault(name, ('histogram', []))[1]
+                for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                    lines.append(('_bucket', labels + (('le', str(bound)),), count))
+                lines.append(('_bucket', labels + (('le', '+Inf'),), histogram.count))
+                lines.append(('_sum', labels, histogram.sum))
+                lines.append(('_count', labels, histogram.count))
+
+        output = []
+        for name in sorted(samples):
+            kind, lines = samples[name]
+            output.append('# TYPE {0} {1}'.format(name, kind))
+            # keep the buckets of each histogram in order; sort by labels otherwise
+            for suffix, labels, value in (lines if kind == 'histogram' else sorted(lines, key=lambda line: line[1])):
+                output.append('{0}{1}{2} {3}'.format(name, suffix, _format_labels(labels), value))
+        return '\n'.join(output) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                             .replace('\n', '\\n'))
+                          for name, value in labels) + '}'
+
+
+# the registry of this process
+metrics = Registry()
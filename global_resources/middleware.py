@@ -0,0 +1,124 @@
+"""
+Site-wide middleware.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.5.1
+"""
+import time
+
+from django.conf import settings
+
+from . import querylog, routers
+from .metrics import COUNT_BUCKETS, SIZE_BUCKETS, metrics
+from .querylog import QueryRecorder
+
+
+class QueryCountMiddleware:
+    """
+    Reports how many database queries a request took in the X-Query-Count response
+    header, so that N+1 query regressions in the APIs can be spotted from the browser
+    or from the test client.
+
+    The JSON APIs build their whole body inside the view (see serializers.py), so the
+    count is exact for them, cards rendered on a fragment cache miss included.
+
+    Enabled by settings.QUERY_COUNT_HEADER.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.QUERY_COUNT_HEADER:
+            return self.get_response(request)
+
+        recorder = QueryRecorder()
+        response = self.get_response(request)
+        response['X-Query-Count'] = len(recorder.stop())
+        return response
+
+
+class RequestMetricsMiddleware:
+    """
+    Records the latency, database queries (count and time), response size and status of
+    every request into the metrics registry (see metrics.py), labelled by the name of the
+    URL pattern, so that slow views show up on the /metrics endpoint.
+
+    Streamed responses (only files served in development) are recorded when they're
+    returned, with their Content-Length as the size.
+
+    Enabled by settings.REQUEST_METRICS; it should come first in settings.MIDDLEWARE, so
+    that the time spent in the other middleware is counted too.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.REQUEST_METRICS:
+            return self.get_response(request)
+
+        start = time.perf_counter()
+        recorder = QueryRecorder()
+        response = self.get_response(request)
+        queries = recorder.stop()
+
+        # the URL pattern rather than the path, so that the number of label values stays bounded
+        view = request.resolver_match.view_name if request.resolver_match is not None else 'unmatched'
+        metrics.inc('http_requests_total', view=view, method=request.method, status=response.status_code)
+
+        size = int(response.get('Content-Length', 0)) if response.streaming else len(response.content)
+        self._record(request.method, view, time.perf_counter() - start, queries, size)
+        return response
+
+    @staticmethod
+    def _record(method, view, duration, queries, size):
+        metrics.observe('http_request_duration_seconds', duration, view=view, method=method)
+        metrics.observe('http_request_db_queries', len(queries), buckets=COUNT_BUCKETS, view=view)
+        metrics.observe('http_request_db_seconds', sum(query['time'] for query in queries), view=view)
+        metrics.observe('http_response_size_bytes', size, buckets=SIZE_BUCKETS, view=view)
+
+
+class SlowQueryMiddleware:
+    """
+    Attributes the queries of each request to its view (the name of its URL pattern) in
+    the slow query log; see querylog.py.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            return self.get_response(request)
+        finally:
+            querylog.set_view(None)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        querylog.set_view(request.resolver_match.view_name)
+
+
+class PrimaryStickinessMiddleware:
+    """
+    Keeps the reads of a browser on the primary database for settings.REPLICA_STICKY_SECONDS
+    after it wrote to the database, through a cookie holding the time until which they stick,
+    so that its users see their own writes even if the replicas lag behind; see routers.py.
+
+    It should come before any middleware that reads or writes the database.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            sticky_until = float(request.COOKIES.get(settings.REPLICA_STICKY_COOKIE, 0))
+        except ValueError:
+            sticky_until = 0
+        routers.begin_request(pinned=sticky_until > time.time())
+
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = routers.end_request()
+
+        if wrote and settings.DATABASE_REPLICAS:
+            response.set_cookie(settings.REPLICA_STICKY_COOKIE, str(time.time() + settings.REPLICA_STICKY_SECONDS),
+                                max_age=settings.REPLICA_STICKY_SECONDS, httponly=True)
+        return response
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 17:42
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_timelines(apps, schema_editor):
+    """
+    Build the home timelines for the existing follow relations, so that the
+    following view isn't empty right after the upgrade.
+    """
+    UserExtended = apps.get_model('global_resources', 'UserExtended')
+    Message = apps.get_model('global_resources', 'Message')
+    TimelineEntry = apps.get_model('global_resources', 'TimelineEntry')
+
+    for user_ext in UserExtended.objects.all():
+        entries = []
+        for author_id in user_ext.following.values_list('id', flat=True):
+            messages = Message.objects.filter(user_id=author_id)
+            entries.extend(TimelineEntry(owner_id=user_ext.user_id, message_id=msg_id, date=date)
+                           for msg_id, date in messages.values_list('id', 'date'))
+        TimelineEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('global_resources', '0002_message_paging_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimelineEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField()),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline_entries', to='global_resources.Message')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='timelineentry',
+            index=models.Index(fields=['owner', 'date', 'message'], name='tl_owner_date_msg_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='timelineentry',
+            unique_together=set([('owner', 'message')]),
+        ),
+        migrations.RunPython(build_timelines, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def count_existing(apps, schema_editor):
+    """
+    Fill in the new counters for the existing rows.
+    """
+    from global_resources.counters import reconcile
+    reconcile(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('global_resources', '0003_timelineentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userextended',
+            name='follower_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userextended',
+            name='following_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userextended',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_existing, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 17:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('global_resources', '0005_comment_message_date_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userextended',
+            name='avatar_hash',
+            field=models.CharField(blank=True, default='', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='userextended',
+            name='avatar_webp',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+
+def backfill_timelines(apps, schema_editor):
+    """
+    The home timelines used to be built from the latest 100 messages of each followed user
+    only; copy the rest of their messages in, as TimelineEntry.backfill() does now.
+    """
+    UserExtended = apps.get_model('global_resources', 'UserExtended')
+    Message = apps.get_model('global_resources', 'Message')
+    TimelineEntry = apps.get_model('global_resources', 'TimelineEntry')
+
+    for user_ext in UserExtended.objects.all():
+        # authors over the fan-out limit are merged on read
+        author_ids = list(user_ext.following.filter(ext__follower_count__lte=settings.TIMELINE_FANOUT_LIMIT)
+                          .values_list('id', flat=True))
+        missing = Message.objects.filter(user_id__in=author_ids) \
+            .exclude(id__in=TimelineEntry.objects.filter(owner_id=user_ext.user_id).values('message_id')) \
+            .values_list('id', 'date')
+        TimelineEntry.objects.bulk_create([TimelineEntry(owner_id=user_ext.user_id, message_id=msg_id, date=date)
+                                           for msg_id, date in missing.iterator()], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('global_resources', '0008_requestprofile'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_timelines, migrations.RunPython.noop),
+    ]
@@ -8,21 +8,42 @@ editing the "INSTALLED_APPS" setting.
 Remember to run <code>manage.py migrate</code> every time this file is modified.
 
 Author: Stephen Xie <[redacted]@cmu.edu>
-Version: 1.2.0
+Version: 1.6.1
 """
-import json
 import logging
 
-from channels import Group
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models import OuterRef, Prefetch, Q, Subquery, prefetch_related_objects
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import format_html
+
+from . import avatars, broadcast, follow_graph, global_window
+from .fragments import COMMENT_CARD, MESSAGE_CARD, get_cached_ids, get_card
+from .paging import DIRECTION_NEWER, DIRECTION_OLDER, keyset_page, page_cursors
 
 # for printing debugging info to console
 logger = logging.getLogger(__name__)
 
 
+def _update_fields_except(instance, excluded):
+    """
+    Names of the fields of a model instance to be written by save(), leaving out the given
+    ones. Denormalized counters are maintained with atomic UPDATEs (see signals.py), so a
+    plain save() of an existing row must not write back the (possibly stale) counts it
+    loaded earlier.
+
+    :param instance: a model instance
+    :param excluded: names of the fields to leave out
+    :return: a list of field names, for the update_fields argument of save()
+    """
+    return [field.name for field in instance._meta.concrete_fields
+            if not field.primary_key and field.name not in excluded]
+
+
 class Message(models.Model):
     """
     The message model.
@@ -40,6 +61,19 @@ class Message(models.Model):
     # an optional photo to be included in the message
     # photo = models.ImageField(upload_to='user-msg-photos', blank=True)
 
+    # denormalized number of comments on this message; see signals.py
+    comment_count = models.PositiveIntegerField(default=0)
+
+    # fields maintained by atomic UPDATEs only
+    COUNTER_FIELDS = ('comment_count',)
+
+    class Meta:
+        # composite indexes backing the keyset (cursor) pagination; see paging.py
+        indexes = [
+            models.Index(fields=['date', 'id'], name='msg_date_id_idx'),
+            models.Index(fields=['user', 'date', 'id'], name='msg_user_date_id_idx')
+        ]
+
     @property
     def html(self):
         """
@@ -47,8 +81,19 @@ class Message(models.Model):
         of the current message. To access it, simply treat this "method" as an
         attribute of the message (i.e. message.html).
 
+        The card is served from the fragment cache when possible; see fragments.py.
+
         :return: an HTML code representation of the current message for Django template
         """
+        return get_card(MESSAGE_CARD, self.id, self.render_html)
+
+    def render_html(self):
+        """
+        Render the bootstrap card HTML code of the current message, bypassing the
+        fragment cache.
+
+        :return: an HTML code representation of the current message
+        """
         # profile url of this user will be something like /profile/username
         profile_url = reverse('profile') + self.user.username
         return """
@@ -56,7 +101,7 @@ class Message(models.Model):
             <div class='card-body'>
                 <div class='row no-gutters align-items-start'>
                     <a href='{0}' class='col-auto'>
-                        <img class='avatar' src='{1}' alt='avatar'>
+                        {1}
                     </a>
         
                     <div class='col'>
@@ -100,28 +145,63 @@ class Message(models.Model):
                 </div>
             </div>
         </div>
-        """.strip().format(profile_url, self.user.ext.avatar.url, self.user.first_name, self.user.last_name,
+        """.strip().format(profile_url, self.user.ext.avatar_html('card'), self.user.first_name, self.user.last_name,
                            self.date.strftime('%H:%M %p - %d %b %Y'), self.message,
-                           '\n'.join([c.html for c in Comment.get_all_ranged(self)]))
+                           '\n'.join([c.html for c in self._get_card_comments()]))
         # note that the original curly braces used for Django template need to be escape like this: '{{' and '}}'
         # before python string formatter can be used
         # '%H:%M %p - %d %b %Y' example: 9:05 PM - 19 Oct 2017
         # Python strftime ref: http://strftime.org/
 
-    # override the save method to send real-time message updates to the global_stream group
+    def _get_card_comments(self):
+        """
+        Get the comments shown on the card of this message, using the ones batch-loaded
+        by load_cards() if there are.
+        """
+        if hasattr(self, 'card_comments'):
+            return self.card_comments
+        return Comment.get_all_ranged(self)
+
+    @staticmethod
+    def load_cards(messages, comments_range=20):
+        """
+        Batch-load everything needed to render the cards (i.e. message.html) of the
+        given messages: authors, their avatars, and the comments shown on each card
+        with their authors and avatars. This takes a constant number of queries no
+        matter how many messages or comments there are, instead of a few queries per
+        message and per comment when the cards are rendered one by one.
+
+        Messages whose cards are already in the fragment cache are skipped.
+
+        :param messages: a list of messages
+        :param comments_range: how many comments are shown on each card
+        :return: the list of messages
+        """
+        cached = get_cached_ids(MESSAGE_CARD, [message.id for message in messages])
+        missing = [message for message in messages if message.id not in cached]
+        if missing:
+            prefetch_related_objects(missing, 'user__ext',
+                                     Prefetch('cmts', queryset=Comment.get_card_window(comments_range),
+                                              to_attr='card_comments'))
+        return messages
+
+    # override the save method to send real-time message updates to the streams
     def save(self, *args, **kwargs):
+        is_new = self.pk is None
+        if not is_new and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = _update_fields_except(self, Message.COUNTER_FIELDS)
         super().save(*args, **kwargs)
 
-        # send the trade record to the group; all consumers (aka "listeners") to that group
-        # will be notified
-        # WebSocket text frame, with JSON content
-        Group('global_stream').send({
-            'text': json.dumps({
-                'id': self.id,
-                'author': self.user.username,
-                'html': self.html
-            })
-        })
+        if is_new:
+            # push the new message into the home timelines of the author's followers
+            TimelineEntry.fan_out(self)
+            # and into the cached window of the global stream, once it's committed
+            transaction.on_commit(lambda: global_window.add(self.id))
+
+        # queue the message to be broadcast to the global_stream group and the following streams
+        # once it's committed, so that the request doesn't wait for the rendering and sending, and
+        # nothing is sent for a transaction that is rolled back; see broadcast.py
+        transaction.on_commit(lambda: broadcast.enqueue(self.id))
 
     @staticmethod
     def get_all_ranged(mrange=20, offset=0, from_date='1970-01-01T00:00+00:00'):
@@ -165,10 +245,59 @@ class Message(models.Model):
         :param from_date:
         :return: a range of ordered messages
         """
-        # first get all followers
-        followers = user.ext.following.all()
-        # then search and sort
-        return Message.objects.filter(user__in=followers, date__gt=from_date).order_by('date')[offset:offset+mrange]
+        # read from the precomputed home timeline of this user, plus messages of the followed
+        # authors who are too popular to be fanned out on write (see TimelineEntry)
+        condition = Q(timeline_entries__owner=user)
+        fan_out_on_read = TimelineEntry.get_fan_out_on_read_authors(user)
+        if fan_out_on_read:
+            condition |= Q(user__in=fan_out_on_read)
+        return Message.objects.filter(condition, date__gt=from_date).distinct().order_by('date')[offset:offset+mrange]
+
+    @staticmethod
+    def get_all_paged(cursor=None, direction=DIRECTION_OLDER, mrange=20):
+        """
+        Get a page of messages from all the records in the database, sorted
+        from the newest to the oldest. Unlike get_all_ranged, the page is located
+        with a keyset cursor instead of an offset, so that every page costs the same.
+
+        :param cursor: cursor string returned along with a previous page, or None for the newest page
+        :param direction: 'older' to walk back in time from the cursor, 'newer' to walk forward
+        :param mrange: how many messages will be returned at most
+        :return: a tuple of (list of messages, next_cursor, prev_cursor); see paging.keyset_page
+        """
+        # most requests are for the newest pages, which are served from the cache
+        page = global_window.get_page(cursor, direction, mrange)
+        if page is not None:
+            return page
+        return keyset_page(Message.objects.all(), cursor, direction, mrange)
+
+    @staticmethod
+    def get_user_paged(user, cursor=None, direction=DIRECTION_OLDER, mrange=20):
+        """
+        Get a page of messages from all the records of the given user, sorted
+        from the newest to the oldest.
+
+        :param user: the given user
+        :param cursor: cursor string returned along with a previous page, or None for the newest page
+        :param direction: 'older' to walk back in time from the cursor, 'newer' to walk forward
+        :param mrange: how many messages will be returned at most
+        :return: a tuple of (list of messages, next_cursor, prev_cursor); see paging.keyset_page
+        """
+        return keyset_page(Message.objects.filter(user=user), cursor, direction, mrange)
+
+    @staticmethod
+    def get_followers_paged(user, cursor=None, direction=DIRECTION_OLDER, mrange=20):
+        """
+        Get a page of messages from all the records of users this current
+        user is following, sorted from the newest to the oldest.
+
+        :param user: user who the followers follow
+        :param cursor: cursor string returned along with a previous page, or None for the newest page
+        :param direction: 'older' to walk back in time from the cursor, 'newer' to walk forward
+        :param mrange: how many messages will be returned at most
+        :return: a tuple of (list of messages, next_cursor, prev_cursor); see paging.keyset_page
+        """
+        return TimelineEntry.get_page(user, cursor, direction, mrange)
 
 
 def user_avatar_dir(instance, filename):
@@ -195,6 +324,13 @@ class Comment(models.Model):
     date = models.DateTimeField(auto_now_add=True)
     content = models.CharField(max_length=42)
 
+    class Meta:
+        # comments are always fetched per message in chronological order; see
+        # get_all_ranged and get_card_window
+        indexes = [
+            models.Index(fields=['message', 'date', 'id'], name='cmt_msg_date_id_idx')
+        ]
+
     @property
     def html(self):
         """
@@ -202,15 +338,26 @@ class Comment(models.Model):
         of the current comment. To access it, simply treat this "method" as an
         attribute of the comment (i.e. comment.html).
 
+        The card is served from the fragment cache when possible; see fragments.py.
+
         :return: an HTML code representation of the current comment for Django template
         """
+        return get_card(COMMENT_CARD, self.id, self.render_html)
+
+    def render_html(self):
+        """
+        Render the bootstrap card HTML code of the current comment, bypassing the
+        fragment cache.
+
+        :return: an HTML code representation of the current comment
+        """
         # profile url of this user will be something like /profile/username
         profile_url = reverse('profile') + self.from_user.username
         return """
-        <div class='row no-gutters comment'>
+        <div class='row no-gutters comment' data-comment-id='{7}'>
             <div class='avatar-col'>
                 <a href='{0}' class='col-auto'>
-                    <img class='avatar' src='{1}' alt='avatar'>
+                    {1}
                 </a>
             </div>
             <div class='text-col'>
@@ -221,9 +368,17 @@ class Comment(models.Model):
                 <div class='row no-gutters'>{6}</div>
             </div>
         </div>
-        """.strip().format(profile_url, self.from_user.ext.avatar.url, self.from_user.first_name,
+        """.strip().format(profile_url, self.from_user.ext.avatar_html('comment'), self.from_user.first_name,
                            self.from_user.last_name, self.from_user.username,
-                           self.date.strftime('%H:%M %p - %d %b %Y'), self.content)
+                           self.date.strftime('%H:%M %p - %d %b %Y'), self.content, self.id)
+
+    # override the save method to send real-time comment updates to the comment streams
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        # queue the comment to be pushed to the sockets subscribed to its message once it's committed;
+        # see broadcast.py
+        transaction.on_commit(lambda: broadcast.enqueue_comment(self.id))
 
     @staticmethod
     def get_all_ranged(message, mrange=20, offset=0, from_date='1970-01-01T00:00+00:00'):
@@ -240,6 +395,39 @@ class Comment(models.Model):
         """
         return Comment.objects.filter(message=message, date__gt=from_date).order_by('date')[offset:offset + mrange]
 
+    @staticmethod
+    def load_cards(comments):
+        """
+        Batch-load the authors and avatars needed to render the cards (i.e. comment.html)
+        of the given comments, skipping the ones already in the fragment cache.
+
+        :param comments: a list of comments
+        :return: the list of comments
+        """
+        cached = get_cached_ids(COMMENT_CARD, [comment.id for comment in comments])
+        missing = [comment for comment in comments if comment.id not in cached]
+        if missing:
+            prefetch_related_objects(missing, 'from_user__ext')
+        return comments
+
+    @staticmethod
+    def get_card_window(mrange=20):
+        """
+        Get a queryset of the first few comments of each message, in chronological
+        order, along with their authors and avatars. The number of comments per
+        message is bounded in the database (rather than fetching every comment and
+        slicing them in Python), so that a popular message doesn't drag in thousands
+        of rows. Used for prefetching comments of several messages at once; see
+        Message.load_cards.
+
+        :param mrange: how many comments per message will be returned at most
+        :return: a queryset of comments
+        """
+        first_comments = Comment.objects.filter(message=OuterRef('message')).order_by('date', 'id').values('id')
+        return (Comment.objects.filter(id__in=Subquery(first_comments[:mrange]))
+                .select_related('from_user__ext')
+                .order_by('date', 'id'))
+
 
 class UserExtended(models.Model):
     """
@@ -273,9 +461,295 @@ class UserExtended(models.Model):
 
     # user avatar
     avatar = models.ImageField(upload_to=user_avatar_dir, default='defaults/default_avatar.png')
+    # content hash of the avatar, under which its thumbnails are stored (empty if they haven't
+    # been generated yet), and whether there're WebP thumbnails; see avatars.py
+    avatar_hash = models.CharField(max_length=avatars.HASH_LENGTH, blank=True, default='')
+    avatar_webp = models.BooleanField(default=False)
 
     # who this user is following
     following = models.ManyToManyField(
         User,
         related_name='followed_by'
     )
+
+    # denormalized counts of the messages this user has posted, the users following this user
+    # and the users this user is following; see signals.py, and the reconcile_counters command
+    # for fixing them up
+    message_count = models.PositiveIntegerField(default=0)
+    follower_count = models.PositiveIntegerField(default=0)
+    following_count = models.PositiveIntegerField(default=0)
+
+    # fields maintained by atomic UPDATEs only
+    COUNTER_FIELDS = ('message_count', 'follower_count', 'following_count')
+
+    def save(self, *args, **kwargs):
+        if self.avatar and not self.avatar._committed:
+            # a newly uploaded avatar: resize it once here, rather than sending the original down the stream
+            self.update_thumbnails(self.avatar)
+        elif self._state.adding and not self.avatar_hash and self.avatar.name == self._meta.get_field('avatar').default:
+            # a new user with the default avatar, whose thumbnails are shared by everyone
+            try:
+                self.avatar_hash, self.avatar_webp = avatars.default_thumbnails(self.avatar.name)
+            except IOError:
+                logger.warning('Cannot make thumbnails of the default avatar', exc_info=True)
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = _update_fields_except(self, UserExtended.COUNTER_FIELDS)
+        super().save(*args, **kwargs)
+
+    def update_thumbnails(self, source):
+        """
+        Generate the thumbnails of the avatar (if they don't exist yet) and point to them.
+        Falls back to the original avatar if it can't be decoded.
+
+        :param source: a file object of the avatar image
+        """
+        try:
+            self.avatar_hash, self.avatar_webp = avatars.make_thumbnails(source)
+        except IOError:
+            logger.warning('Cannot make thumbnails of the avatar of user %s', self.user_id, exc_info=True)
+            self.avatar_hash, self.avatar_webp = '', False
+
+    def avatar_url(self, size_name, extension='jpg'):
+        """
+        Get the URL of a thumbnail of the avatar, or of the original avatar if the thumbnails
+        haven't been generated.
+
+        :param size_name: a key of settings.AVATAR_SIZES, e.g. 'card'
+        :param extension: 'jpg' or 'webp'
+        :return: the URL
+        """
+        if not self.avatar_hash:
+            return self.avatar.url
+        return avatars.thumbnail_url(self.avatar_hash, size_name, extension)
+
+    def avatar_html(self, size_name):
+        """
+        Get the HTML code of the avatar image in the given size, offering the WebP thumbnail
+        to the browsers that support it.
+
+        :param size_name: a key of settings.AVATAR_SIZES, e.g. 'card'
+        :return: the HTML code
+        """
+        img = format_html("<img class='avatar' src='{0}' alt='avatar'>", self.avatar_url(size_name))
+        if not (self.avatar_hash and self.avatar_webp):
+            return img
+        return format_html("<picture><source srcset='{0}' type='image/webp'>{1}</picture>",
+                           self.avatar_url(size_name, 'webp'), img)
+
+    @property
+    def profile_avatar_html(self):
+        """
+        The avatar on the profile page; see avatar_html.
+        """
+        return self.avatar_html('profile')
+
+
+class TimelineEntry(models.Model):
+    """
+    Materialized home timeline (messages from all the users one is following) of a user.
+
+    Instead of searching through the messages of every followed user on each request
+    (fan-out on read), a reference to each new message is copied into the timeline of
+    every follower of its author when the message is posted (fan-out on write), so that
+    reading the following view becomes a single index range scan.
+
+    Authors with more followers than settings.TIMELINE_FANOUT_LIMIT are not fanned out,
+    as a single post from them would write too many rows; their messages are merged into
+    the timeline on read instead.
+    """
+    # the user to whom this timeline belongs
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='timeline')
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='timeline_entries')
+    # a copy of message.date, so that the timeline can be sorted without joining the message table
+    date = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('owner', 'message')
+        indexes = [
+            models.Index(fields=['owner', 'date', 'message'], name='tl_owner_date_msg_idx')
+        ]
+
+    @staticmethod
+    def fan_out(message):
+        """
+        Copy a newly posted message into the timelines of its author's followers.
+
+        :param message: the new message
+        """
+        if UserExtended.objects.filter(user_id=message.user_id,
+                                       follower_count__gt=settings.TIMELINE_FANOUT_LIMIT).exists():
+            return  # too popular: this message will be merged into the timelines on read
+
+        # followed_by holds the UserExtended objects of the followers, whose primary key is the user id
+        follower_ids = list(message.user.followed_by.values_list('user_id', flat=True))
+
+        TimelineEntry.objects.bulk_create([
+            TimelineEntry(owner_id=follower_id, message=message, date=message.date) for follower_id in follower_ids
+        ])
+
+    @staticmethod
+    def backfill(owner_id, author_ids):
+        """
+        Copy the messages of newly followed authors into a user's timeline, so that the
+        following view shows their whole history (as the fan-out on read used to), not just
+        what they post from now on.
+
+        :param owner_id: id of the user who started following the authors
+        :param author_ids: ids of the newly followed users
+        """
+        # authors over the fan-out limit are merged on read, there's nothing to backfill
+        author_ids = list(UserExtended.objects.filter(user_id__in=author_ids,
+                                                      follower_count__lte=settings.TIMELINE_FANOUT_LIMIT)
+                          .values_list('user_id', flat=True))
+        if not author_ids:
+            return
+
+        # skip messages already in the timeline (e.g. the user followed, unfollowed and followed again quickly,
+        # or the author was fanned out on write before)
+        missing = Message.objects.filter(user_id__in=author_ids) \
+            .exclude(id__in=TimelineEntry.objects.filter(owner_id=owner_id).values('message_id')) \
+            .values_list('id', 'date')
+        batch = []
+        for msg_id, date in missing.iterator():
+            batch.append(TimelineEntry(owner_id=owner_id, message_id=msg_id, date=date))
+            if len(batch) >= settings.TIMELINE_BACKFILL_BATCH:
+                TimelineEntry.objects.bulk_create(batch)
+                batch = []
+        TimelineEntry.objects.bulk_create(batch)
+
+    @staticmethod
+    def backfill_followers(author_id, excluded=()):
+        """
+        Copy the messages of an author who has just dropped back under the fan-out limit into
+        the timelines of their followers: the messages posted while the author was over it were
+        only merged on read, and would otherwise be missing from the timelines.
+
+        :param author_id: id of the author
+        :param excluded: ids of followers to skip, e.g. those who are unfollowing the author
+        """
+        follower_ids = UserExtended.objects.filter(following=author_id).exclude(user_id__in=list(excluded)) \
+            .values_list('user_id', flat=True)
+        for follower_id in list(follower_ids):
+            TimelineEntry.backfill(follower_id, [author_id])
+
+    @staticmethod
+    def get_fan_out_on_read_authors(user):
+        """
+        Get the followed users whose messages are not fanned out into the timeline of the given user.
+
+        :param user: owner of the timeline
+        :return: a list of user ids
+        """
+        # both from the cache of the follow graph, rather than a join on every poll
+        return sorted(follow_graph.following_ids(user.id) & follow_graph.fan_out_on_read_ids())
+
+    @staticmethod
+    def get_page(user, cursor=None, direction=DIRECTION_OLDER, mrange=20):
+        """
+        Get a page of messages from the home timeline of the given user, sorted from
+        the newest to the oldest.
+
+        :param user: owner of the timeline
+        :param cursor: cursor string returned along with a previous page, or None for the newest page
+        :param direction: 'older' to walk back in time from the cursor, 'newer' to walk forward
+        :param mrange: how many messages will be returned at most
+        :return: a tuple of (list of messages, next_cursor, prev_cursor); see paging.keyset_page
+        """
+        # timeline entries are paged by (date, message id), so that the cursors are interchangeable with
+        # the ones of plain message pages
+        entries, next_cursor, prev_cursor = keyset_page(
+            TimelineEntry.objects.filter(owner=user).select_related('message'),
+            cursor, direction, mrange, id_field='message_id')
+        messages = [entry.message for entry in entries]
+
+        fan_out_on_read = TimelineEntry.get_fan_out_on_read_authors(user)
+        if not fan_out_on_read:
+            return messages, next_cursor, prev_cursor
+
+        # merge in messages from authors who are too popular to be fanned out on write
+        merged, merged_next_cursor, _ = keyset_page(Message.objects.filter(user__in=fan_out_on_read),
+                                                    cursor, direction, mrange)
+        has_more = next_cursor is not None or merged_next_cursor is not None
+        # drop duplicates: an author may have crossed the fan-out limit after some messages were fanned out
+        merged = {message.id: message for message in messages + merged}
+        messages = sorted(merged.values(), key=lambda m: (m.date, m.id), reverse=True)
+        if direction == DIRECTION_NEWER and cursor:
+            # keep the messages closest to the cursor; the rest will be picked up by the next poll
+            messages = messages[-mrange:]
+        else:
+            has_more = has_more or len(messages) > mrange
+            messages = messages[:mrange]
+
+        return (messages,) + page_cursors(messages, has_more, cursor)
+
+
+class OutgoingEmail(models.Model):
+    """
+    An email waiting in the outbox to be sent by the outbox worker; see outbox.py.
+
+    Emails are written to the outbox within the transaction of the request that sends
+    them, so that the request doesn't wait for the mail server, and an email is only
+    sent if the transaction commits.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'  # given up after settings.OUTBOX_MAX_ATTEMPTS attempts
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed')
+    )
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    # an optional HTML alternative of the body
+    html_body = models.TextField(blank=True, default='')
+    from_email = models.CharField(max_length=254)
+    # recipient addresses, one per line
+    recipients = models.TextField()
+
+    status = models.CharField(max_length=7, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    # number of failed attempts so far
+    attempts = models.PositiveIntegerField(default=0)
+    # the email is not tried again before this time; also pushed forward while a worker is sending it
+    next_attempt = models.DateTimeField(default=timezone.now)
+    # the worker that is currently sending the email
+    claim = models.CharField(max_length=32, blank=True, default='')
+    last_error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # the worker looks for pending emails that are due
+            models.Index(fields=['status', 'next_attempt'], name='outbox_status_next_idx')
+        ]
+
+    def __str__(self):
+        return '{0} -> {1} ({2})'.format(self.subject, self.recipients.replace('\n', ', '), self.status)
+
+
+class RequestProfile(models.Model):
+    """
+    A profile of a single request or consumer call, taken on demand by a staff user; see
+    profiling.py.
+    """
+    # the request (method and path) or the consumer (name and channel) that was profiled
+    label = models.CharField(max_length=255)
+    # the staff user who asked for it (None for consumer calls)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    # wall time of the profiled call, in seconds
+    duration = models.FloatField()
+    query_count = models.PositiveIntegerField()
+    # total time of the database queries, in seconds
+    query_time = models.FloatField()
+    # cProfile stats in the format of pstats.Stats.dump_stats() (marshalled), for snakeviz etc.
+    stats = models.BinaryField()
+    # the top functions by cumulative time, as printed by pstats
+    report = models.TextField()
+    # the SQL executed, as a JSON list of {"sql", "time"}
+    queries = models.TextField()
+
+    def __str__(self):
+        return '{0} ({1:.3f}s, {2} queries)'.format(self.label, self.duration, self.query_count)
@@ -0,0 +1,204 @@
+"""
+A durable outbox for outgoing emails.
+
+Sending an email used to happen right inside the request (and its database transaction),
+so a slow mail server held the transaction open and stalled sign-ups. Now queue_mail()
+only writes the email into the outbox table (OutgoingEmail) within the transaction of the
+request, and pokes the outbox worker once the transaction commits. The worker sends the
+emails that are due in batches over a single SMTP connection.
+
+The worker is the `mailer` process of the Procfile, i.e. `python manage.py send_outbox
+--loop`, which wakes up on the pokes and also checks the outbox every few seconds. It runs
+apart from the `runworker` process serving the pages, so that a slow mail server doesn't
+stall page requests; in development, run it next to `runworker` (or run `send_outbox`
+without --loop now and then).
+
+Emails that fail to send are tried again later, with an exponential backoff starting from
+settings.OUTBOX_RETRY_DELAY seconds, up to settings.OUTBOX_MAX_ATTEMPTS attempts; the
+`mailer` picks them up when they're due.
+
+Several workers can run at the same time: each batch is claimed by pushing its next
+attempt time forward by settings.OUTBOX_LEASE seconds, which hides it from the others
+until it has been sent, or the worker sending it has died. Emails are therefore sent at
+least once, and in rare cases (a worker dying mid-batch) twice.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.2.0
+"""
+import logging
+import smtplib
+import uuid
+from datetime import timedelta
+
+from channels import Channel
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .metrics import metrics
+from .models import OutgoingEmail
+
+
+# for printing debugging info to console
+logger = logging.getLogger(__name__)
+
+# name of the channel the outbox worker is poked on
+OUTBOX_CHANNEL = 'grumblr.outbox'
+
+
+def queue_mail(subject, message, from_email, recipient_list, html_message=None):
+    """
+    Queue an email to be sent by the outbox worker; takes the same arguments as
+    django.core.mail.send_mail. Call it within the transaction whose commit should
+    send the email.
+
+    :return: the OutgoingEmail
+    """
+    email = OutgoingEmail.objects.create(subject=subject, body=message, html_body=html_message or '',
+                                         from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+                                         recipients='\n'.join(recipient_list))
+    transaction.on_commit(poke)
+    return email
+
+
+def poke():
+    """
+    Wake up the outbox worker. If the channel is full the worker is busy (or down),
+    and will get to the email anyway.
+    """
+    channel = Channel(OUTBOX_CHANNEL)
+    try:
+        channel.send({})
+    except channel.channel_layer.ChannelFull:
+        pass
+
+
+def _claim(batch_size):
+    """
+    Claim a batch of due emails for this worker.
+
+    :return: a list of OutgoingEmail
+    """
+    now = timezone.now()
+    due = list(OutgoingEmail.objects.filter(status=OutgoingEmail.STATUS_PENDING, next_attempt__lte=now)
+               .order_by('next_attempt', 'id').values_list('id', flat=True)[:batch_size])
+    if not due:
+        return []
+
+    claim = uuid.uuid4().hex
+    # the next_attempt condition makes the claim atomic: rows claimed by another worker in the
+    # meantime have been pushed into the future
+    OutgoingEmail.objects.filter(id__in=due, status=OutgoingEmail.STATUS_PENDING, next_attempt__lte=now) \
+        .update(claim=claim, next_attempt=now + timedelta(seconds=settings.OUTBOX_LEASE))
+    return list(OutgoingEmail.objects.filter(claim=claim).order_by('id'))
+
+
+def _to_message(email, connection):
+    message = EmailMultiAlternatives(subject=email.subject, body=email.body, from_email=email.from_email,
+                                     to=email.recipients.split('\n'), connection=connection)
+    if email.html_body:
+        message.attach_alternative(email.html_body, 'text/html')
+    return message
+
+
+def _send(message, connection):
+    """
+    Send a message over the connection, reconnecting once if the server has hung up
+    (e.g. it timed out an idle persistent connection).
+    """
+    try:
+        connection.send_messages([message])
+    except smtplib.SMTPServerDisconnected:
+        connection.close()
+        connection.open()
+        connection.send_messages([message])
+
+
+def _backoff(attempts):
+    # seconds to wait before the next attempt, after the given number of failed attempts
+    return settings.OUTBOX_RETRY_DELAY * 2 ** (attempts - 1)
+
+
+def _is_unreachable(error):
+    """
+    Tell whether a sending error means the mail server can't be reached at all (as opposed
+    to rejecting this particular email, e.g. for a bad recipient).
+    """
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    # other SMTP errors are replies from the server; socket errors are OSErrors too
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def _release(emails):
+    """
+    Put claimed emails back without counting an attempt, e.g. when the mail server can't be
+    reached at all; they're tried again after settings.OUTBOX_RETRY_DELAY seconds.
+    """
+    OutgoingEmail.objects.filter(id__in=[email.id for email in emails]) \
+        .update(claim='', next_attempt=timezone.now() + timedelta(seconds=settings.OUTBOX_RETRY_DELAY))
+
+
+def _record_failure(email, error):
+    email.attempts += 1
+    email.last_error = '{0}: {1}'.format(type(error).__name__, error)
+    email.claim = ''
+    if email.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+        email.status = OutgoingEmail.STATUS_FAILED
+        logger.error('Giving up on email %s after %d attempts: %s', email.id, email.attempts, email.last_error)
+    else:
+        email.next_attempt = timezone.now() + timedelta(seconds=_backoff(email.attempts))
+    email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt', 'claim'])
+    metrics.inc('outbox_failures_total')
+
+
+def send_pending(connection=None, batch_size=None):
+    """
+    Send the emails in the outbox that are due, one batch after another, until there are
+    no more (or the mail server can't be reached).
+
+    :param connection: an email backend connection to send with (kept open for reuse);
+                       a new one is opened and closed if None
+    :param batch_size: number of emails claimed at a time; settings.OUTBOX_BATCH_SIZE by default
+    :return: a tuple of (number of emails sent, number of failed attempts)
+    """
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    own_connection = connection is None
+    if own_connection:
+        connection = get_connection(fail_silently=False)
+
+    sent = failed = 0
+    try:
+        while True:
+            batch = _claim(batch_size)
+            if not batch:
+                break
+
+            for index, email in enumerate(batch):
+                try:
+                    # a no-op if the connection is already open
+                    connection.open()
+                    _send(_to_message(email, connection), connection)
+                except Exception as e:
+                    # whatever it is, it mustn't take the rest of the batch down with it
+                    _record_failure(email, e)
+                    failed += 1
+                    if _is_unreachable(e):
+                        # the rest of the batch would fail the same way
+                        logger.warning('Cannot reach the mail server: %s', e)
+                        _release(batch[index + 1:])
+                        connection.close()
+                        return sent, failed
+                else:
+                    email.status = OutgoingEmail.STATUS_SENT
+                    email.sent = timezone.now()
+                    email.claim = ''
+                    email.save(update_fields=['status', 'sent', 'claim'])
+                    metrics.inc('outbox_sent_total')
+                    sent += 1
+    finally:
+        if own_connection:
+            connection.close()
+
+    return sent, failed
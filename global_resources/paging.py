@@ -0,0 +1,169 @@
+"""
+Keyset (cursor) pagination helpers for the backend APIs.
+
+Instead of slicing an ordered queryset with OFFSET (which makes the database walk
+through every skipped row, so page N costs N times as much as page 1), each page
+remembers the (date, id) pair of its first and last row in an opaque cursor. The
+next page is then fetched with a plain range condition on that pair, which is
+answered directly from the composite (date, id) indexes on the paged models.
+
+Pages are always returned newest first:
+- direction 'older' walks back in time from the cursor (scrolling down the stream);
+- direction 'newer' walks forward in time from the cursor (polling for updates).
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.1.1
+"""
+import base64
+import binascii
+from datetime import datetime, timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+
+DIRECTION_OLDER = 'older'
+DIRECTION_NEWER = 'newer'
+
+# the UNIX epoch; cursors store dates as microseconds since this moment so that
+# they round-trip exactly (no float or string formatting precision loss)
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# ids in cursors must fit in a 64-bit database integer
+_MAX_ID = 2 ** 63 - 1
+
+
+class InvalidCursor(ValueError):
+    """
+    Raised when a cursor string sent in by the client cannot be decoded.
+    """
+    pass
+
+
+def _check_id(pk):
+    # a made-up id out of range fails in the database driver rather than matching nothing
+    if not 0 <= pk <= _MAX_ID:
+        raise ValueError('Id out of range: {0}'.format(pk))
+    return pk
+
+
+def encode_cursor(date, pk):
+    """
+    Encode a (date, id) pair into an opaque, URL-safe cursor string.
+
+    :param date: an aware datetime object
+    :param pk: primary key of the row
+    :return: the cursor string
+    """
+    delta = date - _EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    raw = '{0}.{1}'.format(micros, pk).encode('ascii')
+    # padding is stripped so that the cursor can be used in URLs as-is
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor string produced by encode_cursor().
+
+    :param cursor: the cursor string
+    :return: a (date, id) tuple
+    :raise InvalidCursor: if the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')
+        micros, pk = raw.split('.')
+        return _EPOCH + timedelta(microseconds=int(micros)), _check_id(int(pk))
+    except (binascii.Error, UnicodeError, ValueError, TypeError, OverflowError):
+        raise InvalidCursor('Invalid cursor: {0}'.format(cursor))
+
+
+def encode_id_cursor(pk):
+    """
+    Encode an id into an opaque, URL-safe cursor string, for lists ordered by id alone.
+
+    :param pk: the id
+    :return: the cursor string
+    """
+    return base64.urlsafe_b64encode(str(pk).encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_id_cursor(cursor):
+    """
+    Decode a cursor string produced by encode_id_cursor().
+
+    :param cursor: the cursor string
+    :return: the id
+    :raise InvalidCursor: if the cursor is malformed
+    """
+    try:
+        return _check_id(int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')))
+    except (binascii.Error, UnicodeError, ValueError, TypeError, OverflowError):
+        raise InvalidCursor('Invalid cursor: {0}'.format(cursor))
+
+
+def keyset_page(queryset, cursor=None, direction=DIRECTION_OLDER, size=20, date_field='date', id_field='id'):
+    """
+    Get one page of rows from the given queryset, newest first.
+
+    :param queryset: an unordered and unsliced queryset of the model to be paged
+    :param cursor: cursor string of the page boundary (excluded), or None to start from the newest row
+    :param direction: either DIRECTION_OLDER or DIRECTION_NEWER
+    :param size: maximum number of rows in the page
+    :param date_field: name of the date field the rows are ordered by
+    :param id_field: name of the unique id field used to break ties between equal dates
+    :return: a tuple of (list of rows, next_cursor, prev_cursor); next_cursor points to the
+             older side of the page and is None if there's nothing older, prev_cursor points to
+             the newer side of the page and is used to poll for newer rows
+    :raise InvalidCursor: if the cursor is malformed
+    """
+    if direction not in (DIRECTION_OLDER, DIRECTION_NEWER):
+        raise InvalidCursor('Invalid paging direction: {0}'.format(direction))
+
+    boundary = decode_cursor(cursor) if cursor else None
+
+    # without a cursor there's nothing to walk forward from: start from the newest row
+    if direction == DIRECTION_OLDER or boundary is None:
+        if boundary is not None:
+            date, pk = boundary
+            # (date, id) < (cursor date, cursor id); written out since not every
+            # database supports row value comparisons
+            queryset = queryset.filter(Q(**{date_field + '__lt': date}) |
+                                       Q(**{date_field: date, id_field + '__lt': pk}))
+        # fetch one extra row to find out whether there are more pages behind this one
+        rows = list(queryset.order_by('-' + date_field, '-' + id_field)[:size + 1])
+        has_more = len(rows) > size
+        rows = rows[:size]
+    else:
+        date, pk = boundary
+        queryset = queryset.filter(Q(**{date_field + '__gt': date}) |
+                                   Q(**{date_field: date, id_field + '__gt': pk}))
+        # take the rows closest to the cursor first, so that nothing is skipped if more than
+        # one page of new rows has arrived since the last poll
+        rows = list(queryset.order_by(date_field, id_field)[:size])
+        rows.reverse()
+        # walking forward from a cursor means there's at least the cursor row behind us
+        has_more = True
+
+    return (rows,) + page_cursors(rows, has_more, cursor, date_field, id_field)
+
+
+def page_cursors(rows, has_more, cursor=None, date_field='date', id_field='id'):
+    """
+    Build the cursors of a page of rows sorted newest first.
+
+    :param rows: rows in the page
+    :param has_more: whether there're more rows older than the last row in the page
+    :param cursor: cursor string the page was fetched with
+    :param date_field: name of the date field the rows are ordered by
+    :param id_field: name of the unique id field used to break ties between equal dates
+    :return: a tuple of (next_cursor, prev_cursor); see keyset_page
+    """
+    if rows:
+        next_cursor = encode_cursor(getattr(rows[-1], date_field), getattr(rows[-1], id_field)) if has_more else None
+        prev_cursor = encode_cursor(getattr(rows[0], date_field), getattr(rows[0], id_field))
+    else:
+        # nothing in this page: keep pointing at the same spot, so that polling can continue
+        next_cursor = cursor if has_more else None
+        prev_cursor = cursor
+
+    return next_cursor, prev_cursor
@@ -0,0 +1,187 @@
+"""
+On-demand profiling of requests and consumers, for staff users.
+
+A slow page in production often can't be reproduced locally, so a staff user can have a
+single request profiled where it's slow:
+
+- add `?_profile=1` to the URL (or send an `X-Profile: 1` header): the request runs under
+  cProfile with its SQL recorded (see ProfilingMiddleware), and the response carries the
+  X-Profile-Id of the stored profile
+- add `?_profile=consumers` (or `X-Profile: consumers`) to any URL instead: the next
+  settings.PROFILE_CONSUMER_CALLS calls of the Channels consumers (WebSocket connects,
+  comment subscriptions, broadcasts, ...), whichever process they land on, are profiled
+  the same way; see profiled_consumer. A process that has found the consumers unarmed
+  only looks again after ARMED_CHECK_INTERVAL seconds, so that the calls don't each cost a
+  cache lookup; the calls right after arming may therefore be missed
+
+Profiles are stored as RequestProfile rows (the newest settings.PROFILE_KEEP are kept)
+and can be downloaded by staff users from /profiles/ (see views.py): <id>.prof holds the
+raw cProfile stats (for pstats, snakeviz, ...), <id>.txt the top functions and the SQL.
+
+cProfile is a deterministic profiler, which slows the profiled code down (calls with many
+small functions the most), so compare the relative costs in a profile rather than its
+absolute times.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.1.0
+"""
+import cProfile
+import functools
+import io
+import json
+import logging
+import marshal
+import pstats
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import RequestProfile
+from .querylog import QueryRecorder
+
+
+# for printing debugging info to console
+logger = logging.getLogger(__name__)
+
+# the query parameter / header (as found in request.META) that switches profiling on
+PROFILE_PARAMETER = '_profile'
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+# the value that arms the consumers rather than profiling the request itself
+CONSUMERS = 'consumers'
+# cache key of the number of consumer calls left to profile
+ARMED_KEY = 'profiling-consumer-calls'
+# how long (in seconds) the consumers stay armed if they're not called
+ARMED_TIMEOUT = 60 * 10
+# how long (in seconds) a process that found the consumers unarmed waits before looking again
+ARMED_CHECK_INTERVAL = 1
+# number of functions listed in the text report
+REPORT_LINES = 60
+
+# until when (time.monotonic()) this process takes the consumers for unarmed without asking the cache
+_unarmed_until = 0.0
+
+
+def run(label, user, func, *args, **kwargs):
+    """
+    Call a function under the profiler, and store its profile.
+
+    :param label: what is being profiled, e.g. the method and path of a request
+    :param user: the user who asked for it, or None
+    :return: a tuple of (return value of the function, the stored RequestProfile); an
+             exception raised by the function is raised again after the profile is stored
+    """
+    profiler = cProfile.Profile()
+    recorder = QueryRecorder(sql=True)
+    start = time.perf_counter()
+    result = None
+    try:
+        result = profiler.runcall(func, *args, **kwargs)
+    finally:
+        duration = time.perf_counter() - start
+        queries = recorder.stop()
+        profile = _store(label, user, profiler, duration, queries)
+    return result, profile
+
+
+def _store(label, user, profiler, duration, queries):
+    profiler.create_stats()
+    # before pstats takes the stats over (and empties them on the profiler)
+    stats = marshal.dumps(profiler.stats)
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(REPORT_LINES)
+
+    profile = RequestProfile.objects.create(
+        label=label[:255], user=user if user is not None and user.is_authenticated else None, duration=duration,
+        query_count=len(queries), query_time=sum(float(query['time']) for query in queries),
+        stats=stats, report=report.getvalue(),
+        queries=json.dumps([{'sql': query['sql'], 'time': float(query['time'])} for query in queries]))
+
+    # keep the newest ones only
+    stale = RequestProfile.objects.order_by('-id').values_list('id', flat=True)[settings.PROFILE_KEEP:]
+    RequestProfile.objects.filter(id__in=list(stale)).delete()
+
+    logger.info('Profiled %s: %.3fs, %d queries; profile %d', label, duration, len(queries), profile.id)
+    return profile
+
+
+def requested(request):
+    """
+    :return: what a request asks to profile: '1' (the request), CONSUMERS, or None
+    """
+    what = request.GET.get(PROFILE_PARAMETER) or request.META.get(PROFILE_HEADER)
+    # anything else (e.g. ?_profile=0) isn't a request for a profile
+    return what if what in ('1', CONSUMERS) else None
+
+
+def arm_consumers():
+    """
+    Have the next settings.PROFILE_CONSUMER_CALLS consumer calls profiled.
+    """
+    global _unarmed_until
+    cache.set(ARMED_KEY, settings.PROFILE_CONSUMER_CALLS, ARMED_TIMEOUT)
+    # this process sees it right away; the others within ARMED_CHECK_INTERVAL
+    _unarmed_until = 0.0
+
+
+def _take_armed_call():
+    # whether the current consumer call should be profiled; counts it off if so
+    global _unarmed_until
+    now = time.monotonic()
+    if now < _unarmed_until:
+        return False
+    try:
+        # counted below zero by the calls that used up the last ones
+        if (cache.get(ARMED_KEY) or 0) > 0 and cache.decr(ARMED_KEY) >= 0:
+            return True
+    except ValueError:
+        pass  # expired in the meantime
+    _unarmed_until = now + ARMED_CHECK_INTERVAL
+    return False
+
+
+def profiled_consumer(consumer):
+    """
+    Decorator for Channels consumers: profiles calls of the consumer while the consumers
+    are armed (see arm_consumers). It should be the outermost decorator, so that loading
+    the channel session etc. is profiled too.
+    """
+    @functools.wraps(consumer)
+    def wrapper(message, *args, **kwargs):
+        if not _take_armed_call():
+            return consumer(message, *args, **kwargs)
+        label = '{0} ({1})'.format(consumer.__name__, message.channel.name)
+        return run(label, None, consumer, message, *args, **kwargs)[0]
+    return wrapper
+
+
+class ProfilingMiddleware:
+    """
+    Profiles the requests of staff users that ask for it; see the module docstring.
+
+    It must come after AuthenticationMiddleware in settings.MIDDLEWARE.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        what = requested(request)
+        # checked in this order, so that the user is only loaded for requests asking for a profile
+        if what is None or not (request.user.is_authenticated and request.user.is_staff):
+            return self.get_response(request)
+
+        if what == CONSUMERS:
+            arm_consumers()
+            return self.get_response(request)
+
+        response, profile = run('{0} {1}'.format(request.method, request.get_full_path()), request.user,
+                                self._get_complete_response, request)
+        response['X-Profile-Id'] = profile.id
+        return response
+
+    def _get_complete_response(self, request):
+        response = self.get_response(request)
+        if response.streaming:
+            # streamed responses are rendered while being sent; render it here, within the profile
+            response.streaming_content = [b''.join(response.streaming_content)]
+        return response
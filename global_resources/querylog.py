@@ -0,0 +1,308 @@
+"""
+Query timing, and the slow query log.
+
+Every query is timed by TimedCursorWrapper, a thin cursor wrapper installed on every
+database connection (see install_cursor_wrapper). Unlike Django's debug cursor, it doesn't
+keep the queries anywhere: it hands their timings to the QueryRecorders active in the
+current thread (the query count / metrics middleware, the profiler), and only formats the
+SQL of a query when one of them asks for it, or when the query is slow.
+
+Every query slower than settings.SLOW_QUERY_MS milliseconds is written to a rotating
+log file (settings.SLOW_QUERY_LOG) as one JSON object per line, along with:
+
+- the view of the request that ran it (its URL pattern name), set by SlowQueryMiddleware
+- the database it ran on (the primary or a replica, see routers.py)
+- the line in our code it came from (the innermost frame of the project, e.g. a queryset
+  evaluated in a view), and the entry point (the outermost one, e.g. the view or consumer)
+- the query plan (EXPLAIN) of SELECT queries on the same database, once per distinct
+  query shape
+
+Slow queries are reported to the `global_resources.slow_queries` logger, which the logging
+configuration hands to SlowQueryHandler.
+
+Use `python manage.py slow_query_report` to list the top offenders.
+
+Note: this module is loaded by the logging configuration, before the apps are ready; it
+mustn't import any models.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.1.0
+"""
+import json
+import linecache
+import logging
+import logging.handlers
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.backends.utils import CursorDebugWrapper, CursorWrapper
+from django.utils import timezone
+
+
+# the view / explaining state and the active QueryRecorders of the current thread
+_local = threading.local()
+
+# slow queries are reported here; see SlowQueryHandler
+slow_query_logger = logging.getLogger('global_resources.slow_queries')
+
+# query plans by (database alias, query shape) (see fingerprint), so that each shape is only
+# explained once per database
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+# maximum number of query plans kept
+PLAN_CACHE_SIZE = 500
+# longest SQL written to the log, in characters
+MAX_SQL_LENGTH = 10000
+
+# literals in SQL, replaced by placeholders to get the shape of a query
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+# paths of our own code, and of code that isn't ours even if it's in the project directory
+_PROJECT_DIR = os.path.abspath(settings.BASE_DIR) + os.sep
+_FOREIGN_DIRS = ('site-packages', 'dist-packages', os.sep + 'venv', os.sep + '.venv')
+# our own code that only wraps the views / consumers (middleware, decorators, profiling), or runs them
+_WRAPPER_FILES = {os.path.join(_PROJECT_DIR, name) for name in (
+    os.path.join('global_resources', 'middleware.py'), os.path.join('global_resources', 'profiling.py'),
+    os.path.join('global_resources', 'ratelimit.py'), os.path.join('global_resources', 'routers.py'),
+    os.path.join('global_resources', 'querylog.py'), 'manage.py')}
+
+
+def fingerprint(sql):
+    """
+    Get the shape of a query: its SQL with the literals replaced by placeholders, so that
+    the same query with different parameters gives the same string.
+    """
+    sql = _STRING_LITERAL.sub('?', sql)
+    sql = _NUMBER_LITERAL.sub('?', sql)
+    sql = _PLACEHOLDER_LIST.sub('(...)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+def set_view(view_name):
+    """
+    Set (or clear, with None) the view the queries of the current thread are attributed to.
+    """
+    _local.view = view_name
+
+
+def _recorders():
+    recorders = getattr(_local, 'recorders', None)
+    if recorders is None:
+        recorders = _local.recorders = []
+    return recorders
+
+
+class QueryRecorder:
+    """
+    Records the database queries run in the current thread, on any database, from its
+    creation until stop() is called. Recorders may overlap (e.g. the metrics middleware
+    and a profiled request).
+    """
+    def __init__(self, sql=False):
+        """
+        :param sql: whether to record the SQL of the queries too; formatting it costs
+                    a little for every query
+        """
+        self.sql = sql
+        self.queries = []
+        _recorders().append(self)
+
+    def add(self, alias, sql, duration):
+        self.queries.append({'alias': alias, 'sql': sql, 'time': duration})
+
+    def stop(self):
+        """
+        Stop recording; calling it again does nothing.
+
+        :return: a list of the recorded queries, as dictionaries of 'alias', 'sql' (None if
+                 not asked for) and 'time' (in seconds)
+        """
+        recorders = _recorders()
+        if self in recorders:
+            recorders.remove(self)
+        return self.queries
+
+
+def _observe(wrapper, sql, params, duration, many=False):
+    # hand a finished query over to the recorders of the current thread and the slow query log
+    recorders = _recorders()
+    slow = settings.SLOW_QUERY_MS is not None and duration * 1000 >= settings.SLOW_QUERY_MS \
+        and not getattr(_local, 'explaining', False)
+    if not recorders and not slow:
+        return
+
+    text = None
+    if slow or any(recorder.sql for recorder in recorders):
+        if many:
+            try:
+                times = len(params)
+            except TypeError:  # params could be an iterator
+                times = '?'
+            text = '{0} times: {1}'.format(times, sql)
+        else:
+            text = wrapper.db.ops.last_executed_query(wrapper.cursor, sql, params)
+    alias = wrapper.db.alias
+    for recorder in recorders:
+        recorder.add(alias, text if recorder.sql else None, duration)
+    if slow:
+        slow_query_logger.warning('(%.3f) %s', duration, text,
+                                  extra={'duration': duration, 'sql': text, 'alias': alias, 'many': many})
+
+
+class TimedCursorWrapper(CursorWrapper):
+    """
+    Cursor wrapper that times every query; see the module docstring.
+    """
+    def execute(self, sql, params=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            _observe(self, sql, params, time.perf_counter() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, param_list)
+        finally:
+            _observe(self, sql, param_list, time.perf_counter() - start, many=True)
+
+
+class TimedCursorDebugWrapper(TimedCursorWrapper, CursorDebugWrapper):
+    """
+    TimedCursorWrapper on top of Django's debug cursor, for the connections that log their
+    queries anyway (settings.DEBUG, or CaptureQueriesContext in tests).
+    """
+    pass
+
+
+def install_cursor_wrapper(sender, connection, **kwargs):
+    """
+    connection_created signal receiver: wrap the cursors of new database connections in
+    TimedCursorWrapper.
+    """
+    connection.make_cursor = lambda cursor: TimedCursorWrapper(cursor, connection)
+    connection.make_debug_cursor = lambda cursor: TimedCursorDebugWrapper(cursor, connection)
+
+
+def _is_ours(filename):
+    filename = os.path.abspath(filename)
+    return filename.startswith(_PROJECT_DIR) and not any(part in filename for part in _FOREIGN_DIRS) \
+        and filename not in _WRAPPER_FILES
+
+
+def _describe(frame):
+    filename = frame.f_code.co_filename
+    return {
+        'file': os.path.relpath(filename, _PROJECT_DIR),
+        'line': frame.f_lineno,
+        'function': frame.f_code.co_name,
+        'code': linecache.getline(filename, frame.f_lineno).strip()
+    }
+
+
+def _attribute():
+    """
+    :return: a tuple of (the innermost, the outermost) frame of our own code in the current
+             stack, as dictionaries (see _describe); either may be None
+    """
+    origin = entry = None
+    frame = sys._getframe(1)
+    while frame is not None:
+        if _is_ours(frame.f_code.co_filename):
+            if origin is None:
+                origin = frame
+            entry = frame
+        frame = frame.f_back
+    return (_describe(origin) if origin is not None else None), (_describe(entry) if entry is not None else None)
+
+
+def _explain(sql, shape, alias):
+    """
+    :return: the query plan of a SELECT query on the database it ran on, as a list of lines
+             (from the cache if its shape has been explained there before), or None if it
+             can't be explained
+    """
+    with _plans_lock:
+        if (alias, shape) in _plans:
+            _plans.move_to_end((alias, shape))
+            return _plans[(alias, shape)]
+
+    connection = connections[alias]
+    if connection.vendor == 'sqlite':
+        prefix, column = 'EXPLAIN QUERY PLAN ', -1  # rows are (id, parent, notused, detail)
+    elif connection.vendor in ('postgresql', 'mysql'):
+        prefix, column = 'EXPLAIN ', 0
+    else:
+        return None
+
+    # the logged SQL has its parameters quoted and filled in by the database backend already
+    _local.explaining = True
+    try:
+        # a savepoint, so that a failing EXPLAIN doesn't break the transaction it's run in
+        with transaction.atomic(using=alias), connection.cursor() as cursor:
+            cursor.execute(prefix + sql)
+            plan = [str(row[column]) for row in cursor.fetchall()]
+    except Exception as e:
+        plan = ['(cannot explain: {0})'.format(e)]
+    finally:
+        _local.explaining = False
+
+    with _plans_lock:
+        _plans[(alias, shape)] = plan
+        while len(_plans) > PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+    return plan
+
+
+class SlowQueryHandler(logging.Handler):
+    """
+    Logging handler for the `global_resources.slow_queries` logger that writes the slow
+    queries to the slow query log; see the module docstring.
+    """
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        # the file is only created once there's a slow query
+        self._file = logging.handlers.RotatingFileHandler(
+            settings.SLOW_QUERY_LOG, maxBytes=settings.SLOW_QUERY_LOG_MAX_BYTES,
+            backupCount=settings.SLOW_QUERY_LOG_BACKUPS, delay=True, encoding='utf-8')
+
+    def emit(self, record):
+        duration = getattr(record, 'duration', None)
+        if duration is None:
+            return
+
+        try:
+            sql = str(record.sql)
+            alias = record.alias
+            shape = fingerprint(sql)
+            origin, entry = _attribute()
+            explainable = shape.upper().startswith('SELECT') and not record.many
+            line = json.dumps(OrderedDict([
+                ('time', timezone.now().isoformat()),
+                ('duration_ms', round(duration * 1000, 3)),
+                ('view', getattr(_local, 'view', None)),
+                ('database', alias),
+                ('origin', origin),
+                ('entry', entry),
+                ('sql', sql[:MAX_SQL_LENGTH]),
+                ('fingerprint', shape[:MAX_SQL_LENGTH]),
+                ('plan', _explain(sql, shape, alias) if explainable else None),
+                ('pid', os.getpid())
+            ]))
+            self._file.handle(logging.makeLogRecord({'msg': line, 'levelno': logging.WARNING}))
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self._file.close()
+        super().close()
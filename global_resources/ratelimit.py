@@ -0,0 +1,140 @@
+"""
+Rate limiting of the APIs, backed by the default cache (shared between the processes if
+settings.CACHE_URL is set).
+
+Each limited view takes one token from a bucket per user and one per client IP address
+(the limits are set per view in settings.RATE_LIMITS, e.g. '10/m': a bucket of 10 tokens,
+refilled at 10 tokens a minute). A request that finds a bucket empty is answered with
+429 Too Many Requests and a Retry-After header, and counted in the rate_limited_total
+metric.
+
+The buckets are kept with GCRA (the generic cell rate algorithm, equivalent to a token
+bucket): each bucket is a single integer in the cache, the theoretical arrival time (TAT)
+of the next request in microseconds, which moves ahead by one emission interval (the time
+it takes to refill one token) per request. A request is allowed if the TAT lies less than
+a full bucket's worth of intervals in the future. Taking a token is one atomic cache.incr;
+a bucket that has been idle for a while (its TAT in the past) is reset with cache.set,
+where two racing requests may both get through.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.0.0
+"""
+import functools
+import logging
+import math
+import re
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from .metrics import metrics
+
+
+# for printing debugging info to console
+logger = logging.getLogger(__name__)
+
+# the rates in settings.RATE_LIMITS: <number of requests>/<s|m|h|d>
+_RATE = re.compile(r'^\s*(\d+)\s*/\s*([smhd])\s*$')
+_PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 60 * 60 * 24}
+# the buckets are kept in the cache for this many periods of their rate at least (they
+# aren't renewed on incr, so a client hitting the limit all the time gets an extra bucket
+# of tokens once in this many periods)
+KEY_PERIODS = 10
+
+
+@functools.lru_cache(maxsize=None)
+def parse_rate(rate):
+    """
+    :param rate: a rate like '10/m'
+    :return: a tuple of (number of requests, period in seconds)
+    :raise ValueError: if the rate is malformed
+    """
+    match = _RATE.match(rate)
+    if match is None or int(match.group(1)) <= 0:
+        raise ValueError('Invalid rate limit {0!r}; expected e.g. "10/m".'.format(rate))
+    return int(match.group(1)), _PERIODS[match.group(2)]
+
+
+def client_ip(request):
+    """
+    :return: the IP address of the client of a request; with settings.RATE_LIMIT_TRUSTED_PROXIES
+             proxies in front of the site, the address they saw in the X-Forwarded-For header
+    """
+    proxies = settings.RATE_LIMIT_TRUSTED_PROXIES
+    if proxies:
+        # each proxy appends the address it got the request from; anything before that is made up by the client
+        forwarded = [address.strip() for address in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+        if len(forwarded) >= proxies and forwarded[-proxies]:
+            return forwarded[-proxies]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def take_token(key, rate):
+    """
+    Take a token from a bucket.
+
+    :param key: cache key of the bucket
+    :param rate: the rate of the bucket, e.g. '10/m'
+    :return: 0 if a token was taken, otherwise the number of seconds until one is available
+    """
+    count, period = parse_rate(rate)
+    interval = period * 10 ** 6 // count  # microseconds to refill a token
+    tolerance = interval * (count - 1)  # how far ahead of now the TAT may be (a full bucket minus this request)
+    timeout = period * KEY_PERIODS
+    now = int(time.time() * 10 ** 6)
+
+    # a new bucket is full
+    if cache.add(key, now + interval, timeout):
+        return 0
+    try:
+        tat = cache.incr(key, interval) - interval
+    except ValueError:  # expired in the meantime
+        cache.set(key, now + interval, timeout)
+        return 0
+
+    if tat < now:
+        # an idle bucket has filled up again
+        cache.set(key, now + interval, timeout)
+        return 0
+    if tat - now <= tolerance:
+        return 0
+
+    # empty: give the token back
+    try:
+        cache.decr(key, interval)
+    except ValueError:
+        pass
+    return max(1, math.ceil((tat - tolerance - now) / 10 ** 6))
+
+
+def rate_limit(name):
+    """
+    View decorator: limits the requests to the view by the rates in settings.RATE_LIMITS[name],
+    a dictionary of 'user' (the rate per user) and / or 'ip' (the rate per client IP address).
+    Views sharing a name share their buckets.
+
+    It should come right after @login_required, so that rejected requests don't get further.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            limits = settings.RATE_LIMITS.get(name, {}) if settings.RATE_LIMITS_ENABLED else {}
+            buckets = []
+            if 'user' in limits and request.user.is_authenticated:
+                buckets.append(('user', request.user.pk, limits['user']))
+            if 'ip' in limits:
+                buckets.append(('ip', client_ip(request), limits['ip']))
+
+            for scope, identity, rate in buckets:
+                retry_after = take_token('ratelimit-{0}-{1}-{2}'.format(name, scope, identity), rate)
+                if retry_after:
+                    metrics.inc('rate_limited_total', limit=name, scope=scope)
+                    logger.info('Rate limit %s (%s) hit by %s %s', name, rate, scope, identity)
+                    response = HttpResponse('Too many requests; please slow down.', status=429)
+                    response['Retry-After'] = retry_after
+                    return response
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
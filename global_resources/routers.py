@@ -0,0 +1,116 @@
+"""
+Database router for read replicas.
+
+Writes always go to the primary ('default') database. The reads of the read-heavy views
+(the polling APIs and the profile page), marked with the read_from_replica decorator, go
+to one of the replicas in settings.DATABASE_REPLICAS instead, picked at random per
+request; every other read goes to the primary too.
+
+A replica may lag behind the primary, so a user could miss what they've just posted
+(read-your-writes). Whenever a request writes to the database, PrimaryStickinessMiddleware
+sets a cookie on its response that keeps the reads of the following requests of that
+browser on the primary for settings.REPLICA_STICKY_SECONDS.
+
+Note: the routing state is kept per thread, and set up by PrimaryStickinessMiddleware;
+reads outside of requests (consumers, management commands, ...) always go to the primary.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.0.1
+"""
+import functools
+import random
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+# the routing state of the current thread: the replica the reads go to (or None for the
+# primary), whether the reads stick to the primary, and whether the request wrote anything
+_local = threading.local()
+
+# the methods whose requests may read from a replica; others read what they're about to change
+SAFE_METHODS = ('GET', 'HEAD')
+
+
+def begin_request(pinned):
+    """
+    Set up the routing state of a request.
+
+    :param pinned: whether the reads of the request must stick to the primary
+    """
+    _local.pinned = pinned
+    _local.wrote = False
+    _local.replica = None
+
+
+def end_request():
+    """
+    Clear the routing state of a request.
+
+    :return: whether the request wrote to the database
+    """
+    wrote = getattr(_local, 'wrote', False)
+    _local.pinned = _local.wrote = False
+    _local.replica = None
+    return wrote
+
+
+class _ReplicaReads:
+    # context manager routing the reads of the current thread to a replica while it's active
+    def __init__(self, replica):
+        self.replica = replica
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'replica', None)
+        _local.replica = self.replica
+
+    def __exit__(self, *exc_info):
+        _local.replica = self.previous
+
+
+def read_from_replica(view):
+    """
+    View decorator: the reads of the view go to a replica, unless the request isn't a GET /
+    HEAD, or its reads stick to the primary after a recent write; see the module docstring.
+
+    It should come after @login_required (and @rate_limit), so that the conditional GET
+    validators of the view read from the replica too.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not settings.DATABASE_REPLICAS or request.method not in SAFE_METHODS \
+                or getattr(_local, 'pinned', True):
+            return view(request, *args, **kwargs)
+
+        # one replica for the whole request, so that its reads are consistent with each other
+        replica = random.choice(settings.DATABASE_REPLICAS)
+        with _ReplicaReads(replica):
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+class ReplicaRouter:
+    """
+    Routes writes to the primary and the reads of read_from_replica views to the replicas;
+    see the module docstring. Enabled in settings.DATABASE_ROUTERS.
+    """
+    def db_for_read(self, model, **hints):
+        return getattr(_local, 'replica', None) or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # the following reads of this browser have to see this write
+        _local.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same data as the primary
+        databases = {DEFAULT_DB_ALIAS}.union(settings.DATABASE_REPLICAS)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replicas get the schema from the primary through replication
+        return db not in settings.DATABASE_REPLICAS
+
@@ -0,0 +1,318 @@
+"""
+Signal receivers that keep derived data in sync with the models.
+
+The receivers are connected when the app registry is ready; see apps.py.
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.4.1
+"""
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_out
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import backends, follow_graph, global_window, subscriptions
+from .fragments import COMMENT_CARD, MESSAGE_CARD, invalidate_cards
+from .models import Comment, Message, TimelineEntry, UserExtended
+
+
+# fields of User that show up on the message / comment cards
+USER_CARD_FIELDS = {'username', 'first_name', 'last_name'}
+# fields of UserExtended that show up on the message / comment cards
+AVATAR_FIELDS = {'avatar', 'avatar_hash', 'avatar_webp'}
+
+
+@receiver(m2m_changed, sender=UserExtended.following.through)
+def sync_timelines_on_follow(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Add or remove messages in the home timelines when users follow / unfollow each other.
+
+    The relation can be changed from either side: user.ext.following.add(author) (forward;
+    instance is a UserExtended and pk_set holds user ids of the authors), or
+    author.followed_by.add(user.ext) (reverse; instance is the author User and pk_set holds
+    primary keys of the followers' UserExtended, which are also their user ids).
+    """
+    if action == 'post_add':
+        if not reverse:
+            TimelineEntry.backfill(instance.pk, pk_set)
+        else:
+            for follower_id in pk_set:
+                TimelineEntry.backfill(follower_id, [instance.pk])
+
+    elif action == 'post_remove':
+        if not reverse:
+            TimelineEntry.objects.filter(owner_id=instance.pk, message__user_id__in=pk_set).delete()
+        else:
+            TimelineEntry.objects.filter(owner_id__in=pk_set, message__user_id=instance.pk).delete()
+
+    elif action == 'pre_clear':
+        # pk_set is not available for clear; remove the entries before the relations are gone
+        if not reverse:
+            TimelineEntry.objects.filter(owner_id=instance.pk,
+                                         message__user__in=instance.following.all()).delete()
+        else:
+            TimelineEntry.objects.filter(owner__in=instance.followed_by.values('user_id'),
+                                         message__user_id=instance.pk).delete()
+
+
+def _invalidate_cards(kind, pks):
+    """
+    Invalidate cached cards now (so that they're re-rendered with the new data within
+    this request, e.g. for the broadcast in Message.save()) and again once the transaction
+    commits (so that a card re-rendered by another request from the not yet committed
+    data doesn't stick around).
+    """
+    pks = list(pks)
+    if pks:
+        invalidate_cards(kind, pks)
+        transaction.on_commit(lambda: invalidate_cards(kind, pks))
+
+
+@receiver([post_save, post_delete], sender=Message)
+def invalidate_message_card(sender, instance, **kwargs):
+    _invalidate_cards(MESSAGE_CARD, [instance.pk])
+
+
+@receiver([post_save, post_delete], sender=Comment)
+def invalidate_comment_card(sender, instance, **kwargs):
+    _invalidate_cards(COMMENT_CARD, [instance.pk])
+    # the message card embeds its comment list
+    _invalidate_cards(MESSAGE_CARD, [instance.message_id])
+
+
+def _invalidate_user_cards(user_id):
+    """
+    Invalidate all the cards showing the given user: messages and comments posted by
+    them, and messages they commented on.
+    """
+    _invalidate_cards(MESSAGE_CARD, Message.objects.filter(Q(user_id=user_id) | Q(cmts__from_user_id=user_id))
+                      .values_list('id', flat=True).distinct())
+    _invalidate_cards(COMMENT_CARD, Comment.objects.filter(from_user_id=user_id).values_list('id', flat=True))
+
+
+def _card_fields(sender):
+    return USER_CARD_FIELDS if sender is User else AVATAR_FIELDS
+
+
+@receiver(pre_save, sender=User)
+@receiver(pre_save, sender=UserExtended)
+def remember_stored_card_fields(sender, instance, raw, using, update_fields, **kwargs):
+    """
+    Remember the values of the fields shown on the cards as they're stored, before a save
+    that may change them, so that the receivers below can tell whether they did. Saves
+    that can't change them (e.g. the last_login update on every login) skip the lookup.
+    """
+    fields = _card_fields(sender)
+    instance._stored_card_fields = None
+    if raw or instance._state.adding or (update_fields is not None and not fields.intersection(update_fields)):
+        return
+    instance._stored_card_fields = sender._default_manager.using(using).filter(pk=instance.pk) \
+        .values(*fields).first()
+
+
+def _card_fields_changed(sender, instance, created):
+    stored = getattr(instance, '_stored_card_fields', None)
+    instance._stored_card_fields = None
+    if created or stored is None:
+        return False
+    # FieldFile (the avatar) compares equal to its stored name
+    return any(getattr(instance, name) != value for name, value in stored.items())
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_cards(sender, instance, created, **kwargs):
+    # skip saves that leave the names as they were, e.g. a password change
+    if _card_fields_changed(sender, instance, created):
+        _invalidate_user_cards(instance.pk)
+
+
+@receiver(post_save, sender=UserExtended)
+def invalidate_avatar_cards(sender, instance, created, **kwargs):
+    # UserExtended.save() writes every field, so the avatar is compared with the stored one;
+    # bio / hobby / ... edits don't show on the cards
+    if _card_fields_changed(sender, instance, created):
+        _invalidate_user_cards(instance.pk)
+
+
+def _on_commit_for_followers(apply, instance, reverse, pk_set):
+    # apply(follower id, author ids) once the transaction commits
+    if not reverse:
+        follows = [(instance.pk, list(pk_set))]
+    else:
+        follows = [(follower_id, [instance.pk]) for follower_id in pk_set]
+    transaction.on_commit(lambda: [apply(follower_id, author_ids) for follower_id, author_ids in follows])
+
+
+@receiver(m2m_changed, sender=UserExtended.following.through)
+def sync_following_stream_on_follow(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Update the following stream subscriptions of open connections (see subscriptions.py)
+    once users following / unfollowing each other is committed. See
+    sync_timelines_on_follow for what instance and pk_set are.
+    """
+    if action == 'post_add':
+        _on_commit_for_followers(subscriptions.follow, instance, reverse, pk_set)
+
+    elif action == 'post_remove':
+        _on_commit_for_followers(subscriptions.unfollow, instance, reverse, pk_set)
+
+    elif action == 'pre_clear':
+        # the other side is only known before the relations are gone
+        if not reverse:
+            related = instance.following.values_list('id', flat=True)
+        else:
+            related = instance.followed_by.values_list('user_id', flat=True)
+        _on_commit_for_followers(subscriptions.unfollow, instance, reverse, set(related))
+
+
+@receiver(m2m_changed, sender=UserExtended.following.through)
+def sync_follow_graph_on_follow(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Forget the cached id sets of the follow graph (see follow_graph.py) of the users on
+    both sides of changed follow relations. See sync_timelines_on_follow for what instance
+    and pk_set are; either way, pk_set holds user ids.
+    """
+    if action in ('post_add', 'post_remove'):
+        follow_graph.invalidate({instance.pk}.union(pk_set))
+
+    elif action == 'pre_clear':
+        # the other side is only known before the relations are gone
+        if not reverse:
+            related = instance.following.values_list('id', flat=True)
+        else:
+            related = instance.followed_by.values_list('user_id', flat=True)
+        follow_graph.invalidate({instance.pk}.union(related))
+
+
+def _add_to_counter(model, field, pks, delta):
+    """
+    Atomically add to (or, with a negative delta, subtract from) a denormalized counter
+    of the given rows, in a single UPDATE within the current transaction; the counter
+    never goes below zero.
+    """
+    pks = list(pks)
+    if pks and delta:
+        value = F(field) + delta if delta > 0 else Greatest(F(field) + delta, 0)
+        model.objects.filter(pk__in=pks).update(**{field: value})
+        if model is UserExtended:
+            # the primary key of a UserExtended is its user id
+            backends.invalidate(pks)
+
+
+@receiver(post_save, sender=Message)
+def count_new_message(sender, instance, created, **kwargs):
+    if created:
+        _add_to_counter(UserExtended, 'message_count', [instance.user_id], 1)
+
+
+@receiver(post_delete, sender=Message)
+def count_deleted_message(sender, instance, **kwargs):
+    _add_to_counter(UserExtended, 'message_count', [instance.user_id], -1)
+
+
+@receiver(post_delete, sender=Message)
+def discard_from_global_window(sender, instance, **kwargs):
+    message_id = instance.pk
+    transaction.on_commit(lambda: global_window.discard(message_id))
+
+
+@receiver(post_save, sender=Comment)
+def count_new_comment(sender, instance, created, **kwargs):
+    if created:
+        _add_to_counter(Message, 'comment_count', [instance.message_id], 1)
+        _refresh_global_window(instance.message_id)
+
+
+@receiver(post_delete, sender=Comment)
+def count_deleted_comment(sender, instance, **kwargs):
+    _add_to_counter(Message, 'comment_count', [instance.message_id], -1)
+    _refresh_global_window(instance.message_id)
+
+
+def _refresh_global_window(message_id):
+    # the cached window of the global stream keeps a copy of the comment count
+    transaction.on_commit(lambda: global_window.refresh(message_id))
+
+
+def _count_follows(instance, reverse, pk_set, delta):
+    """
+    Update the follower / following counters for follows added (delta=1) or removed
+    (delta=-1). See sync_timelines_on_follow for what instance and pk_set are; the
+    primary key of a UserExtended is its user id, so pk_set can be used on either side.
+    """
+    if not reverse:
+        # instance follows (or unfollows) the users in pk_set
+        _add_to_counter(UserExtended, 'following_count', [instance.pk], delta * len(pk_set))
+        _add_to_counter(UserExtended, 'follower_count', pk_set, delta)
+        _backfill_under_fan_out_limit(follow_graph.check_fan_out_limit(pk_set, delta), delta, [instance.pk])
+    else:
+        # the users in pk_set follow (or unfollow) instance
+        _add_to_counter(UserExtended, 'follower_count', [instance.pk], delta * len(pk_set))
+        _add_to_counter(UserExtended, 'following_count', pk_set, delta)
+        _backfill_under_fan_out_limit(follow_graph.check_fan_out_limit([instance.pk], delta * len(pk_set)),
+                                      delta, pk_set)
+
+
+def _backfill_under_fan_out_limit(crossed, delta, leaving):
+    """
+    Fill in the timelines of the followers of authors who have just dropped back under the
+    fan-out limit (see TimelineEntry.backfill_followers), leaving out the followers who are
+    unfollowing them.
+    """
+    if delta < 0:
+        for author_id in crossed:
+            TimelineEntry.backfill_followers(author_id, leaving)
+
+
+@receiver(m2m_changed, sender=UserExtended.following.through)
+def count_follows(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep the follower / following counters in sync with the follow relations. The
+    counters are updated within the transaction that changes the relations.
+    """
+    if action == 'post_add':
+        # pk_set only holds the relations that were actually added
+        _count_follows(instance, reverse, pk_set, 1)
+
+    elif action == 'pre_remove':
+        # pk_set holds whatever was passed to remove(); only count the relations that exist
+        related = instance.following if not reverse else instance.followed_by
+        _count_follows(instance, reverse, set(related.filter(pk__in=pk_set).values_list('pk', flat=True)), -1)
+
+    elif action == 'pre_clear':
+        related = instance.following if not reverse else instance.followed_by
+        _count_follows(instance, reverse, set(related.values_list('pk', flat=True)), -1)
+
+
+@receiver(pre_delete, sender=User)
+def count_deleted_follows(sender, instance, **kwargs):
+    """
+    The follow relations of a deleted user are removed by cascade, which doesn't send
+    m2m_changed; take them off the counters and the cached follow graph of the users on the
+    other side.
+    """
+    followed = list(UserExtended.objects.filter(user__followed_by=instance.pk).values_list('pk', flat=True))
+    followers = list(UserExtended.objects.filter(following=instance).values_list('pk', flat=True))
+    UserExtended.objects.filter(pk__in=followed).update(follower_count=Greatest(F('follower_count') - 1, 0))
+    UserExtended.objects.filter(pk__in=followers).update(following_count=Greatest(F('following_count') - 1, 0))
+    _backfill_under_fan_out_limit(follow_graph.check_fan_out_limit(followed, -1), -1, [instance.pk])
+    follow_graph.invalidate([instance.pk] + followed + followers)
+
+
+@receiver([post_save, post_delete], sender=User)
+@receiver([post_save, post_delete], sender=UserExtended)
+def invalidate_cached_user(sender, instance, **kwargs):
+    """
+    Forget the copies of a user remembered by CachedModelBackend when they're changed,
+    e.g. by a profile edit or a password change.
+    """
+    backends.invalidate([instance.pk])
+
+
+@receiver(user_logged_out)
+def invalidate_logged_out_user(sender, request, user, **kwargs):
+    if user is not None:
+        backends.invalidate([user.pk])
@@ -5,6 +5,13 @@
  * @author Stephen Xie <[redacted]@cmu.edu>
  */
 
+// maximum number of messages the comments stream socket can subscribe to; must not be greater
+// than COMMENT_SUBSCRIPTIONS_PER_SOCKET in the backend settings
+var MAX_COMMENT_SUBSCRIPTIONS = 50;
+// the socket pushing new comments of the grumbles on screen, and the ids of those grumbles
+var commentsSocket = null;
+var commentSubscriptions = [];
+
 /**
  * Post new comment to the backend, and update the frontend template respectively.
  */
@@ -19,8 +26,10 @@ function postComment(event) {
             .done(function() {
                 // clear the old input
                 input_field.val("");
-                // update the comment list
-                getComments(message)
+                // update the comment list, unless the new comment is going to be pushed through the socket
+                if (!isCommentsStreamLive(msg_id)) {
+                    getComments(message);
+                }
             });
     }
 }
@@ -37,23 +46,96 @@ function getComments(message) {
     // get the last time this comment list is updated
     var lastTimeUpdated = (typeof commentList.data("last-updated") === "undefined") ? "" : commentList.data("last-updated");
 
-    $.get("/api/get-comments/" + msg_id + "/" + lastTimeUpdated)
-        .done(function(data) {
+    // ifModified: let the backend answer 304 Not Modified if no comment has been posted since the last request
+    $.ajax({"url": "/api/get-comments/" + msg_id + "/" + lastTimeUpdated, "ifModified": true})
+        .done(function(data, status) {
+            if (status === "notmodified") {
+                return;  // nothing new
+            }
             commentList.data("last-updated", data["last_updated"]);  // update last updated time with data from backend API
             if (!lastTimeUpdated) {
                 // clear the list if lastTimeUpdated is not recorded before; this avoids duplicate comment addition
                 commentList.html("");
             }
             for (var i = 0; i < data.comments.length; i++) {
-                commentList.append(data.comments[i]);  // add each comment HTML code to the end of the list
+                commentList.append(data.comments[i].html);  // add each comment HTML code to the end of the list
             }
         });
 }
 
+/**
+ * Check whether new comments of the given message are currently being pushed through the socket.
+ *
+ * @param msg_id id of the message
+ */
+function isCommentsStreamLive(msg_id) {
+    return commentsSocket !== null && commentsSocket.socket.readyState === WebSocket.OPEN &&
+        commentSubscriptions.indexOf(parseInt(msg_id)) !== -1;
+}
+
+/**
+ * Subscribe the comments socket to the grumbles currently in the stream (the first
+ * MAX_COMMENT_SUBSCRIPTIONS of them), and unsubscribe it from those no longer there.
+ *
+ * @param resubscribe true to send all subscriptions again, e.g. after the socket reconnects
+ */
+function syncCommentSubscriptions(resubscribe) {
+    var wanted = $("#messages-stream").find(".grumble").slice(0, MAX_COMMENT_SUBSCRIPTIONS).map(function() {
+        return parseInt(this.getAttribute("data-grumble-id"));
+    }).get();
+    var previous = resubscribe ? [] : commentSubscriptions;
+
+    var subscribe = wanted.filter(function(id) { return previous.indexOf(id) === -1; });
+    var unsubscribe = previous.filter(function(id) { return wanted.indexOf(id) === -1; });
+    commentSubscriptions = wanted;
+
+    if ((subscribe.length || unsubscribe.length) && commentsSocket.socket.readyState === WebSocket.OPEN) {
+        commentsSocket.send({"subscribe": subscribe, "unsubscribe": unsubscribe});
+    }
+}
+
+/**
+ * Open the socket that pushes new comments of the grumbles on screen.
+ */
+function updateCommentsWS() {
+    var msgStream = $("#messages-stream");
+    if (!msgStream.length) {
+        return;
+    }
+
+    commentsSocket = new channels.WebSocketBridge();
+    commentsSocket.connect("/api/get-comments-stream/");
+    // subscriptions are kept per connection by the backend, so send them all again whenever the
+    // socket (re)connects
+    commentsSocket.socket.addEventListener("open", function() {
+        syncCommentSubscriptions(true);
+    });
+    commentsSocket.listen(function(data) {
+        if (data.error) {
+            console.log(data.error);
+            return;
+        }
+        for (var i = 0; i < data.comments.length; i++) {
+            var comment = data.comments[i];
+            var commentList = msgStream.find(".grumble[data-grumble-id='" + comment.message_id + "'] .comment-list");
+            // skip comments that are already on the list, e.g. fetched by getComments()
+            if (commentList.find("[data-comment-id='" + comment.id + "']").length === 0) {
+                commentList.append(comment.html);
+            }
+        }
+    });
+
+    // follow the grumbles coming in and out of the stream
+    new MutationObserver(function() {
+        syncCommentSubscriptions(false);
+    }).observe(msgStream.get(0), {"childList": true});
+}
+
 /**
  * Initializations after the page is loaded.
  */
 $(document).ready(function() {
+    updateCommentsWS();
     $(document).on("click", ".comment-sent-btn", postComment);
     $(document).on("keypress", ".comment-input", function(event) {
         // also post comment when user presses enter key in the input field
@@ -10,6 +10,8 @@ var thisScript = document.getElementById("grumbles-ctrl");
 var view = thisScript.getAttribute("data-view").toLowerCase();
 // if this is the profile page, what's the ID of the user to which this page belongs?
 var profile_username = thisScript.getAttribute("data-user");
+// how often (in milliseconds) a heartbeat is sent over the stream socket
+var GLOBAL_STREAM_HEARTBEAT_MS = 30 * 1000;
 
 /**
  * Post new message to the backend, and update the frontend template with the latest messages.
@@ -37,25 +39,33 @@ function postMessage() {
  */
 function updateStream() {
     var msgStream = $("#messages-stream");
-    var lastTimeUpdated = (typeof msgStream.data("last-updated") === "undefined") ? "" : msgStream.data("last-updated");
-    // get the last time the stream is updated, or empty if this data is not found (this is the first update)
+    // get the cursor pointing to the newest message in the stream, or empty if this data is not found
+    // (this is the first update, and the newest page will be fetched)
+    var cursor = (typeof msgStream.data("cursor") === "undefined") ? "" : msgStream.data("cursor");
 
     // determine the API address
     var apiUrl;
     if (view === "profile") {
-        apiUrl = "/api/get-messages/profile/" + profile_username + "/" + lastTimeUpdated;
+        apiUrl = "/api/get-messages/profile/" + profile_username + "/page/";
     } else if (view === "global") {
-        apiUrl = "/api/get-messages/global/" + lastTimeUpdated;
+        apiUrl = "/api/get-messages/global/page/";
     } else {
-        apiUrl = "/api/get-messages/follower/" + lastTimeUpdated;
+        apiUrl = "/api/get-messages/follower/page/";
     }
 
     // then make the connection!
-    $.get(apiUrl)
-    // this will return a list of messages that range from lastTimeUpdated (or the default starting time if it's
-    // empty; excluded value) to current time
-        .done(function(data) {
-            msgStream.data("last-updated", data["last_updated"]);  // update last updated time with data from backend API
+    // ifModified: send back the ETag of the last response from this URL, so that the backend can answer
+    // 304 Not Modified (with no body) if nothing has changed since
+    $.ajax({"url": apiUrl, "data": cursor ? {"cursor": cursor, "direction": "newer"} : {}, "ifModified": true})
+    // this will return a page of messages that are newer than the cursor (or the newest page if the cursor
+    // is empty), sorted from the newest to the oldest
+        .done(function(data, status) {
+            if (status === "notmodified") {
+                return;  // nothing new
+            }
+            if (data["prev_cursor"]) {
+                msgStream.data("cursor", data["prev_cursor"]);  // poll from the newest message we've seen next time
+            }
             if (data.messages.length <= 0 && msgStream.data("isEmpty")) {
                 msgStream.html("<p>No message has been posted yet.</p>");
 
@@ -64,13 +74,19 @@ function updateStream() {
                     msgStream.html("");
                     msgStream.data("isEmpty", false);
                 }
-                for (var i = 0; i < data.messages.length; i++) {
+                // iterate from the oldest to the newest, so that the newest message ends up on top
+                for (var i = data.messages.length - 1; i >= 0; i--) {
                     var message = data.messages[i];
                     // each message card is wrapped inside a div tag with a label attribute of its id;
                     // useful for locating existing messages
                     // Note: the advantage of setting the id explicitly rather than hiding it inside
                     // jQuery's .data() is that you can search for the message page-wide using
                     // jQuery's Attribute Equals Selector: $("div[data-grumble-id='" + id + "']")
+                    var existingMsg = $("div[data-grumble-id='" + message.id + "']");
+                    if (existingMsg.length) {  // the message may have arrived through WebSocket already
+                        existingMsg.html(message.html);
+                        continue;
+                    }
                     var message_html = $("<div class='grumble' data-grumble-id='" + message.id + "'>" + message.html + "</div>");
                     msgStream.prepend(message_html);  // add each message HTML code to the top of the list
                 }
@@ -80,44 +96,71 @@ function updateStream() {
 
 /**
  * Update message stream in real-time with WebSockets.
- * Used in global / profile view.
+ * The following view connects to its own stream, which only delivers messages from the users
+ * the current user is following; global / profile view share the global stream.
  */
 function updateStreamWS() {
     var msgStream = $("#messages-stream");
-    var apiUrl = "/api/get-messages-stream/";
-    console.log("Connecting to global stream socket");  // TODO: for debugging
+    var apiUrl = (view === "following") ? "/api/get-messages-stream/following/" : "/api/get-messages-stream/";
+    console.log("Connecting to " + view + " stream socket");  // TODO: for debugging
 
     // use the WebSocket wrapper provided by Django Channels to simplify the calls
     var webSocketBridge = new channels.WebSocketBridge();
     webSocketBridge.connect(apiUrl);
     webSocketBridge.listen(function(data) {
+        // each frame carries a batch of new grumbles, from the oldest to the newest
+        for (var i = 0; i < data.messages.length; i++) {
+            var message = data.messages[i];
+
+            if (view === "profile" && message.author !== profile_username) {
+                // if this is the profile page, pass grumbles that don't belong to the
+                // profile owner
+                continue;
+            }
 
-        if (msgStream.data("isEmpty")) {  // clear that "No message" sentence
-            msgStream.html("");
-            msgStream.data("isEmpty", false);
-        }
-
-        if (view === "profile" && data.author !== profile_username) {
-            // if this is the profile page, pass grumbles that don't belong to the
-            // profile owner
-            return;
-        }
+            if (msgStream.data("isEmpty")) {  // clear that "No message" sentence
+                msgStream.html("");
+                msgStream.data("isEmpty", false);
+            }
 
-        var content = data.html;  // html code of the new grumble
-        // search for existing grumble with the same id; replace if it exists,
-        // otherwise create new
-        var existingMsg = $("div[data-grumble-id='" + data.id + "']");
-        if (existingMsg.length) {
-            existingMsg.html(content);
-        } else {
-            var newMsg = $("<div class='grumble' data-grumble-id='" + data.id + "'>" + content + "</div>");
-            msgStream.prepend(newMsg);
+            var content = message.html;  // html code of the new grumble
+            // search for existing grumble with the same id; replace if it exists,
+            // otherwise create new
+            var existingMsg = $("div[data-grumble-id='" + message.id + "']");
+            if (existingMsg.length) {
+                existingMsg.html(content);
+            } else {
+                var newMsg = $("<div class='grumble' data-grumble-id='" + message.id + "'>" + content + "</div>");
+                msgStream.prepend(newMsg);
+            }
         }
     });
 
+    // tell the server the socket is still alive, or it's pruned from the stream after a while
+    // (see GLOBAL_STREAM_HEARTBEAT in settings.py); a reconnected socket picks up the beat again
+    setInterval(function() {
+        if (webSocketBridge.socket.readyState === WebSocket.OPEN) {
+            webSocketBridge.send({"type": "heartbeat"});
+        }
+    }, GLOBAL_STREAM_HEARTBEAT_MS);
+
+    // the following page only fetches what the socket may have missed (e.g. while it was reconnecting) when
+    // it reconnects, or when it fails; it's answered with 304 Not Modified when there's nothing new
+    var connectedBefore = false;
+    webSocketBridge.socket.onopen = function() {
+        console.log("Connected to " + view + " stream socket");  // TODO: for debugging
+        if (view === "following" && connectedBefore) {
+            updateStream();
+        }
+        connectedBefore = true;
+    };
+    webSocketBridge.socket.onerror = function() {
+        if (view === "following") {
+            updateStream();
+        }
+    };
     // TODO: for debugging
-    webSocketBridge.socket.onopen = function() { console.log("Connected to global stream socket"); }
-    webSocketBridge.socket.onclose = function() { console.log("Disconnected to global stream socket"); }
+    webSocketBridge.socket.onclose = function() { console.log("Disconnected to " + view + " stream socket"); }
 }
 
 /**
@@ -151,23 +194,12 @@ $(document).ready(function() {
     autofocusField.focus();  // same as adding autofocus attribute to the element
 
 
-    if (view !== "following") {
-        // update stream in real-time using WebSocket
-        updateStreamWS();
-    } else {
-        // periodically update the stream every 5s
-        // Note: HTTP Polling is used instead for the following page, because checking whether every
-        // new grumble is made by an author followed by the current user requires database searching;
-        // this will not scale well in real life where we have lots of new grumbles posted every second.
-        // The idea of creating a message group for each user which will be subscribed by all of his / her
-        // followers does not seem to scale well either, as many groups maintained on the server will
-        // definitely consume a large amount of resources.
-        // TODO: new plausible solution: query and store usernames of all following users in a set on the client side;
-        // use it to filter message stream locally.
-        window.setInterval(function(){
-            updateStream();
-        }, 5000);
-    }
+    // update stream in real-time using WebSocket
+    // Note: the following page used to poll the server every 5s instead, as checking whether every new grumble
+    // is made by an author followed by the current user required database searching. The server now subscribes
+    // the socket to the groups of the authors the user is following, and sends each new grumble to the
+    // interested sockets only.
+    updateStreamWS();
 
 
     // -- pass CSRF token in every POST request using jQuery ----------------------
@@ -0,0 +1,171 @@
+"""
+Sharded groups of the global stream sockets.
+
+Sending to a Channels group is one send per member, done one after the other by the
+channel layer; with every socket in a single group, publishing a message took time in
+proportion to the number of open sockets. The sockets are now spread over
+settings.GLOBAL_STREAM_SHARDS groups (global_stream-0, global_stream-1, ...), which are
+sent to in parallel by a pool of settings.GLOBAL_STREAM_PUBLISH_THREADS threads (the
+Redis channel layer also spreads the groups over its hosts, if it has several).
+
+A socket is assigned to a shard by consistent hashing of its reply channel name, so that
+changing the number of shards only moves about 1 / GLOBAL_STREAM_SHARDS of the sockets.
+
+Sockets whose disconnect never arrives (e.g. the interface server crashed) would stay in
+their group until the channel layer's group_expiry (a day) passes, costing a send to a dead
+channel on every publish. So the clients send a heartbeat frame every
+settings.GLOBAL_STREAM_HEARTBEAT seconds; each heartbeat adds the socket to its group again
+(moving it to a new shard, if the number of shards changed), and is recorded in the default
+cache for three heartbeats. The sockets without a recent heartbeat are pruned from each
+group at most every settings.GLOBAL_STREAM_PRUNE_INTERVAL seconds, after a publish. Pruning
+relies on every worker process seeing the heartbeats recorded by the others, so it's only
+done if settings.GLOBAL_STREAM_PRUNE is set (the default when the cache is shared, see
+CACHE_URL).
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.0.0
+"""
+import functools
+import hashlib
+import logging
+import threading
+import time
+from bisect import bisect
+from concurrent.futures import ThreadPoolExecutor
+
+from channels import Group
+from django.conf import settings
+from django.core.cache import cache
+
+from .metrics import metrics
+
+
+# for printing debugging info to console
+logger = logging.getLogger(__name__)
+
+# prefix of the names of the shard groups
+GROUP_PREFIX = 'global_stream'
+# number of points of each shard on the hash ring; more points spread the sockets more evenly
+RING_POINTS = 64
+# heartbeats are remembered for this many intervals, so that one late or lost heartbeat is fine
+HEARTBEAT_GRACE = 3
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+@functools.lru_cache(maxsize=4)
+def _ring(shards):
+    # (sorted points, the shard of each point) of a hash ring of the given number of shards
+    points = sorted((_hash('{0}-{1}'.format(shard, point)), shard)
+                    for shard in range(shards) for point in range(RING_POINTS))
+    return [point for point, _ in points], [shard for _, shard in points]
+
+
+def group_name(shard):
+    """
+    :return: the name of the group of a shard
+    """
+    return '{0}-{1}'.format(GROUP_PREFIX, shard)
+
+
+def shard_of(reply_channel):
+    """
+    :param reply_channel: the name of the reply channel of a socket
+    :return: the shard the socket belongs to: the first point on the ring after its hash
+    """
+    points, shards = _ring(settings.GLOBAL_STREAM_SHARDS)
+    return shards[bisect(points, _hash(reply_channel)) % len(points)]
+
+
+def _seen_key(reply_channel):
+    return 'global-stream-seen-{0}'.format(reply_channel)
+
+
+def add(reply_channel):
+    """
+    Add a socket to its shard, or refresh its membership on a heartbeat.
+
+    :param reply_channel: the reply channel of the socket
+    """
+    shard = shard_of(reply_channel.name)
+    # seen first, so that it's never pruned right after joining
+    cache.set(_seen_key(reply_channel.name), shard, settings.GLOBAL_STREAM_HEARTBEAT * HEARTBEAT_GRACE)
+    Group(group_name(shard)).add(reply_channel)
+
+
+def discard(reply_channel):
+    """
+    Remove a closed socket from its shard.
+
+    :param reply_channel: the reply channel of the socket
+    """
+    Group(group_name(shard_of(reply_channel.name))).discard(reply_channel)
+    cache.delete(_seen_key(reply_channel.name))
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.GLOBAL_STREAM_PUBLISH_THREADS,
+                                           thread_name_prefix='global-stream-publish')
+        return _executor
+
+
+def _send(shard, content):
+    try:
+        Group(group_name(shard)).send(content)
+    except Exception:
+        # the other shards still get it
+        logger.exception('Cannot publish to the global stream shard %d', shard)
+        metrics.inc('ws_group_send_errors_total', group=GROUP_PREFIX)
+
+
+def publish(content):
+    """
+    Send a frame to every socket of the global stream, to all the shards in parallel, and
+    prune the shards that are due (see the module docstring).
+
+    :param content: the content of the frame, e.g. {'text': ...}
+    """
+    start = time.perf_counter()
+    shards = range(settings.GLOBAL_STREAM_SHARDS)
+    if settings.GLOBAL_STREAM_PUBLISH_THREADS > 1 and len(shards) > 1:
+        # list() waits for all of them
+        list(_get_executor().map(functools.partial(_send, content=content), shards))
+    else:
+        for shard in shards:
+            _send(shard, content)
+    metrics.inc('ws_group_sends_total', len(shards), group=GROUP_PREFIX)
+    metrics.observe('ws_global_stream_publish_seconds', time.perf_counter() - start)
+
+    if settings.GLOBAL_STREAM_PRUNE:
+        for shard in shards:
+            # one process prunes a shard per interval
+            if cache.add('global-stream-pruned-{0}'.format(shard), True, settings.GLOBAL_STREAM_PRUNE_INTERVAL):
+                prune(shard)
+
+
+def prune(shard):
+    """
+    Remove the sockets without a recent heartbeat, and those that have moved to another shard,
+    from a shard.
+
+    :return: the number of sockets removed
+    """
+    group = Group(group_name(shard))
+    members = list(group.channel_layer.group_channels(group.name))
+    seen = cache.get_many([_seen_key(member) for member in members])
+    stale = [member for member in members if seen.get(_seen_key(member)) != shard]
+    for member in stale:
+        group.channel_layer.group_discard(group.name, member)
+
+    if stale:
+        logger.info('Pruned %d of %d sockets from %s', len(stale), len(members), group.name)
+        metrics.inc('ws_pruned_total', len(stale), group=GROUP_PREFIX)
+    return len(stale)
@@ -0,0 +1,164 @@
+"""
+Subscriptions of the following stream sockets, kept in the channel layer.
+
+Every WebSocket connected to the following stream joins the Channels group of each
+author its user is following (following-author-<author id>), so that a new message is
+delivered by one group send to the sockets interested in its author (see publish_messages
+in consumers.py), instead of being broadcast to everyone and filtered on the client, or
+searched for in the database by every client on a timer. It also joins the group of its
+user (following-user-<user id>), through which follow / unfollow changes find the open
+sockets of that user.
+
+The groups live in the channel layer (Redis in production), so every worker process sees
+the same subscriptions, whichever process a socket connected through or a follow was
+handled by, and they outlive restarts of the workers. Follow changes are applied once
+their transaction commits (see signals.py), so a rolled back follow changes nothing.
+
+Sockets whose disconnect never arrives would stay in their groups until the channel
+layer's group_expiry (a day) passes, so they're pruned by heartbeat the same way as the
+global stream sockets (see stream_shards.py): the clients send a heartbeat frame every
+settings.GLOBAL_STREAM_HEARTBEAT seconds, which subscribes the socket again and is recorded
+in the default cache for three heartbeats. After a publish, the sockets without a recent
+heartbeat are pruned from the group of the author at most every
+settings.GLOBAL_STREAM_PRUNE_INTERVAL seconds, and from the group of their user whenever
+its sockets are looked up; only if settings.GLOBAL_STREAM_PRUNE is set.
+
+The following page doesn't poll the API: it only fetches what it may have missed when its
+socket reconnects (see grumbles_control.js).
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 2.1.0
+"""
+import logging
+
+from channels import Group
+from django.conf import settings
+from django.core.cache import cache
+
+from . import follow_graph
+from .metrics import metrics
+from .stream_shards import HEARTBEAT_GRACE
+
+
+# for printing debugging info to console
+logger = logging.getLogger(__name__)
+
+
+def user_group(user_id):
+    """
+    :return: the name of the group of the following stream sockets of a user
+    """
+    return 'following-user-{0}'.format(user_id)
+
+
+def author_group(author_id):
+    """
+    :return: the name of the group of the following stream sockets subscribed to an author
+    """
+    return 'following-author-{0}'.format(author_id)
+
+
+def _seen_key(reply_channel):
+    return 'following-stream-seen-{0}'.format(reply_channel)
+
+
+def connect(reply_channel, user_id):
+    """
+    Subscribe a new socket to the users its user is following, or refresh its subscriptions
+    on a heartbeat.
+
+    :param reply_channel: the reply channel of the socket
+    :param user_id: id of the user who opened the socket
+    """
+    # seen first, so that it's never pruned right after joining
+    cache.set(_seen_key(reply_channel.name), user_id, settings.GLOBAL_STREAM_HEARTBEAT * HEARTBEAT_GRACE)
+    # join the user's group first, so that a follow committed while the authors are being
+    # looked up reaches this socket through follow()
+    Group(user_group(user_id)).add(reply_channel)
+    for author_id in follow_graph.following_ids(user_id):
+        Group(author_group(author_id)).add(reply_channel)
+
+
+def disconnect(reply_channel, user_id):
+    """
+    Remove a closed socket from its groups.
+
+    :param reply_channel: the reply channel of the socket
+    :param user_id: id of the user who opened the socket
+    """
+    Group(user_group(user_id)).discard(reply_channel)
+    for author_id in follow_graph.following_ids(user_id):
+        Group(author_group(author_id)).discard(reply_channel)
+    cache.delete(_seen_key(reply_channel.name))
+
+
+def _prune(group):
+    # remove the members without a recent heartbeat from a group; returns (live, stale) members
+    members = list(group.channel_layer.group_channels(group.name))
+    seen = cache.get_many([_seen_key(member) for member in members])
+    live = [member for member in members if _seen_key(member) in seen]
+    stale = [member for member in members if _seen_key(member) not in seen]
+    for member in stale:
+        group.channel_layer.group_discard(group.name, member)
+
+    if stale:
+        logger.info('Pruned %d of %d sockets from %s', len(stale), len(members), group.name)
+        metrics.inc('ws_pruned_total', len(stale), group='following')
+    return live, stale
+
+
+def _user_channels(user_id):
+    # names of the reply channels of the open following stream sockets of a user
+    group = Group(user_group(user_id))
+    if settings.GLOBAL_STREAM_PRUNE:
+        return _prune(group)[0]
+    return list(group.channel_layer.group_channels(group.name))
+
+
+def follow(user_id, author_ids):
+    """
+    Subscribe all the open sockets of a user to newly followed authors.
+
+    :param user_id: id of the follower
+    :param author_ids: ids of the newly followed users
+    """
+    for reply_channel in _user_channels(user_id):
+        for author_id in author_ids:
+            Group(author_group(author_id)).add(reply_channel)
+
+
+def unfollow(user_id, author_ids):
+    """
+    Unsubscribe all the open sockets of a user from unfollowed authors.
+
+    :param user_id: id of the follower
+    :param author_ids: ids of the unfollowed users
+    """
+    for reply_channel in _user_channels(user_id):
+        for author_id in author_ids:
+            Group(author_group(author_id)).discard(reply_channel)
+
+
+def publish(author_id, content):
+    """
+    Send a frame to the sockets subscribed to an author, and prune their group if it's due
+    (see the module docstring).
+
+    :param author_id: id of the author
+    :param content: the content of the frame, e.g. {'text': ...}
+    """
+    Group(author_group(author_id)).send(content)
+
+    # one process prunes a group per interval
+    if settings.GLOBAL_STREAM_PRUNE and \
+            cache.add('following-stream-pruned-{0}'.format(author_id), True, settings.GLOBAL_STREAM_PRUNE_INTERVAL):
+        prune(author_id)
+
+
+def prune(author_id):
+    """
+    Remove the sockets without a recent heartbeat from the group of an author.
+
+    :return: the number of sockets removed
+    """
+    return len(_prune(Group(author_group(author_id)))[1])
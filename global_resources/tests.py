@@ -1,3 +1,1665 @@
-from django.test import TestCase
+"""
+Tests of the shared backend (models, APIs, caches and stream plumbing).
 
-# Create your tests here.
+Run with: python manage.py test
+
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.0.0
+"""
+import base64
+import hashlib
+import io
+import json
+import os
+import shutil
+import smtplib
+import tempfile
+import threading
+import time
+from datetime import datetime
+from unittest import mock
+
+from channels import DEFAULT_CHANNEL_LAYER, Channel, channel_layers
+from channels.test import ChannelTestCase, WSClient
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+
+from . import (avatars, backends, broadcast, counters, follow_graph, global_window, outbox, profiling, querylog,
+               routers, stream_shards, subscriptions)
+from .consumers import publish_comments, publish_messages
+from .fragments import COMMENT_CARD, MESSAGE_CARD, get_cached_ids, get_card
+from .management.commands.send_outbox import wait_for_poke
+from .metrics import Registry, metrics
+from .middleware import PrimaryStickinessMiddleware
+from .models import Comment, Message, OutgoingEmail, RequestProfile, TimelineEntry, UserExtended
+from .paging import (DIRECTION_NEWER, DIRECTION_OLDER, InvalidCursor, decode_cursor, decode_id_cursor,
+                     encode_cursor, encode_id_cursor, keyset_page)
+from .ratelimit import client_ip, parse_rate, take_token
+from .serializers import comments_response, messages_response
+from .views import BULK_FOLLOW_LIMIT
+
+
+def make_user(username):
+    """
+    Create a user along with their extended profile, the way the registration page does.
+    """
+    user = User.objects.create_user(username, password='password', first_name=username.title(), last_name='Grumbler')
+    UserExtended.objects.create(user=user)
+    return user
+
+
+def make_messages(user, count):
+    """
+    :return: the ids of the new messages, oldest first
+    """
+    return [Message.objects.create(user=user, message='Grumble #{0}'.format(number)).id for number in range(count)]
+
+
+def read_json(response):
+    return json.loads(response.content.decode('utf-8'))
+
+
+def raw_cursor(raw):
+    # a cursor made up by the client
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip('=')
+
+
+class TempMediaMixin:
+    """
+    Runs the tests of a TestCase with an empty default cache, and with a throwaway MEDIA_ROOT
+    (holding a copy of the default avatar), so that the avatar thumbnails made for new users
+    don't end up in the real one.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp(prefix='grumblr-media-')
+        shutil.copytree(os.path.join(settings.MEDIA_ROOT, 'defaults'), os.path.join(cls.media_root, 'defaults'))
+        cls.media_override = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            super().tearDownClass()
+        finally:
+            cls.media_override.disable()
+            shutil.rmtree(cls.media_root, ignore_errors=True)
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+
+class GrumblrTestCase(TempMediaMixin, TestCase):
+    pass
+
+
+class GrumblrChannelTestCase(TempMediaMixin, ChannelTestCase):
+    pass
+
+
+class PagingTests(GrumblrTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user('pager')
+        make_messages(self.user, 25)
+        self.newest_first = list(Message.objects.order_by('-date', '-id').values_list('id', flat=True))
+
+    def test_cursor_round_trip(self):
+        date = datetime(2017, 10, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+        self.assertEqual(decode_cursor(encode_cursor(date, 42)), (date, 42))
+        self.assertEqual(decode_id_cursor(encode_id_cursor(42)), 42)
+        # usable in URLs as-is
+        self.assertNotIn('=', encode_cursor(date, 42))
+
+    def test_malformed_cursors(self):
+        for cursor in ('not a cursor', '!!!', encode_id_cursor(42)):
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(cursor)
+        with self.assertRaises(InvalidCursor):
+            decode_id_cursor('not a cursor')
+        with self.assertRaises(InvalidCursor):
+            keyset_page(Message.objects.all(), direction='sideways')
+
+    def test_out_of_range_cursors(self):
+        # past datetime.max, or ids that don't fit in the database
+        for raw in ('9' * 30 + '.1', '0.' + '9' * 30, '0.-1'):
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(raw_cursor(raw))
+        for raw in ('9' * 30, '-1'):
+            with self.assertRaises(InvalidCursor):
+                decode_id_cursor(raw_cursor(raw))
+
+    def test_walk_older(self):
+        ids, cursor, pages = [], None, 0
+        while True:
+            rows, cursor, _ = keyset_page(Message.objects.all(), cursor, DIRECTION_OLDER, size=10)
+            ids.extend(row.id for row in rows)
+            pages += 1
+            if cursor is None:
+                break
+        self.assertEqual(pages, 3)
+        self.assertEqual(ids, self.newest_first)
+
+    def test_walk_newer(self):
+        # from the oldest page back up to the newest, each page still sorted newest first
+        rows, _, _ = keyset_page(Message.objects.all(), None, DIRECTION_OLDER, size=20)
+        rows, _, _ = keyset_page(Message.objects.all(), encode_cursor(rows[-1].date, rows[-1].id), size=20)
+        self.assertEqual([row.id for row in rows], self.newest_first[20:])
+
+        rows, _, prev_cursor = keyset_page(Message.objects.all(), encode_cursor(rows[0].date, rows[0].id),
+                                           DIRECTION_NEWER, size=10)
+        # the rows closest to the cursor come first, so that nothing is skipped
+        self.assertEqual([row.id for row in rows], self.newest_first[10:20])
+        rows, _, prev_cursor = keyset_page(Message.objects.all(), prev_cursor, DIRECTION_NEWER, size=10)
+        self.assertEqual([row.id for row in rows], self.newest_first[:10])
+
+        # nothing newer yet: keep polling from the same spot
+        rows, next_cursor, same_cursor = keyset_page(Message.objects.all(), prev_cursor, DIRECTION_NEWER, size=10)
+        self.assertEqual((rows, same_cursor), ([], prev_cursor))
+        self.assertEqual(next_cursor, prev_cursor)
+
+    def test_paged_api(self):
+        self.client.force_login(self.user)
+        for url in ('/api/get-messages/global/page/', '/api/get-messages/profile/pager/page/'):
+            first = read_json(self.client.get(url))
+            second = read_json(self.client.get(url, {'cursor': first['next_cursor']}))
+            self.assertEqual([message['id'] for message in first['messages'] + second['messages']],
+                             self.newest_first)
+            self.assertIsNone(second['next_cursor'])
+
+    def test_paged_api_bad_requests(self):
+        self.client.force_login(self.user)
+        for url in ('/api/get-messages/global/page/', '/api/get-messages/follower/page/',
+                    '/api/get-messages/profile/pager/page/'):
+            for params in ({'cursor': 'not a cursor'}, {'cursor': raw_cursor('9' * 30 + '.1')},
+                           {'direction': 'sideways'}):
+                self.assertEqual(self.client.get(url, params).status_code, 400, (url, params))
+
+
+@override_settings(TIMELINE_FANOUT_LIMIT=2)
+class TimelineTests(GrumblrTestCase):
+    def setUp(self):
+        super().setUp()
+        self.reader, self.author, self.star = make_user('reader'), make_user('author'), make_user('star')
+        self.fans = [make_user('fan{0}'.format(number)) for number in range(2)]
+        # star has 3 followers, over the fan-out limit
+        for user in [self.reader] + self.fans:
+            user.ext.following.add(self.star)
+
+    def timeline(self, user):
+        return list(TimelineEntry.objects.filter(owner=user).order_by('-date', '-message_id')
+                    .values_list('message_id', flat=True))
+
+    def page_ids(self, user, cursor=None, direction=DIRECTION_OLDER, mrange=20):
+        messages, next_cursor, prev_cursor = TimelineEntry.get_page(user, cursor, direction, mrange)
+        return [message.id for message in messages], next_cursor, prev_cursor
+
+    def newest_first(self, *authors):
+        return list(Message.objects.filter(user__in=authors).order_by('-date', '-id').values_list('id', flat=True))
+
+    def test_fan_out_on_write(self):
+        self.reader.ext.following.add(self.author)
+        message_ids = make_messages(self.author, 2)
+        self.assertEqual(self.timeline(self.reader), list(reversed(message_ids)))
+        # not into the timelines of users who don't follow the author
+        self.assertEqual(self.timeline(self.fans[0]), [])
+
+    def test_no_fan_out_over_the_limit(self):
+        make_messages(self.star, 2)
+        self.assertEqual(TimelineEntry.objects.count(), 0)
+
+    def test_backfill_whole_history(self):
+        with self.settings(TIMELINE_BACKFILL_BATCH=3):
+            make_messages(self.author, 7)
+            self.reader.ext.following.add(self.author)
+        self.assertEqual(self.timeline(self.reader), self.newest_first(self.author))
+
+        # unfollowing takes them out again; following again doesn't duplicate anything
+        self.reader.ext.following.remove(self.author)
+        self.assertEqual(self.timeline(self.reader), [])
+        self.author.followed_by.add(self.reader.ext)
+        self.reader.ext.following.add(self.author)
+        self.assertEqual(self.timeline(self.reader), self.newest_first(self.author))
+
+    def test_merge_on_read(self):
+        self.reader.ext.following.add(self.author)
+        make_messages(self.author, 3)
+        make_messages(self.star, 4)
+        make_messages(self.author, 3)
+        expected = self.newest_first(self.author, self.star)
+
+        ids, next_cursor, _ = self.page_ids(self.reader, mrange=4)
+        self.assertEqual(ids, expected[:4])
+        ids, next_cursor, _ = self.page_ids(self.reader, next_cursor, mrange=4)
+        self.assertEqual(ids, expected[4:8])
+        ids, next_cursor, prev_cursor = self.page_ids(self.reader, next_cursor, mrange=4)
+        self.assertEqual((ids, next_cursor), (expected[8:], None))
+
+        # polling for newer messages from the newest page
+        _, _, prev_cursor = self.page_ids(self.reader, mrange=4)
+        new_ids = make_messages(self.star, 1) + make_messages(self.author, 1)
+        self.assertEqual(self.page_ids(self.reader, prev_cursor, DIRECTION_NEWER)[0], list(reversed(new_ids)))
+
+    def test_following_api(self):
+        self.reader.ext.following.add(self.author)
+        make_messages(self.author, 2)
+        make_messages(self.star, 2)
+        make_messages(make_user('stranger'), 2)
+        self.client.force_login(self.reader)
+        data = read_json(self.client.get('/api/get-messages/follower/page/'))
+        self.assertEqual([message['id'] for message in data['messages']], self.newest_first(self.author, self.star))
+
+    def test_backfill_when_dropping_under_the_limit(self):
+        # posted while star was merged on read only
+        message_ids = make_messages(self.star, 3)
+        self.assertEqual(self.timeline(self.reader), [])
+
+        self.fans[0].ext.following.remove(self.star)
+        for user in [self.reader, self.fans[1]]:
+            self.assertEqual(self.timeline(user), list(reversed(message_ids)))
+            self.assertEqual(self.page_ids(user)[0], list(reversed(message_ids)))
+        # not the follower who left
+        self.assertEqual(self.timeline(self.fans[0]), [])
+
+    def test_backfill_when_a_follower_is_deleted(self):
+        message_ids = make_messages(self.star, 2)
+        self.fans[0].delete()
+        self.assertEqual(self.timeline(self.reader), list(reversed(message_ids)))
+
+    def test_no_backfill_for_leaving_followers(self):
+        make_messages(self.star, 2)
+        self.star.followed_by.clear()
+        self.assertEqual(TimelineEntry.objects.count(), 0)
+
+
+class FragmentTests(GrumblrTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+        self.message = Message.objects.create(user=self.alice, message='Hello')
+        self.comment = Comment.objects.create(message=self.message, from_user=self.bob, content='Hi')
+        self.renders = []
+
+    def card(self, kind, pk):
+        def render():
+            self.renders.append((kind, pk))
+            return '<div>\n  <p>{0} {1}</p>\n</div>'.format(kind, pk)
+        return get_card(kind, pk, render)
+
+    def assertRerendered(self, *cards):
+        self.renders = []
+        for kind, pk in ((MESSAGE_CARD, self.message.pk), (COMMENT_CARD, self.comment.pk)):
+            self.card(kind, pk)
+        self.assertEqual(self.renders, list(cards))
+
+    def test_cached(self):
+        self.assertEqual(get_cached_ids(MESSAGE_CARD, [self.message.pk]), set())
+        # the indentation between tags is dropped once, when rendered
+        self.assertEqual(self.card(MESSAGE_CARD, self.message.pk),
+                         '<div><p>{0} {1}</p></div>'.format(MESSAGE_CARD, self.message.pk))
+        self.assertEqual(get_cached_ids(MESSAGE_CARD, [self.message.pk, self.message.pk + 1]), {self.message.pk})
+        self.assertRerendered((COMMENT_CARD, self.comment.pk))
+        self.assertRerendered()
+
+    def test_message_and_comment_changes(self):
+        self.assertRerendered((MESSAGE_CARD, self.message.pk), (COMMENT_CARD, self.comment.pk))
+        Comment.objects.create(message=self.message, from_user=self.alice, content='Hey')
+        # the message card embeds its comments
+        self.assertRerendered((MESSAGE_CARD, self.message.pk))
+
+        self.comment.content = 'Edited'
+        self.comment.save()
+        self.assertRerendered((MESSAGE_CARD, self.message.pk), (COMMENT_CARD, self.comment.pk))
+
+        self.comment.delete()
+        self.renders = []
+        self.card(MESSAGE_CARD, self.message.pk)
+        self.assertEqual(self.renders, [(MESSAGE_CARD, self.message.pk)])
+
+    def test_user_changes(self):
+        self.assertRerendered((MESSAGE_CARD, self.message.pk), (COMMENT_CARD, self.comment.pk))
+
+        # the comment card and the card of the message commented on show bob
+        self.bob.first_name = 'Robert'
+        self.bob.save()
+        self.assertRerendered((MESSAGE_CARD, self.message.pk), (COMMENT_CARD, self.comment.pk))
+
+        self.alice.last_name = 'Liddell'
+        self.alice.save(update_fields=['last_name'])
+        self.assertRerendered((MESSAGE_CARD, self.message.pk))
+
+    def test_rendered_cards(self):
+        self.assertIn('Hello', Message.objects.get(pk=self.message.pk).html)
+        self.assertIn('Bob', Comment.objects.get(pk=self.comment.pk).html)
+
+        self.bob.first_name = 'Robert'
+        self.bob.save()
+        message = Message.objects.get(pk=self.message.pk)
+        self.assertIn('Robert', message.html)
+        self.assertIn('Robert', Comment.objects.get(pk=self.comment.pk).html)
+
+    def test_changes_not_on_cards(self):
+        self.assertRerendered((MESSAGE_CARD, self.message.pk), (COMMENT_CARD, self.comment.pk))
+
+        self.bob.set_password('changed')
+        self.bob.save()
+        self.bob.save(update_fields=['last_login'])
+        self.bob.first_name = 'Robert'
+        self.bob.save(update_fields=['email'])  # the name isn't written
+        ext = UserExtended.objects.get(pk=self.bob.pk)
+        ext.hobby = 'Testing'
+        ext.save()
+        self.assertRerendered()
+
+    def test_avatar_changes(self):
+        self.assertRerendered((MESSAGE_CARD, self.message.pk), (COMMENT_CARD, self.comment.pk))
+        ext = UserExtended.objects.get(pk=self.bob.pk)
+        ext.avatar_webp = not ext.avatar_webp
+        ext.save()
+        self.assertRerendered((MESSAGE_CARD, self.message.pk), (COMMENT_CARD, self.comment.pk))
+
+
+class CardLoadingTests(GrumblrTestCase):
+    def setUp(self):
+        super().setUp()
+        self.authors = [make_user('author{0}'.format(number)) for number in range(8)]
+        for index, author in enumerate(self.authors):
+            message_id, = make_messages(author, 1)
+            # comments from several different users on each message
+            for commenter in self.authors[:index % 4 + 1]:
+                Comment.objects.create(message_id=message_id, from_user=commenter, content='Me too')
+
+    def count_queries(self, render):
+        cache.clear()
+        with CaptureQueriesContext(connection) as captured:
+            render()
+        return len(captured)
+
+    def render_messages(self, count):
+        def render():
+            messages = Message.load_cards(list(Message.objects.order_by('-date', '-id')[:count]))
+            return [message.html for message in messages]
+        return self.count_queries(render)
+
+    def render_comments(self, count):
+        def render():
+            comments = Comment.load_cards(list(Comment.objects.order_by('date', 'id')[:count]))
+            return [comment.html for comment in comments]
+        return self.count_queries(render)
+
+    def test_message_cards_take_constant_queries(self):
+        self.assertEqual(self.render_messages(2), self.render_messages(8))
+        # the page, the authors, their avatars, and the comments with their authors and avatars
+        self.assertEqual(self.render_messages(8), 4)
+
+    def test_comment_cards_take_constant_queries(self):
+        self.assertEqual(self.render_comments(2), self.render_comments(20))
+        # the page, the authors and their avatars
+        self.assertEqual(self.render_comments(20), 3)
+
+    def test_cached_cards_are_not_loaded(self):
+        messages = Message.load_cards(list(Message.objects.all()))
+        [message.html for message in messages]
+        with CaptureQueriesContext(connection) as captured:
+            messages = Message.load_cards(list(Message.objects.all()))
+            [message.html for message in messages]
+        # just the page itself
+        self.assertEqual(len(captured), 1)
+
+    def test_comments_on_cards_are_bounded(self):
+        message = Message.objects.get(user=self.authors[3])
+        for _ in range(5):
+            Comment.objects.create(message=message, from_user=self.authors[0], content='Again')
+        message, = Message.load_cards([Message.objects.get(pk=message.pk)], comments_range=3)
+        self.assertEqual([comment.id for comment in message.card_comments],
+                         list(Comment.objects.filter(message=message).order_by('date', 'id')
+                              .values_list('id', flat=True)[:3]))
+
+
+class SerializerTests(GrumblrTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+        for number, message_id in enumerate(make_messages(self.alice, 3) + make_messages(self.bob, 2)):
+            Comment.objects.create(message_id=message_id, from_user=self.bob, content='Re #{0}'.format(number))
+        self.client.force_login(self.alice)
+
+    def test_same_as_template(self):
+        messages = Message.load_cards(list(Message.objects.order_by('-date', '-id')))
+        last_updated = timezone.now().isoformat()
+        rendered = json.loads(render_to_string('messages_template.json',
+                                               {'messages': messages, 'last_updated': last_updated}), strict=False)
+        # the template only has the id and the card of each message
+        self.assertEqual(read_json(messages_response(messages, ('id', 'html'), last_updated=last_updated)),
+                         rendered)
+
+    def test_quotes_are_escaped(self):
+        Message.objects.create(user=self.alice, message='Say "cheese" \\o/')
+        data = read_json(self.client.get('/api/get-messages/global/page/'))
+        self.assertEqual(data['messages'][0]['text'], 'Say "cheese" \\o/')
+
+    def test_fields(self):
+        comment = Comment.objects.first()
+        data = read_json(comments_response([comment], ('id', 'author', 'text'), message_id=comment.message_id))
+        self.assertEqual(data, {'message_id': comment.message_id,
+                                'comments': [{'id': comment.id, 'author': 'bob', 'text': comment.content}]})
+
+        data = read_json(self.client.get('/api/get-messages/global/page/', {'fields': 'date,id'}))
+        self.assertEqual(set(data['messages'][0]), {'id', 'date'})
+        self.assertEqual(self.client.get('/api/get-messages/global/page/', {'fields': 'id,nope'}).status_code, 400)
+
+    @override_settings(QUERY_COUNT_HEADER=True)
+    def test_query_count_header_is_exact(self):
+        message = Message.objects.filter(user=self.alice).first()
+        for url in ('/api/get-messages/global/page/', '/api/get-comments/{0}/'.format(message.id)):
+            # cold and warm card cache: the header includes the queries of the cards rendered
+            for _ in range(2):
+                with CaptureQueriesContext(connection) as captured:
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(int(response['X-Query-Count']), len(captured), url)
+
+
+class FollowingStreamTests(GrumblrChannelTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob, self.carol = make_user('alice'), make_user('bob'), make_user('carol')
+        self.socket = Channel('websocket.send.alice')
+
+    def members(self, group):
+        return set(channel_layers[DEFAULT_CHANNEL_LAYER].group_channels(group))
+
+    def test_subscriptions(self):
+        self.alice.ext.following.add(self.bob)
+        subscriptions.connect(self.socket, self.alice.pk)
+        self.assertEqual(self.members(subscriptions.author_group(self.bob.pk)), {self.socket.name})
+        self.assertEqual(self.members(subscriptions.author_group(self.carol.pk)), set())
+
+        # as the commit hooks of the follow changes would (see signals.py)
+        self.alice.ext.following.add(self.carol)
+        subscriptions.follow(self.alice.pk, [self.carol.pk])
+        self.alice.ext.following.remove(self.bob)
+        subscriptions.unfollow(self.alice.pk, [self.bob.pk])
+        self.assertEqual(self.members(subscriptions.author_group(self.bob.pk)), set())
+        self.assertEqual(self.members(subscriptions.author_group(self.carol.pk)), {self.socket.name})
+
+        subscriptions.publish(self.carol.pk, {'text': 'new'})
+        self.assertEqual(self.get_next_message(self.socket.name, require=True).content, {'text': 'new'})
+        subscriptions.publish(self.bob.pk, {'text': 'new'})
+        self.assertIsNone(self.get_next_message(self.socket.name))
+
+        subscriptions.disconnect(self.socket, self.alice.pk)
+        self.assertEqual(self.members(subscriptions.author_group(self.carol.pk)), set())
+        self.assertEqual(self.members(subscriptions.user_group(self.alice.pk)), set())
+
+    @override_settings(GLOBAL_STREAM_PRUNE=True)
+    def test_sockets_without_heartbeat_are_pruned(self):
+        self.alice.ext.following.add(self.bob)
+        dead = Channel('websocket.send.alice-dead')
+        subscriptions.connect(self.socket, self.alice.pk)
+        subscriptions.connect(dead, self.alice.pk)
+
+        # the heartbeats of the dead socket run out; the other one keeps beating
+        cache.delete('following-stream-seen-{0}'.format(dead.name))
+        subscriptions.connect(self.socket, self.alice.pk)
+
+        subscriptions.publish(self.bob.pk, {'text': 'new'})
+        self.assertEqual(self.members(subscriptions.author_group(self.bob.pk)), {self.socket.name})
+        # pruned once per interval
+        subscriptions.connect(dead, self.alice.pk)
+        cache.delete('following-stream-seen-{0}'.format(dead.name))
+        subscriptions.publish(self.bob.pk, {'text': 'new'})
+        self.assertIn(dead.name, self.members(subscriptions.author_group(self.bob.pk)))
+        self.assertEqual(subscriptions.prune(self.bob.pk), 1)
+
+        # follow changes skip the dead sockets of the user, and drop them from the user's group
+        subscriptions.follow(self.alice.pk, [self.carol.pk])
+        self.assertEqual(self.members(subscriptions.author_group(self.carol.pk)), {self.socket.name})
+        self.assertEqual(self.members(subscriptions.user_group(self.alice.pk)), {self.socket.name})
+
+    def test_heartbeat_frames(self):
+        self.alice.ext.following.add(self.bob)
+        client = WSClient()
+        client.force_login(self.alice)
+        client.send_and_consume('websocket.connect', path='/api/get-messages-stream/following/')
+        self.assertEqual(client.receive(), None)  # accepted
+        self.assertEqual(self.members(subscriptions.author_group(self.bob.pk)), {client.reply_channel})
+
+        key = 'following-stream-seen-{0}'.format(client.reply_channel)
+        cache.delete(key)
+        client.send_and_consume('websocket.receive', {'text': json.dumps({'type': 'heartbeat'})},
+                                path='/api/get-messages-stream/following/')
+        self.assertEqual(cache.get(key), self.alice.pk)
+
+        # anything else is ignored
+        cache.delete(key)
+        client.send_and_consume('websocket.receive', {'text': 'not json'}, path='/api/get-messages-stream/following/')
+        self.assertIsNone(cache.get(key))
+
+
+@override_settings(GLOBAL_STREAM_SHARDS=1, GLOBAL_STREAM_PRUNE=False)
+class BroadcastTests(GrumblrChannelTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+        self.reader = Channel('websocket.send.reader')
+        stream_shards.add(self.reader)
+
+    def publish(self):
+        # as the worker would, for the first queued message
+        publish_messages(self.get_next_message(broadcast.QUEUE_CHANNEL, require=True))
+
+    def frame(self):
+        return json.loads(self.get_next_message(self.reader.name, require=True).content['text'])
+
+    def test_batched(self):
+        message_ids = make_messages(self.alice, 3)
+        # as the commit hooks of Message.save() would
+        for message_id in message_ids:
+            broadcast.enqueue(message_id)
+        self.publish()
+
+        # everything queued up goes out in one frame, oldest first
+        self.assertEqual([message['id'] for message in self.frame()['messages']], message_ids)
+        self.assertIsNone(self.get_next_message(self.reader.name))
+        self.assertIsNone(self.get_next_message(broadcast.QUEUE_CHANNEL))
+
+    @override_settings(BROADCAST_BATCH_SIZE=2)
+    def test_batch_size(self):
+        message_ids = make_messages(self.alice, 3)
+        for message_id in message_ids:
+            broadcast.enqueue(message_id)
+        self.publish()
+        self.assertEqual([message['id'] for message in self.frame()['messages']], message_ids[:2])
+        self.publish()
+        self.assertEqual([message['id'] for message in self.frame()['messages']], message_ids[2:])
+
+    def test_deleted_messages_are_skipped(self):
+        message_ids = make_messages(self.alice, 2)
+        for message_id in message_ids:
+            broadcast.enqueue(message_id)
+        Message.objects.filter(id=message_ids[0]).delete()
+        self.publish()
+        self.assertEqual([message['id'] for message in self.frame()['messages']], message_ids[1:])
+
+    def test_full_queue_drops(self):
+        capacity = channel_layers[DEFAULT_CHANNEL_LAYER].channel_layer.capacity
+        dropped = metrics.get('broadcast_dropped_total', queue='messages') or 0
+        message_id, = make_messages(self.alice, 1)
+        # doesn't raise, e.g. in the commit hook of a request whose message is already saved
+        with self.assertLogs('global_resources.broadcast', 'WARNING'):
+            for _ in range(capacity + 2):
+                broadcast.enqueue(message_id)
+        self.assertEqual(metrics.get('broadcast_dropped_total', queue='messages'), dropped + 2)
+
+
+class CommentStreamTests(GrumblrChannelTestCase):
+    path = '/api/get-comments-stream/'
+
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+        self.message_ids = make_messages(self.alice, 3)
+        self.client = WSClient()
+        self.client.force_login(self.alice)
+        self.client.send_and_consume('websocket.connect', path=self.path)
+        self.client.receive()
+
+    def subscribe(self, **request):
+        self.client.send_and_consume('websocket.receive', {'text': json.dumps(request)}, path=self.path)
+
+    def comment(self, message_id):
+        comment = Comment.objects.create(message_id=message_id, from_user=self.alice, content='Hi')
+        # as the commit hook of Comment.save() would
+        broadcast.enqueue_comment(comment.id)
+        return comment.id
+
+    def test_subscriptions(self):
+        self.subscribe(subscribe=self.message_ids[:2])
+        first, second = self.comment(self.message_ids[0]), self.comment(self.message_ids[0])
+        self.comment(self.message_ids[2])
+        publish_comments(self.get_next_message(broadcast.COMMENT_QUEUE_CHANNEL, require=True))
+
+        # one frame for the subscribed message, with both of its comments
+        self.assertEqual([comment['id'] for comment in self.client.receive()['comments']], [first, second])
+        self.assertIsNone(self.client.receive())
+
+        self.subscribe(unsubscribe=self.message_ids[:1])
+        self.comment(self.message_ids[0])
+        publish_comments(self.get_next_message(broadcast.COMMENT_QUEUE_CHANNEL, require=True))
+        self.assertIsNone(self.client.receive())
+
+    @override_settings(COMMENT_SUBSCRIPTIONS_PER_SOCKET=2)
+    def test_subscription_limit(self):
+        self.subscribe(subscribe=self.message_ids)
+        self.assertEqual(self.client.receive()['rejected'], self.message_ids[2:])
+
+    def test_malformed_requests(self):
+        self.subscribe(subscribe=['not an id'])
+        self.assertIn('error', self.client.receive())
+
+
+class CounterTests(GrumblrTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob, self.carol = make_user('alice'), make_user('bob'), make_user('carol')
+
+    def counts(self, user):
+        return UserExtended.objects.values_list('message_count', 'follower_count', 'following_count').get(pk=user.pk)
+
+    def test_follow_counters(self):
+        self.alice.ext.following.add(self.bob, self.carol)
+        self.alice.ext.following.add(self.bob)  # already followed
+        self.assertEqual(self.counts(self.alice), (0, 0, 2))
+        self.assertEqual(self.counts(self.bob), (0, 1, 0))
+
+        # from the other side of the relation
+        self.bob.followed_by.add(self.carol.ext)
+        self.assertEqual(self.counts(self.bob), (0, 2, 0))
+        self.assertEqual(self.counts(self.carol), (0, 1, 1))
+
+        self.alice.ext.following.remove(self.bob, self.bob)
+        self.alice.ext.following.remove(self.bob)  # not followed any more
+        self.assertEqual(self.counts(self.alice), (0, 0, 1))
+        self.assertEqual(self.counts(self.bob), (0, 1, 0))
+
+        self.carol.followed_by.clear()
+        self.assertEqual(self.counts(self.alice), (0, 0, 0))
+        self.assertEqual(self.counts(self.carol), (0, 0, 1))
+
+        # the relations of a deleted user go away by cascade
+        self.carol.delete()
+        self.assertEqual(self.counts(self.bob), (0, 0, 0))
+
+    def test_message_and_comment_counters(self):
+        message = Message.objects.create(user=self.alice, message='Hello')
+        Message.objects.create(user=self.alice, message='Again')
+        comment = Comment.objects.create(message=message, from_user=self.bob, content='Hi')
+        Comment.objects.create(message=message, from_user=self.carol, content='Hey')
+        self.assertEqual(self.counts(self.alice)[0], 2)
+        self.assertEqual(Message.objects.get(pk=message.pk).comment_count, 2)
+
+        comment.delete()
+        message.refresh_from_db()
+        self.assertEqual(message.comment_count, 1)
+        message.delete()
+        self.assertEqual(self.counts(self.alice)[0], 1)
+
+    def test_stale_instance_keeps_counters(self):
+        ext = UserExtended.objects.get(pk=self.alice.pk)
+        Message.objects.create(user=self.alice, message='Hello')
+        ext.hobby = 'Testing'
+        ext.save()
+        self.assertEqual(self.counts(self.alice)[0], 1)
+
+    def test_reconcile(self):
+        message = Message.objects.create(user=self.alice, message='Hello')
+        Comment.objects.create(message=message, from_user=self.bob, content='Hi')
+        self.alice.ext.following.add(self.bob)
+        # updates that send no signals
+        UserExtended.objects.filter(pk__in=[self.alice.pk, self.carol.pk]).update(message_count=7)
+        UserExtended.objects.filter(pk=self.bob.pk).update(follower_count=0)
+        Message.objects.update(comment_count=0)
+
+        expected = [('UserExtended', 'message_count', 2), ('UserExtended', 'follower_count', 1),
+                    ('UserExtended', 'following_count', 0), ('Message', 'comment_count', 1)]
+        self.assertEqual(counters.reconcile(dry_run=True), expected)
+        self.assertEqual(self.counts(self.carol)[0], 7)
+
+        # one row per batch, so that every batch boundary is crossed
+        self.assertEqual(counters.reconcile(batch_size=1), expected)
+        self.assertEqual(self.counts(self.alice), (1, 0, 1))
+        self.assertEqual(self.counts(self.bob), (0, 1, 0))
+        self.assertEqual(self.counts(self.carol), (0, 0, 0))
+        self.assertEqual(Message.objects.get(pk=message.pk).comment_count, 1)
+        self.assertEqual([drifted for _, _, drifted in counters.reconcile()], [0, 0, 0, 0])
+
+
+class ConditionalGetTests(GrumblrTestCase):
+    """
+    Changes reach the global window and its version stamp once they commit, which never happens
+    within a TestCase; global_window.add / discard / refresh are called as the commit hooks would.
+    """
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+        self.message_ids = make_messages(self.alice, 3)
+        self.client.force_login(self.alice)
+
+    def assertNotModified(self, url, modify=None, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        if modify is not None:
+            modify()
+            self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code, 200, url)
+
+    def test_global(self):
+        def post():
+            message_id, = make_messages(self.alice, 1)
+            global_window.add(message_id)
+        self.assertNotModified('/api/get-messages/global/page/', post)
+        self.assertNotModified('/api/get-messages/global/', post)
+        # the tag is per request path
+        self.assertNotModified('/api/get-messages/global/page/', post, fields='id')
+
+    @override_settings(GLOBAL_WINDOW_SIZE=2)
+    def test_global_changes_outside_the_window(self):
+        def delete():
+            # the oldest one, out of the window
+            Message.objects.filter(id=self.message_ids[0]).delete()
+            global_window.discard(self.message_ids[0])
+        self.assertNotModified('/api/get-messages/global/', delete)
+
+        def comment():
+            Comment.objects.create(message_id=self.message_ids[1], from_user=self.alice, content='Hi')
+            global_window.refresh(self.message_ids[1])
+        self.assertNotModified('/api/get-messages/global/', comment)
+
+    def test_profile_and_comments(self):
+        self.assertNotModified('/api/get-messages/profile/alice/page/',
+                               lambda: make_messages(self.alice, 1))
+        self.assertNotModified('/api/get-comments/{0}/'.format(self.message_ids[0]),
+                               lambda: Comment.objects.create(message_id=self.message_ids[0], from_user=self.alice,
+                                                              content='Hi'))
+
+    def test_errors_are_not_tagged(self):
+        for url, params in (('/api/get-messages/global/page/', {'cursor': 'not a cursor'}),
+                            ('/api/get-messages/global/page/', {'fields': 'nope'}),
+                            ('/api/get-comments/{0}/'.format(self.message_ids[0]), {'fields': 'nope'})):
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 400)
+            self.assertFalse(response.has_header('ETag'), (url, params))
+
+
+@override_settings(GLOBAL_WINDOW_ENABLED=True, GLOBAL_WINDOW_SIZE=10)
+class GlobalWindowTests(GrumblrTestCase):
+    """
+    The window is updated once the changes commit, which never happens within a TestCase;
+    add / discard / refresh are called as the commit hooks would.
+    """
+    def setUp(self):
+        super().setUp()
+        self.user = make_user('windowed')
+
+    def newest_first(self):
+        return list(Message.objects.order_by('-date', '-id').values_list('id', flat=True))
+
+    def page_ids(self, *args, **kwargs):
+        page = global_window.get_page(*args, **kwargs)
+        return None if page is None else [message.id for message in page[0]]
+
+    def test_complete_window(self):
+        make_messages(self.user, 5)
+        self.assertEqual(self.page_ids(size=3), self.newest_first()[:3])
+        # the window holds every message, so the page past its end is known to be short
+        self.assertEqual(self.page_ids(size=20), self.newest_first())
+        self.assertTrue(cache.get(global_window.WINDOW_KEY)['complete'])
+
+    def test_pages_past_the_window(self):
+        make_messages(self.user, 15)
+        newest_first = self.newest_first()
+        self.assertEqual(self.page_ids(size=5), newest_first[:5])
+        self.assertIsNone(self.page_ids(size=20))
+
+        messages, next_cursor, _ = global_window.get_page(size=5)
+        self.assertEqual(self.page_ids(next_cursor, size=4), newest_first[5:9])
+        self.assertIsNone(self.page_ids(next_cursor, size=5))
+        # either way, the model method gets the page right
+        self.assertEqual([message.id for message in Message.get_all_paged(next_cursor, mrange=5)[0]],
+                         newest_first[5:10])
+        self.assertEqual([message.id for message in Message.get_all_paged(next_cursor, mrange=20)[0]],
+                         newest_first[5:])
+
+    def test_add_and_discard(self):
+        make_messages(self.user, 3)
+        self.page_ids()
+        version = global_window.get_version()
+
+        message_id, = make_messages(self.user, 1)
+        global_window.add(message_id)
+        self.assertEqual(self.page_ids()[0], message_id)
+        self.assertEqual(len(cache.get(global_window.WINDOW_KEY)['rows']), 4)
+        self.assertNotEqual(global_window.get_version(), version)
+
+        version = global_window.get_version()
+        Message.objects.filter(pk=message_id).delete()
+        global_window.discard(message_id)
+        self.assertEqual(self.page_ids(), self.newest_first())
+        self.assertNotEqual(global_window.get_version(), version)
+
+    def test_window_stays_bounded(self):
+        make_messages(self.user, 10)
+        self.page_ids()
+        for message_id in make_messages(self.user, 3):
+            global_window.add(message_id)
+        window = cache.get(global_window.WINDOW_KEY)
+        self.assertEqual([row['id'] for row in window['rows']], self.newest_first()[:10])
+        self.assertFalse(window['complete'])
+
+    def test_refresh(self):
+        message_id, = make_messages(self.user, 1)
+        self.page_ids()
+        version = global_window.get_version()
+        Comment.objects.create(message_id=message_id, from_user=self.user, content='Hi')
+        global_window.refresh(message_id)
+        self.assertEqual(cache.get(global_window.WINDOW_KEY)['rows'][0]['comment_count'], 1)
+        self.assertNotEqual(global_window.get_version(), version)
+
+    def test_newer_pages(self):
+        make_messages(self.user, 3)
+        _, _, prev_cursor = global_window.get_page()
+        message_ids = make_messages(self.user, 2)
+        for message_id in message_ids:
+            global_window.add(message_id)
+        self.assertEqual(self.page_ids(prev_cursor, DIRECTION_NEWER), list(reversed(message_ids)))
+
+    def test_single_flight_fill(self):
+        window = {'rows': [], 'complete': True}
+
+        def slow_fill():
+            time.sleep(0.05)
+            return window
+
+        # all of them miss the window at once; only the one taking the lock reads the database
+        barrier = threading.Barrier(8)
+        results = []
+
+        def read():
+            barrier.wait()
+            results.append(global_window.get_window())
+
+        with mock.patch.object(global_window, '_fill', side_effect=slow_fill) as fill:
+            threads = [threading.Thread(target=read) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(fill.call_count, 1)
+        self.assertEqual(results, [window] * 8)
+
+    def test_updates_do_not_wait_for_the_lock(self):
+        make_messages(self.user, 3)
+        self.page_ids()
+        message_id, = make_messages(self.user, 1)
+        # held by a fill in another process
+        cache.add(global_window.LOCK_KEY, 'someone else', global_window.LOCK_TIMEOUT)
+        start = time.perf_counter()
+        global_window.add(message_id)
+        self.assertLess(time.perf_counter() - start, settings.GLOBAL_WINDOW_WAIT)
+        # dropped, to be filled again by the next read
+        self.assertIsNone(cache.get(global_window.WINDOW_KEY))
+
+    def test_fill_racing_an_update_is_dropped(self):
+        make_messages(self.user, 3)
+        fill = global_window._fill
+
+        def racing_fill():
+            window = fill()
+            # a message committed after the rows have been read, updating the window during the fill
+            message_id, = make_messages(self.user, 1)
+            global_window.add(message_id)
+            return window
+
+        with mock.patch.object(global_window, '_fill', side_effect=racing_fill):
+            self.assertEqual(len(global_window.get_window()['rows']), 3)
+        self.assertIsNone(cache.get(global_window.WINDOW_KEY))
+        self.assertEqual(len(global_window.get_window()['rows']), 4)
+
+    @override_settings(GLOBAL_WINDOW_ENABLED=False)
+    def test_disabled_without_a_shared_cache(self):
+        make_messages(self.user, 3)
+        self.assertIsNone(global_window.get_window())
+        self.assertIsNone(global_window.get_page())
+        global_window.add(self.newest_first()[0])
+        self.assertIsNone(cache.get(global_window.WINDOW_KEY))
+        # served from the database instead
+        self.assertEqual([message.id for message in Message.get_all_paged()[0]], self.newest_first())
+
+
+class AvatarTests(GrumblrTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+
+    @staticmethod
+    def image(color, size=(300, 200)):
+        buffer = io.BytesIO()
+        Image.new('RGBA', size, color).save(buffer, 'PNG')
+        return buffer.getvalue()
+
+    def upload(self, user, data):
+        ext = UserExtended.objects.get(pk=user.pk)
+        ext.avatar = SimpleUploadedFile('avatar.png', data, content_type='image/png')
+        ext.save()
+        return UserExtended.objects.get(pk=user.pk)
+
+    def test_thumbnails(self):
+        data = self.image((255, 0, 0, 128))
+        ext = self.upload(self.alice, data)
+        self.assertEqual(ext.avatar_hash, hashlib.sha256(data).hexdigest()[:avatars.HASH_LENGTH])
+        self.assertEqual(ext.avatar_webp, avatars.WEBP_SUPPORTED)
+
+        for size_name, pixels in settings.AVATAR_SIZES.items():
+            # square, whatever the shape of the original
+            with default_storage.open(avatars.thumbnail_name(ext.avatar_hash, size_name, 'jpg')) as thumbnail:
+                self.assertEqual(Image.open(thumbnail).size, (pixels, pixels))
+            self.assertEqual(ext.avatar_url(size_name),
+                             '{0}avatars/{1}/{2}.jpg'.format(settings.MEDIA_URL, ext.avatar_hash, size_name))
+        self.assertIn(ext.avatar_url('card'), ext.avatar_html('card'))
+        self.assertEqual(ext.avatar_url('card', 'webp') in ext.avatar_html('card'), avatars.WEBP_SUPPORTED)
+
+    def test_content_hash_urls(self):
+        first = self.upload(self.alice, self.image((0, 128, 0, 255)))
+        # the same image is stored once, under the same URLs
+        with mock.patch.object(default_storage, 'save', wraps=default_storage.save) as save:
+            second = self.upload(self.bob, self.image((0, 128, 0, 255)))
+        self.assertEqual(second.avatar_url('card'), first.avatar_url('card'))
+        self.assertFalse([call for call in save.call_args_list if call[0][0].startswith('avatars/')])
+
+        # a new image gets new URLs, so that the old ones can be cached forever
+        third = self.upload(self.alice, self.image((0, 0, 255, 255)))
+        self.assertNotEqual(third.avatar_url('card'), first.avatar_url('card'))
+
+    def test_undecodable_avatar(self):
+        with self.assertLogs('global_resources.models', 'WARNING'):
+            ext = self.upload(self.alice, b'not an image')
+        self.assertEqual(ext.avatar_hash, '')
+        # the original is served instead
+        self.assertEqual(ext.avatar_url('card'), ext.avatar.url)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                   OUTBOX_BATCH_SIZE=2, OUTBOX_RETRY_DELAY=30, OUTBOX_MAX_ATTEMPTS=3, OUTBOX_LEASE=300)
+class OutboxTests(GrumblrChannelTestCase):
+    def queue(self, count):
+        return [outbox.queue_mail('Hello #{0}'.format(number), 'Body', 'admin@grumblr.com',
+                                  ['user{0}@example.com'.format(number)]) for number in range(count)]
+
+    def make_due(self):
+        OutgoingEmail.objects.update(next_attempt=timezone.now())
+
+    def test_send_in_batches(self):
+        self.queue(5)
+        self.assertEqual(outbox.send_pending(), (5, 0))
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         ['user{0}@example.com'.format(number) for number in range(5)])
+        self.assertEqual(OutgoingEmail.objects.filter(status=OutgoingEmail.STATUS_SENT).count(), 5)
+        # sent once only
+        self.assertEqual(outbox.send_pending(), (0, 0))
+
+    def test_claimed_emails_are_hidden(self):
+        self.queue(3)
+        claimed = outbox._claim(2)
+        self.assertEqual(len(claimed), 2)
+        self.assertTrue(all(email.next_attempt > timezone.now() for email in claimed))
+        # another worker only gets the rest
+        self.assertEqual([email.id for email in outbox._claim(2)],
+                         list(OutgoingEmail.objects.exclude(id__in=[email.id for email in claimed])
+                              .values_list('id', flat=True)))
+        self.assertEqual(outbox._claim(2), [])
+
+    def test_retry_with_backoff(self):
+        email, = self.queue(1)
+        rejected = smtplib.SMTPDataError(554, 'Rejected')
+        with mock.patch.object(outbox, '_send', side_effect=rejected):
+            self.assertEqual(outbox.send_pending(), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts, email.claim), (OutgoingEmail.STATUS_PENDING, 1, ''))
+        self.assertIn('Rejected', email.last_error)
+        self.assertAlmostEqual((email.next_attempt - timezone.now()).total_seconds(), 30, delta=5)
+        # not due yet
+        self.assertEqual(outbox.send_pending(), (0, 0))
+
+        # the delay doubles after every failed attempt
+        self.assertEqual([outbox._backoff(attempts) for attempts in (1, 2, 3)], [30, 60, 120])
+        self.make_due()
+        with mock.patch.object(outbox, '_send', side_effect=rejected):
+            outbox.send_pending()
+        email.refresh_from_db()
+        self.assertAlmostEqual((email.next_attempt - timezone.now()).total_seconds(), 60, delta=5)
+
+        self.make_due()
+        self.assertEqual(outbox.send_pending(), (1, 0))
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutgoingEmail.STATUS_SENT)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_give_up(self):
+        email, = self.queue(1)
+        with self.assertLogs('global_resources.outbox', 'ERROR'):
+            for _ in range(3):
+                self.make_due()
+                with mock.patch.object(outbox, '_send', side_effect=smtplib.SMTPDataError(554, 'Rejected')):
+                    outbox.send_pending()
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutgoingEmail.STATUS_FAILED, 3))
+        self.make_due()
+        self.assertEqual(outbox.send_pending(), (0, 0))
+
+    def test_unreachable_server(self):
+        first, second, third = self.queue(3)
+        with mock.patch.object(outbox, '_send', side_effect=ConnectionRefusedError('Connection refused')), \
+                self.assertLogs('global_resources.outbox', 'WARNING'):
+            self.assertEqual(outbox.send_pending(), (0, 1))
+        # only the email being sent counts an attempt; the rest of its batch is put back
+        attempts = dict(OutgoingEmail.objects.values_list('id', 'attempts'))
+        self.assertEqual([attempts[first.id], attempts[second.id], attempts[third.id]], [1, 0, 0])
+        self.assertFalse(OutgoingEmail.objects.exclude(claim='').exists())
+
+        self.make_due()
+        self.assertEqual(outbox.send_pending(), (3, 0))
+
+    def test_poke(self):
+        channel_layer = channel_layers[DEFAULT_CHANNEL_LAYER]
+        self.assertFalse(wait_for_poke(channel_layer, 0))
+        outbox.poke()
+        outbox.poke()
+        self.assertTrue(wait_for_poke(channel_layer, 0))
+        # the pokes that piled up are dropped along with the first one
+
+    def test_sent_by_the_mailer_only(self):
+        # the pokes are left to the `mailer` process; the workers serving the pages don't consume them
+        self.assertNotIn(outbox.OUTBOX_CHANNEL, channel_layers[DEFAULT_CHANNEL_LAYER].router.channels)
+
+
+class CachedModelBackendTests(GrumblrTestCase):
+    def setUp(self):
+        super().setUp()
+        backends._users.clear()
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+        self.backend = backends.CachedModelBackend()
+
+    def assertReloaded(self, reloaded=True):
+        with CaptureQueriesContext(connection) as captured:
+            user = self.backend.get_user(self.alice.pk)
+        self.assertEqual(len(captured), 1 if reloaded else 0)
+        return user
+
+    def test_remembered(self):
+        user = self.assertReloaded()
+        self.assertEqual(user.ext.pk, self.alice.pk)
+        # along with their UserExtended, and as a copy of its own
+        user.first_name = 'Changed'
+        copy = self.assertReloaded(False)
+        self.assertEqual((copy.first_name, copy.ext.pk), ('Alice', self.alice.pk))
+
+    def test_changes(self):
+        self.assertReloaded()
+        self.alice.first_name = 'Alicia'
+        self.alice.save()
+        self.assertEqual(self.assertReloaded().first_name, 'Alicia')
+
+        ext = UserExtended.objects.get(pk=self.alice.pk)
+        ext.hobby = 'Testing'
+        ext.save()
+        self.assertEqual(self.assertReloaded().ext.hobby, 'Testing')
+
+        # counters are updated in bulk, without saving the row
+        self.alice.ext.following.add(self.bob)
+        self.assertEqual(self.assertReloaded().ext.following_count, 1)
+        self.assertReloaded(False)
+
+    def test_changes_in_another_process(self):
+        self.assertReloaded()
+        # as a process sharing the cache would, after changing the user
+        cache.set('auth-user-version-{0}'.format(self.alice.pk), 'changed elsewhere', None)
+        self.assertReloaded()
+        self.assertReloaded(False)
+
+    def test_logout(self):
+        self.client.force_login(self.alice)
+        self.assertReloaded()
+        self.client.logout()
+        self.assertReloaded()
+
+    @override_settings(AUTH_USER_CACHE_TIMEOUT=0)
+    def test_expiry(self):
+        self.assertReloaded()
+        self.assertReloaded()
+
+    @override_settings(AUTH_USER_CACHE_SIZE=1)
+    def test_bounded(self):
+        self.assertReloaded()
+        self.backend.get_user(self.bob.pk)
+        self.assertEqual(list(backends._users), [self.bob.pk])
+
+    def test_inactive_users(self):
+        User.objects.filter(pk=self.alice.pk).update(is_active=False)
+        self.assertIsNone(self.backend.get_user(self.alice.pk))
+        self.assertIsNone(self.backend.get_user(0))
+
+
+class MetricsTests(GrumblrChannelTestCase):
+    """
+    A ChannelTestCase, so that /metrics reads the queue depths from the in-memory channel layer.
+    """
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+
+    def test_registry(self):
+        registry = Registry()
+        registry.inc('requests_total', view='a')
+        registry.inc('requests_total', 2, view='a')
+        registry.set_gauge('depth', 5)
+        registry.add_gauge('depth', -2)
+        for value in (0.003, 0.2, 20):
+            registry.observe('latency_seconds', value, buckets=(0.01, 1.0), view='a "quoted"\nview')
+        self.assertEqual(registry.get('requests_total', view='a'), 3)
+        self.assertEqual(registry.get('depth'), 3)
+        self.assertIsNone(registry.get('requests_total', view='b'))
+
+        self.assertEqual(registry.render().splitlines(), [
+            '# TYPE depth gauge',
+            'depth 3',
+            '# TYPE latency_seconds histogram',
+            # cumulative buckets
+            'latency_seconds_bucket{view="a \\"quoted\\"\\nview",le="0.01"} 1',
+            'latency_seconds_bucket{view="a \\"quoted\\"\\nview",le="1.0"} 2',
+            'latency_seconds_bucket{view="a \\"quoted\\"\\nview",le="+Inf"} 3',
+            'latency_seconds_sum{view="a \\"quoted\\"\\nview"} 20.203',
+            'latency_seconds_count{view="a \\"quoted\\"\\nview"} 3',
+            '# TYPE requests_total counter',
+            'requests_total{view="a"} 3',
+        ])
+
+    def test_request_metrics(self):
+        self.client.force_login(self.alice)
+        response = self.client.get('/api/get-messages/global/page/')
+        view = response.resolver_match.view_name
+        before = metrics.get('http_requests_total', view=view, method='GET', status=200)
+        self.client.get('/api/get-messages/global/page/')
+        self.assertEqual(metrics.get('http_requests_total', view=view, method='GET', status=200), before + 1)
+        self.assertIn('http_request_db_queries_count{{view="{0}"}}'.format(view), metrics.render())
+
+        self.client.get('/no/such/page/')
+        self.assertTrue(metrics.get('http_requests_total', view='unmatched', method='GET', status=404))
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_access(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE http_requests_total counter', response.content.decode('utf-8'))
+
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.alice.is_staff = True
+        self.alice.save()
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+class ProfilingTests(GrumblrTestCase):
+    def setUp(self):
+        super().setUp()
+        profiling._unarmed_until = 0.0
+        self.staff = make_user('staff')
+        self.staff.is_staff = True
+        self.staff.save()
+        self.alice = make_user('alice')
+
+    def test_requested(self):
+        factory = RequestFactory()
+        for params, header, what in (({'_profile': '1'}, None, '1'), ({'_profile': 'consumers'}, None, 'consumers'),
+                                     ({}, 'consumers', 'consumers'), ({'_profile': '0'}, None, None),
+                                     ({'_profile': 'yes'}, None, None), ({}, 'true', None), ({}, None, None)):
+            request = factory.get('/', params, **({'HTTP_X_PROFILE': header} if header else {}))
+            self.assertEqual(profiling.requested(request), what, (params, header))
+
+    def test_profile_request(self):
+        self.client.force_login(self.alice)
+        response = self.client.get('/api/get-messages/global/page/', {'_profile': '1'})
+        self.assertFalse(response.has_header('X-Profile-Id'))
+
+        self.client.force_login(self.staff)
+        response = self.client.get('/api/get-messages/global/page/', {'_profile': '1'})
+        self.assertEqual(response.status_code, 200)
+        profile = RequestProfile.objects.get(id=response['X-Profile-Id'])
+        self.assertTrue(profile.label.startswith('GET /api/get-messages/global/page/'))
+        self.assertGreater(profile.query_count, 0)
+
+        self.assertEqual(read_json(self.client.get('/profiles/'))['profiles'][0]['id'], profile.id)
+        report = self.client.get('/profiles/{0}.txt'.format(profile.id)).content.decode('utf-8')
+        self.assertIn('SQL ({0} queries'.format(profile.query_count), report)
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get('/profiles/{0}.prof'.format(profile.id)).status_code, 403)
+
+    @override_settings(PROFILE_CONSUMER_CALLS=2)
+    def test_profile_consumers(self):
+        consumer = profiling.profiled_consumer(lambda message: 'done')
+        message = mock.Mock()
+        message.channel.name = 'websocket.connect'
+
+        self.client.force_login(self.staff)
+        self.client.get('/api/get-messages/global/page/', {'_profile': 'consumers'})
+        self.assertEqual([consumer(message) for _ in range(3)], ['done'] * 3)
+        self.assertEqual(RequestProfile.objects.filter(label__contains='websocket.connect').count(), 2)
+
+    def test_unarmed_consumers_skip_the_cache(self):
+        consumer = profiling.profiled_consumer(lambda message: 'done')
+        with mock.patch.object(profiling, 'cache', wraps=cache) as wrapped:
+            for _ in range(5):
+                consumer(mock.Mock())
+        # looked up once, then taken for unarmed for ARMED_CHECK_INTERVAL
+        self.assertEqual(wrapped.get.call_count, 1)
+        self.assertFalse(RequestProfile.objects.exists())
+
+
+class QueryLogTests(GrumblrTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+
+    def test_fingerprint(self):
+        self.assertEqual(querylog.fingerprint("SELECT *  FROM t\nWHERE a = 'it''s' AND b IN (1, 2, 3) AND c > 4.5"),
+                         'SELECT * FROM t WHERE a = ? AND b IN (...) AND c > ?')
+
+    def test_recorders(self):
+        outer = querylog.QueryRecorder(sql=True)
+        inner = querylog.QueryRecorder()
+        User.objects.count()
+        inner.stop()
+        UserExtended.objects.count()
+        queries = outer.stop()
+
+        self.assertEqual(len(inner.stop()), 1)
+        self.assertIsNone(inner.queries[0]['sql'])
+        self.assertEqual([query['alias'] for query in queries], ['default', 'default'])
+        self.assertIn('auth_user', queries[0]['sql'])
+        self.assertIn('global_resources_userextended', queries[1]['sql'])
+        # stopped recorders record nothing more
+        User.objects.count()
+        self.assertEqual(len(outer.stop()), 2)
+
+    def test_slow_query_log(self):
+        path = os.path.join(self.media_root, 'slow_queries.log')
+        with override_settings(SLOW_QUERY_MS=0, SLOW_QUERY_LOG=path):
+            handler = querylog.SlowQueryHandler()
+            with mock.patch.object(querylog.slow_query_logger, 'handlers', [handler]):
+                querylog.set_view('test-view')
+                try:
+                    User.objects.filter(username='alice').first()
+                finally:
+                    querylog.set_view(None)
+            handler.close()
+
+        with open(path, encoding='utf-8') as log_file:
+            entries = [json.loads(line) for line in log_file]
+        entry, = [entry for entry in entries if 'auth_user' in entry['sql']]
+        self.assertEqual((entry['view'], entry['database']), ('test-view', 'default'))
+        self.assertIn("'alice'", entry['sql'])
+        self.assertIn('= ?', entry['fingerprint'])
+        self.assertEqual(entry['origin']['file'], os.path.join('global_resources', 'tests.py'))
+        self.assertTrue(entry['plan'])
+
+        report = io.StringIO()
+        call_command('slow_query_report', log=path, view='test-view', json=True, stdout=report)
+        group, = json.loads(report.getvalue())
+        self.assertEqual((group['fingerprint'], group['count']), (entry['fingerprint'], 1))
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'], REPLICA_STICKY_SECONDS=5)
+class ReplicaRouterTests(GrumblrTestCase):
+    """
+    The routing decisions are checked through the database a queryset would read from;
+    nothing is read from the (made up) replica.
+    """
+    def setUp(self):
+        super().setUp()
+        self.factory = RequestFactory()
+
+    @staticmethod
+    @routers.read_from_replica
+    def read_view(request):
+        return HttpResponse(Message.objects.all().db)
+
+    @staticmethod
+    @routers.read_from_replica
+    def streamed_read_view(request):
+        # the body of a streamed response is generated after the view returns
+        return StreamingHttpResponse(Message.objects.all().db for _ in range(2))
+
+    @staticmethod
+    def write_view(request):
+        routers.ReplicaRouter().db_for_write(Message)
+        return HttpResponse(Message.objects.all().db)
+
+    def request(self, view, method='get', cookie=None):
+        request = getattr(self.factory, method)('/')
+        if cookie is not None:
+            request.COOKIES[settings.REPLICA_STICKY_COOKIE] = cookie
+        return PrimaryStickinessMiddleware(view)(request)
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.request(self.read_view).content, b'replica1')
+
+    def test_streamed_reads_go_to_primary(self):
+        # only the reads made while the view runs are routed to the replica
+        self.assertEqual(b''.join(self.request(self.streamed_read_view).streaming_content), b'defaultdefault')
+
+    def test_writing_requests_read_from_primary(self):
+        self.assertEqual(self.request(self.read_view, 'post').content, b'default')
+
+    def test_reads_outside_requests_go_to_primary(self):
+        self.request(self.read_view)
+        self.assertEqual(Message.objects.all().db, 'default')
+
+    def test_stickiness_cookie(self):
+        response = self.request(self.write_view, 'post')
+        cookie = response.cookies[settings.REPLICA_STICKY_COOKIE]
+        self.assertEqual(cookie['max-age'], 5)
+        self.assertGreater(float(cookie.value), time.time())
+
+        # the next requests of the browser read from the primary, until the cookie runs out
+        self.assertEqual(self.request(self.read_view, cookie=cookie.value).content, b'default')
+        self.assertEqual(self.request(self.read_view, cookie=str(time.time() - 1)).content, b'replica1')
+        self.assertEqual(self.request(self.read_view, cookie='garbage').content, b'replica1')
+
+    def test_no_cookie_without_writes(self):
+        self.assertNotIn(settings.REPLICA_STICKY_COOKIE, self.request(self.read_view).cookies)
+        with self.settings(DATABASE_REPLICAS=[]):
+            self.assertNotIn(settings.REPLICA_STICKY_COOKIE, self.request(self.write_view, 'post').cookies)
+
+    def test_no_migrations_on_replicas(self):
+        router = routers.ReplicaRouter()
+        self.assertTrue(router.allow_migrate('default', 'global_resources'))
+        self.assertFalse(router.allow_migrate('replica1', 'global_resources'))
+
+
+class RateLimitTests(GrumblrChannelTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('10/m'), (10, 60))
+        self.assertEqual(parse_rate(' 3 / d '), (3, 60 * 60 * 24))
+        for rate in ('10', '0/m', '10/w', 'ten/m'):
+            with self.assertRaises(ValueError):
+                parse_rate(rate)
+
+    def test_client_ip(self):
+        request = RequestFactory().get('/', REMOTE_ADDR='10.0.0.1', HTTP_X_FORWARDED_FOR='6.6.6.6, 1.2.3.4')
+        self.assertEqual(client_ip(request), '10.0.0.1')
+        with self.settings(RATE_LIMIT_TRUSTED_PROXIES=1):
+            # the address in front of the proxy, not the one made up by the client
+            self.assertEqual(client_ip(request), '1.2.3.4')
+        with self.settings(RATE_LIMIT_TRUSTED_PROXIES=3):
+            self.assertEqual(client_ip(request), '10.0.0.1')
+
+    def test_bucket(self):
+        now = 1000000.0
+        with mock.patch('global_resources.ratelimit.time.time', lambda: now):
+            # a full bucket lets 3 requests through at once
+            self.assertEqual([take_token('bucket', '3/m') for _ in range(3)], [0, 0, 0])
+            # then one every 20 seconds
+            self.assertEqual(take_token('bucket', '3/m'), 20)
+            self.assertEqual(take_token('bucket', '3/m'), 20)  # a denied request takes nothing
+
+        now += 20
+        with mock.patch('global_resources.ratelimit.time.time', lambda: now):
+            self.assertEqual(take_token('bucket', '3/m'), 0)
+            self.assertEqual(take_token('bucket', '3/m'), 20)
+
+        # an idle bucket fills up again
+        now += 600
+        with mock.patch('global_resources.ratelimit.time.time', lambda: now):
+            self.assertEqual([take_token('bucket', '3/m') for _ in range(4)], [0, 0, 0, 20])
+
+    @override_settings(RATE_LIMITS={'post-follows': {'user': '2/m'}})
+    def test_limited_view(self):
+        make_user('target')
+        self.client.force_login(make_user('follower'))
+        for _ in range(2):
+            self.assertEqual(self.client.post('/api/post-follows/', {'follow': 'target'}).status_code, 200)
+
+        limited = metrics.get('rate_limited_total', limit='post-follows', scope='user') or 0
+        response = self.client.post('/api/post-follows/', {'follow': 'target'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertEqual(metrics.get('rate_limited_total', limit='post-follows', scope='user'), limited + 1)
+
+        with self.settings(RATE_LIMITS_ENABLED=False):
+            self.assertEqual(self.client.post('/api/post-follows/', {'follow': 'target'}).status_code, 200)
+
+    @override_settings(RATE_LIMITS={'post-follows': {'ip': '1/m'}})
+    def test_limited_by_ip(self):
+        make_user('target')
+        for username, address in (('first', '10.0.0.1'), ('second', '10.0.0.1'), ('third', '10.0.0.2')):
+            self.client.force_login(make_user(username))
+            response = self.client.post('/api/post-follows/', {'follow': 'target'}, REMOTE_ADDR=address)
+            # the second user shares the address of the first one
+            self.assertEqual(response.status_code, 429 if username == 'second' else 200)
+
+
+class FollowGraphTests(GrumblrTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        follow_graph._sets.clear()
+        follow_graph._size = 0
+        self.alice, self.bob, self.carol = make_user('alice'), make_user('bob'), make_user('carol')
+
+    def test_changes_invalidate(self):
+        self.assertEqual(follow_graph.following_ids(self.alice.pk), frozenset())
+        self.alice.ext.following.add(self.bob, self.carol)
+        self.assertEqual(follow_graph.following_ids(self.alice.pk), {self.bob.pk, self.carol.pk})
+        self.assertEqual(follow_graph.follower_ids(self.bob.pk), {self.alice.pk})
+
+        # from the other side of the relation
+        self.carol.followed_by.add(self.bob.ext)
+        self.assertEqual(follow_graph.follower_ids(self.carol.pk), {self.alice.pk, self.bob.pk})
+        self.alice.ext.following.remove(self.bob)
+        self.assertFalse(follow_graph.is_following(self.alice.pk, self.bob.pk))
+        self.carol.followed_by.clear()
+        self.assertEqual(follow_graph.following_ids(self.alice.pk), frozenset())
+        self.assertEqual(follow_graph.follower_ids(self.carol.pk), frozenset())
+
+    def test_cached_lookups(self):
+        self.alice.ext.following.add(self.bob)
+        follow_graph.following_ids(self.alice.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(follow_graph.is_following(self.alice.pk, self.bob.pk))
+            self.assertFalse(follow_graph.is_following(self.alice.pk, self.carol.pk))
+
+        # a process without a local copy reads the ids from the cache
+        follow_graph._sets.clear()
+        with self.assertNumQueries(0):
+            self.assertTrue(follow_graph.is_following(self.alice.pk, self.bob.pk))
+
+    def test_version_stamps(self):
+        follow_graph.following_ids(self.alice.pk)
+        # a change that didn't go through the m2m managers isn't seen...
+        through = UserExtended.following.through
+        through.objects.create(userextended_id=self.alice.pk, user_id=self.bob.pk)
+        self.assertEqual(follow_graph.following_ids(self.alice.pk), frozenset())
+
+        # ... until the user's version stamp is replaced, by this or any other process
+        follow_graph.invalidate([self.alice.pk])
+        self.assertEqual(follow_graph.following_ids(self.alice.pk), {self.bob.pk})
+        through.objects.create(userextended_id=self.alice.pk, user_id=self.carol.pk)
+        cache.set(follow_graph._version_key(self.alice.pk), 'another-process', None)
+        self.assertEqual(follow_graph.following_ids(self.alice.pk), {self.bob.pk, self.carol.pk})
+
+        # or evicted from the cache
+        through.objects.filter(userextended_id=self.alice.pk).delete()
+        cache.delete(follow_graph._version_key(self.alice.pk))
+        self.assertEqual(follow_graph.following_ids(self.alice.pk), frozenset())
+
+    def test_id_pages(self):
+        others = [make_user('user{0}'.format(number)) for number in range(5)]
+        self.alice.ext.following.add(*others)
+        ids = sorted(user.pk for user in others)
+
+        self.assertEqual(follow_graph.get_id_page(follow_graph.FOLLOWING, self.alice.pk, size=3), (ids[:3], True))
+        self.assertEqual(follow_graph.get_id_page(follow_graph.FOLLOWING, self.alice.pk, ids[2], size=3),
+                         (ids[3:], False))
+        self.assertEqual(follow_graph.get_id_page(follow_graph.FOLLOWERS, ids[0], size=3), ([self.alice.pk], False))
+
+    @override_settings(FOLLOW_GRAPH_CACHE_IDS=2)
+    def test_local_copies_are_bounded(self):
+        self.alice.ext.following.add(self.bob, self.carol)
+        self.bob.ext.following.add(self.carol)
+        follow_graph.following_ids(self.alice.pk)
+        follow_graph.following_ids(self.bob.pk)
+        # the least recently used copy goes first
+        self.assertEqual(list(follow_graph._sets), [(follow_graph.FOLLOWING, self.bob.pk)])
+        self.assertEqual(follow_graph._size, 1)
+
+    @override_settings(TIMELINE_FANOUT_LIMIT=1)
+    def test_fan_out_on_read_ids(self):
+        self.alice.ext.following.add(self.carol)
+        self.assertEqual(follow_graph.fan_out_on_read_ids(), frozenset())
+        self.bob.ext.following.add(self.carol)
+        self.assertEqual(follow_graph.fan_out_on_read_ids(), {self.carol.pk})
+        self.alice.ext.following.remove(self.carol)
+        self.assertEqual(follow_graph.fan_out_on_read_ids(), frozenset())
+
+
+@override_settings(RATE_LIMITS_ENABLED=False)
+class BulkFollowTests(GrumblrTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = make_user('follower')
+        self.others = [make_user('user{0}'.format(number)) for number in range(3)]
+        self.client.force_login(self.user)
+
+    def following(self):
+        return sorted(self.user.ext.following.values_list('username', flat=True))
+
+    def post(self, follow=(), unfollow=()):
+        return self.client.post('/api/post-follows/', {'follow': list(follow), 'unfollow': list(unfollow)})
+
+    def test_follow_and_unfollow(self):
+        response = self.post(follow=['user0', 'user1', 'nobody', 'follower'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(read_json(response), {
+            'followed': ['user0', 'user1'],
+            'unfollowed': [],
+            'unknown': ['nobody'],
+            'following_count': 2
+        })
+
+        data = read_json(self.post(follow=['user1', 'user2'], unfollow=['user0']))
+        self.assertEqual((data['followed'], data['unfollowed'], data['following_count']), (['user2'], ['user0'], 2))
+        self.assertEqual(self.following(), ['user1', 'user2'])
+        self.assertEqual(UserExtended.objects.get(pk=self.others[0].pk).follower_count, 0)
+        self.assertEqual(UserExtended.objects.get(pk=self.others[2].pk).follower_count, 1)
+
+    def test_limits(self):
+        self.assertEqual(self.post().status_code, 400)
+        too_many = ['user{0}'.format(number) for number in range(BULK_FOLLOW_LIMIT + 1)]
+        self.assertEqual(self.post(follow=too_many).status_code, 400)
+        self.assertEqual(self.post(follow=['user0'], unfollow=['user0']).status_code, 400)
+        self.assertEqual(self.client.get('/api/post-follows/').status_code, 405)
+        self.assertEqual(self.following(), [])
+
+    def test_atomic(self):
+        self.post(follow=['user0'])
+        # fails while unfollowing, after the new follows have been added (nobody crossed the fan-out limit)
+        with mock.patch('global_resources.follow_graph.check_fan_out_limit', side_effect=[[], RuntimeError('Boom')]):
+            with self.assertRaises(RuntimeError):
+                self.post(follow=['user1', 'user2'], unfollow=['user0'])
+        self.assertEqual(self.following(), ['user0'])
+        self.assertEqual(UserExtended.objects.get(pk=self.user.pk).following_count, 1)
+        self.assertEqual([UserExtended.objects.get(pk=user.pk).follower_count for user in self.others], [1, 0, 0])
+
+
+@override_settings(GLOBAL_STREAM_SHARDS=8, GLOBAL_STREAM_PUBLISH_THREADS=1, GLOBAL_STREAM_PRUNE=False)
+class StreamShardTests(GrumblrChannelTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def members(self, shard):
+        return set(channel_layers[DEFAULT_CHANNEL_LAYER].group_channels(stream_shards.group_name(shard)))
+
+    def test_consistent_hashing(self):
+        names = ['websocket.send.{0}'.format(number) for number in range(2000)]
+        shards = [stream_shards.shard_of(name) for name in names]
+        self.assertEqual(shards, [stream_shards.shard_of(name) for name in names])  # stable
+        counts = [shards.count(shard) for shard in range(8)]
+        self.assertGreater(min(counts), 2000 / 8 / 2, counts)
+
+        # one more shard only takes sockets over to itself, about 1 / 9 of them
+        with self.settings(GLOBAL_STREAM_SHARDS=9):
+            moved = [stream_shards.shard_of(name) for name, shard in zip(names, shards)
+                     if stream_shards.shard_of(name) != shard]
+        self.assertEqual(set(moved), {8})
+        self.assertLess(len(moved), 2000 / 9 * 2)
+
+    def test_add_and_discard(self):
+        socket = Channel('websocket.send.reader')
+        shard = stream_shards.shard_of(socket.name)
+        stream_shards.add(socket)
+        self.assertEqual(self.members(shard), {socket.name})
+        self.assertEqual(cache.get(stream_shards._seen_key(socket.name)), shard)
+
+        stream_shards.publish({'text': 'new'})
+        self.assertEqual(self.get_next_message(socket.name, require=True).content, {'text': 'new'})
+
+        stream_shards.discard(socket)
+        self.assertEqual(self.members(shard), set())
+        self.assertIsNone(cache.get(stream_shards._seen_key(socket.name)))
+
+    @override_settings(GLOBAL_STREAM_PRUNE=True)
+    def test_pruning(self):
+        live, dead = Channel('websocket.send.live'), Channel('websocket.send.dead')
+        shard = stream_shards.shard_of(live.name)
+        stream_shards.add(live)
+        stream_shards.add(dead)
+        # the heartbeats of the dead socket run out
+        cache.delete(stream_shards._seen_key(dead.name))
+        # a socket left behind in its old shard when the number of shards changed
+        moved = Channel('websocket.send.moved')
+        stream_shards.add(moved)
+        old_shard = (stream_shards.shard_of(moved.name) + 1) % 8
+        channel_layers[DEFAULT_CHANNEL_LAYER].group_add(stream_shards.group_name(old_shard), moved.name)
+
+        pruned = metrics.get('ws_pruned_total', group=stream_shards.GROUP_PREFIX) or 0
+        stream_shards.publish({'text': 'new'})
+        self.assertNotIn(dead.name, self.members(stream_shards.shard_of(dead.name)))
+        self.assertIn(live.name, self.members(shard))
+        self.assertNotIn(moved.name, self.members(old_shard))
+        self.assertIn(moved.name, self.members(stream_shards.shard_of(moved.name)))
+        self.assertEqual(metrics.get('ws_pruned_total', group=stream_shards.GROUP_PREFIX), pruned + 2)
+
+        # pruned once per interval
+        stream_shards.add(dead)
+        cache.delete(stream_shards._seen_key(dead.name))
+        stream_shards.publish({'text': 'new'})
+        self.assertIn(dead.name, self.members(stream_shards.shard_of(dead.name)))
+        self.assertEqual(stream_shards.prune(stream_shards.shard_of(dead.name)), 1)
+
+    def test_heartbeat_frames(self):
+        client = WSClient()
+        client.send_and_consume('websocket.connect', path='/api/get-messages-stream/')
+        self.assertEqual(client.receive(), None)  # accepted
+        key = stream_shards._seen_key(client.reply_channel)
+        self.assertIn(client.reply_channel, self.members(stream_shards.shard_of(client.reply_channel)))
+
+        cache.delete(key)
+        client.send_and_consume('websocket.receive', {'text': json.dumps({'type': 'heartbeat'})},
+                                path='/api/get-messages-stream/')
+        self.assertEqual(cache.get(key), stream_shards.shard_of(client.reply_channel))
+
+        client.send_and_consume('websocket.disconnect', {'code': 1000}, path='/api/get-messages-stream/')
+        self.assertIsNone(cache.get(key))
@@ -7,6 +7,9 @@ urlpatterns = [
 
     url(r'^get-messages/$', views.get_messages, name='get-messages'),
     url(r'^get-messages/profile/(?P<profile_user>[^/]+?)/$', views.get_profile_messages),
+    # keyset (cursor) paginated variants; must be matched before the from_t patterns below
+    url(r'^get-messages/profile/(?P<profile_user>[^/]+?)/page/$', views.get_profile_messages_page),
+    url(r'^get-messages/(?P<view>\w+)/page/$', views.get_messages_page),
     url(r'^get-messages/profile/(?P<profile_user>[^/]+?)/(?P<from_t>[^/]+?)/$', views.get_profile_messages),
     url(r'^get-messages/(?P<view>\w+)/$', views.get_messages),  # (?P<py_func_parameter>pattern) is a Python regex group
     url(r'^get-messages/(?P<view>\w+)/(?P<from_t>[^/]+?)/$', views.get_messages),
@@ -14,5 +17,11 @@ urlpatterns = [
     url(r'^post-comment/(?P<msg_id>[^/]+?)/$', views.post_comment),
 
     url(r'^get-comments/(?P<msg_id>[^/]+?)/$', views.get_comments),
-    url(r'^get-comments/(?P<msg_id>[^/]+?)/(?P<from_t>[^/]+?)/$', views.get_comments)
+    url(r'^get-comments/(?P<msg_id>[^/]+?)/(?P<from_t>[^/]+?)/$', views.get_comments),
+
+    # who a user is following / is followed by, paged with a cursor
+    url(r'^following/(?P<username>[^/]+?)/$', views.get_following, name='following-list'),
+    url(r'^followers/(?P<username>[^/]+?)/$', views.get_followers, name='followers-list'),
+    # follow / unfollow many users at once
+    url(r'^post-follows/$', views.post_follows, name='post-follows')
 ]
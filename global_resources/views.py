@@ -2,26 +2,128 @@
 Backend APIs.
 
 Author: Stephen Xie <[redacted]@cmu.edu>
-Version: 1.1.0
+Version: 1.9.1
 """
+import functools
+import hashlib
+import json
 import logging
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.db import transaction
-from django.http import Http404, HttpResponse, HttpResponseBadRequest
-from django.shortcuts import render
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse
+from django.urls import reverse
 from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_POST
 
+from . import broadcast, follow_graph, global_window
 from .forms import CommentForm, MessageForm
-from .models import Comment, Message
+from .metrics import metrics
+from .models import Comment, Message, RequestProfile, TimelineEntry, UserExtended
+from .paging import DIRECTION_OLDER, InvalidCursor, decode_id_cursor, encode_id_cursor
+from .ratelimit import rate_limit
+from .routers import read_from_replica
+from .serializers import COMMENT_FIELDS, MESSAGE_FIELDS, InvalidFields, comments_response, messages_response, \
+    parse_fields
 
 
 # used for printing debugging info in console
 logger = logging.getLogger(__name__)
 
 
+# --- validators for conditional GET ----------------------------------------------------------
+# The polling APIs answer with ETags computed from a few indexed lookups (the newest row in
+# the scope of the request, plus a denormalized counter that changes on deletion), so that an
+# idle poll sending back If-None-Match gets a 304 Not Modified without running the full query.
+# The request path (including the cursor / direction / fields parameters) is part of the tag.
+# The global tag also carries the version stamp of the global stream (see global_window.py),
+# which changes whenever a message is deleted or its comment count changes. Elsewhere,
+# changes to the cards of messages already sent (e.g. new comments) don't change the tags;
+# those are pushed through the WebSocket streams.
+
+def __etag(request, *parts):
+    """
+    Build an ETag from the request path and the given validator parts.
+    """
+    key = ':'.join([request.get_full_path()] + [str(part) for part in parts])
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def __newest_message_id(messages):
+    # the newest message of a queryset, through the (..., date, id) indexes
+    return messages.order_by('-date', '-id').values_list('id', flat=True).first()
+
+
+def __messages_etag(request, view='global', **kwargs):
+    view_name = view.lower()
+    if view_name == 'global':
+        # read before the data, so that a tag is never newer than the data it's sent with
+        version = global_window.get_version()
+        window = global_window.get_window()
+        if window is not None:
+            # the cached window is the newest part of the global stream
+            return __etag(request, version, window['rows'][0]['id'] if window['rows'] else None)
+        return __etag(request, version, __newest_message_id(Message.objects.all()))
+
+    elif view_name == 'follower':
+        user = request.user
+        newest_entry = user.timeline.order_by('-date', '-message_id').values_list('message_id', flat=True).first()
+        fan_out_on_read = TimelineEntry.get_fan_out_on_read_authors(user)
+        newest_on_read = __newest_message_id(Message.objects.filter(user__in=fan_out_on_read)) \
+            if fan_out_on_read else None
+        # following_count changes when timeline entries are added / removed by (un)following
+        # (the copy of user.ext remembered by CachedModelBackend is dropped when it does)
+        return __etag(request, user.id, newest_entry, newest_on_read, user.ext.following_count)
+
+    return None  # unknown view; left to the view to reject
+
+
+def __profile_messages_etag(request, profile_user, **kwargs):
+    author = User.objects.filter(username=profile_user).values_list('id', 'ext__message_count').first()
+    if author is None:
+        return None
+    return __etag(request, author[0], author[1], __newest_message_id(Message.objects.filter(user_id=author[0])))
+
+
+def __comments_etag(request, msg_id, **kwargs):
+    comment_count = Message.objects.filter(id=msg_id).values_list('comment_count', flat=True).first() \
+        if msg_id.isdigit() else None
+    if comment_count is None:
+        return None
+    newest_comment = Comment.objects.filter(message_id=msg_id).order_by('-date', '-id') \
+        .values_list('id', flat=True).first()
+    return __etag(request, comment_count, newest_comment)
+
+
+# responses must be revalidated by the browser before being reused, and never be stored by shared caches
+__revalidate = cache_control(private=True, no_cache=True)
+
+
+def __condition(etag_func):
+    """
+    Like @condition(etag_func=...), but only successful responses (and the 304s answering them)
+    keep the ETag: a 400 / 404 tagged with the tag of the data would make a later request with
+    that tag get a 304, as if the error had been a valid response to reuse.
+    """
+    def decorator(view):
+        conditional_view = condition(etag_func=etag_func)(view)
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            if response.status_code not in (200, 304):
+                del response['ETag']
+            return response
+        return wrapper
+    return decorator
+
+
 @login_required
+@rate_limit('post-message')
 @transaction.atomic  # for message posting
 def post_message(request):
     """
@@ -48,6 +150,10 @@ def post_message(request):
 
 
 @login_required
+@rate_limit('get-messages')
+@read_from_replica
+@__revalidate
+@__condition(__messages_etag)
 def get_messages(request, view='global', from_t='1970-01-01T00:00+00:00'):
     """
     API used to get a list of latest messages since the given time frame.
@@ -62,27 +168,30 @@ def get_messages(request, view='global', from_t='1970-01-01T00:00+00:00'):
     view_name = view.lower()
     user = request.user  # get current user
 
-    context = {}
-
     if view_name == 'global':
-        # get 20 most recent messages from the database
-        # TODO: implement a paging mechanism
-        context['messages'] = Message.get_all_ranged(from_date=from_t)
+        # get 20 most recent messages from the cached window of the global stream, or from
+        # the database if they fall outside of it
+        # Note: see get_messages_page for the paginated version
+        messages = global_window.get_ranged(from_t)
+        if messages is None:
+            messages = list(Message.get_all_ranged(from_date=from_t))
 
     elif view_name == 'follower':
         # get 20 latest messages that are posted later than from_t from the followed users
-        # TODO: implement a paging mechanism
-        context['messages'] = Message.get_followers_ranged(user, from_date=from_t)
+        messages = list(Message.get_followers_ranged(user, from_date=from_t))
 
     else:
         raise Http404
 
-    context['last_updated'] = timezone.now().isoformat()  # last updated time string in ISO 8601 format
-
-    return render(request, 'messages_template.json', context, content_type='application/json')
+    # last updated time string in ISO 8601 format
+    return __messages_response(request, messages, last_updated=timezone.now().isoformat())
 
 
 @login_required
+@rate_limit('get-messages')
+@read_from_replica
+@__revalidate
+@__condition(__profile_messages_etag)
 def get_profile_messages(request, profile_user, from_t='1970-01-01T00:00+00:00'):
     """
     API used to get a list of latest messages since the given time frame.
@@ -94,8 +203,6 @@ def get_profile_messages(request, profile_user, from_t='1970-01-01T00:00+00:00')
     :param from_t: the starting time (excluded)
     :return: a JSON string
     """
-    context = {}
-
     try:
         user = User.objects.get(username=profile_user)
         # Note: this will not have an SQL injection vulnerability, as Django will automatically
@@ -103,16 +210,118 @@ def get_profile_messages(request, profile_user, from_t='1970-01-01T00:00+00:00')
     except User.DoesNotExist:
         raise Http404
 
-    # get 20 most recent messages posted by this user, ordered by date in descending order (most recent first)
-    # TODO: implement a paging mechanism
-    context['messages'] = Message.get_user_ranged(user, from_date=from_t)
+    # get 20 latest messages that are posted later than from_t by this user
+    # Note: see get_profile_messages_page for the paginated version
+    messages = list(Message.get_user_ranged(user, from_date=from_t))
 
-    context['last_updated'] = timezone.now().isoformat()  # last updated time string in ISO 8601 format
+    # last updated time string in ISO 8601 format
+    return __messages_response(request, messages, last_updated=timezone.now().isoformat())
 
-    return render(request, 'messages_template.json', context, content_type='application/json')
+
+@login_required
+@rate_limit('get-messages')
+@read_from_replica
+@__revalidate
+@__condition(__messages_etag)
+def get_messages_page(request, view='global'):
+    """
+    API used to get a page of messages with keyset (cursor) pagination.
+    Messages in the page are sorted from the newest to the oldest.
+    Note: this method is only for global and following views; for profile
+    view see get_profile_messages_page.
+
+    Query string parameters:
+    - cursor: cursor string from a previous page (next_cursor or prev_cursor);
+      omit it to get the newest page
+    - direction: 'older' (default) to get messages older than the cursor,
+      or 'newer' to get messages newer than the cursor
+
+    :param request:
+    :param view: either 'global' view or 'follower' view
+    :return: a JSON string
+    """
+    view_name = view.lower()
+    cursor = request.GET.get('cursor') or None
+    direction = request.GET.get('direction', DIRECTION_OLDER)
+
+    try:
+        if view_name == 'global':
+            page = Message.get_all_paged(cursor, direction)
+        elif view_name == 'follower':
+            page = Message.get_followers_paged(request.user, cursor, direction)
+        else:
+            raise Http404
+    except InvalidCursor:
+        return HttpResponseBadRequest('Invalid paging cursor or direction.')
+
+    return __render_messages_page(request, page)
 
 
 @login_required
+@rate_limit('get-messages')
+@read_from_replica
+@__revalidate
+@__condition(__profile_messages_etag)
+def get_profile_messages_page(request, profile_user):
+    """
+    API used to get a page of messages posted by the given user with keyset
+    (cursor) pagination. Takes the same query string parameters as get_messages_page.
+
+    :param request:
+    :param profile_user: ID of the user to which the profile belongs
+    :return: a JSON string
+    """
+    try:
+        user = User.objects.get(username=profile_user)
+    except User.DoesNotExist:
+        raise Http404
+
+    try:
+        page = Message.get_user_paged(user, request.GET.get('cursor') or None,
+                                      request.GET.get('direction', DIRECTION_OLDER))
+    except InvalidCursor:
+        return HttpResponseBadRequest('Invalid paging cursor or direction.')
+
+    return __render_messages_page(request, page)
+
+
+def __render_messages_page(request, page):
+    """
+    Render a page of messages returned by the Message.get_*_paged methods.
+
+    :param request:
+    :param page: a tuple of (list of messages, next_cursor, prev_cursor)
+    :return: a JSON string
+    """
+    messages, next_cursor, prev_cursor = page
+    return __messages_response(request, messages,
+                               last_updated=timezone.now().isoformat(),
+                               next_cursor=next_cursor,  # fetch older messages with this cursor
+                               prev_cursor=prev_cursor)  # poll for newer messages with this cursor
+
+
+def __messages_response(request, messages, **head):
+    """
+    Serialize a list of messages into the JSON response of the message APIs, with
+    the fields requested in the "fields" query string parameter (all fields by default).
+
+    :param request:
+    :param messages: a list of messages
+    :param head: other members of the response object
+    :return: a JSON string
+    """
+    try:
+        fields = parse_fields(request.GET.get('fields'), MESSAGE_FIELDS)
+    except InvalidFields as e:
+        return HttpResponseBadRequest(str(e))
+
+    if 'html' in fields:
+        Message.load_cards(messages)
+    return messages_response(messages, fields, **head)
+
+
+@login_required
+@rate_limit('post-comment')
 @transaction.atomic
 def post_comment(request, msg_id):
     """
@@ -145,6 +354,10 @@ def post_comment(request, msg_id):
 
 
 @login_required
+@rate_limit('get-comments')
+@read_from_replica
+@__revalidate
+@__condition(__comments_etag)
 def get_comments(request, msg_id, from_t='1970-01-01T00:00+00:00'):
     """
     API used to retrieve all latest comments made to a specified message
@@ -155,16 +368,203 @@ def get_comments(request, msg_id, from_t='1970-01-01T00:00+00:00'):
     :param from_t: the starting time (excluded)
     :return: a JSON string
     """
-    context = {'message_id': msg_id}
+    try:
+        fields = parse_fields(request.GET.get('fields'), COMMENT_FIELDS)
+    except InvalidFields as e:
+        return HttpResponseBadRequest(str(e))
+
     try:
         message = Message.objects.get(id=msg_id)
         # get the latest 20 comments that are posted later than from_t
         # TODO: implement a paging mechanism
-        context['comments'] = Comment.get_all_ranged(message, from_date=from_t)
+        comments = list(Comment.get_all_ranged(message, from_date=from_t))
 
     except:
         raise Http404
 
-    context['last_updated'] = timezone.now().isoformat()  # last updated time string in ISO 8601 format
+    if 'html' in fields:
+        Comment.load_cards(comments)
+
+    # last updated time string in ISO 8601 format
+    return comments_response(comments, fields, message_id=message.id, last_updated=timezone.now().isoformat())
+
+
+# number of users in a page of the follower / following lists
+FOLLOW_PAGE_SIZE = 50
+
+
+@login_required
+@rate_limit('get-follows')
+@read_from_replica
+def get_following(request, username):
+    """
+    API used to page through the users the given user is following.
+
+    :param request: may carry the `cursor` of the next page, as returned with the previous one
+    :param username: the user whose relations are listed
+    :return: a JSON string; see __follow_list_response
+    """
+    return __follow_list_response(request, username, follow_graph.FOLLOWING)
+
+
+@login_required
+@rate_limit('get-follows')
+@read_from_replica
+def get_followers(request, username):
+    """
+    API used to page through the users following the given user.
+
+    :param request: may carry the `cursor` of the next page, as returned with the previous one
+    :param username: the user whose relations are listed
+    :return: a JSON string; see __follow_list_response
+    """
+    return __follow_list_response(request, username, follow_graph.FOLLOWERS)
+
+
+def __follow_list_response(request, username, relation):
+    """
+    Build a page of a follower / following list: the users in the page (ordered by id, and
+    loaded in one query), whether the current user is following each of them, the total
+    number of users in the list, and the cursor of the next page (null on the last page).
+    """
+    try:
+        user = User.objects.select_related('ext').get(username=username)
+    except User.DoesNotExist:
+        raise Http404
+    try:
+        after_id = decode_id_cursor(request.GET['cursor']) if request.GET.get('cursor') else None
+    except InvalidCursor as e:
+        return HttpResponseBadRequest(str(e))
+
+    # the ids come from the cached follow graph, so only the users in the page are read
+    ids, has_more = follow_graph.get_id_page(relation, user.id, after_id, FOLLOW_PAGE_SIZE)
+    users = User.objects.select_related('ext').in_bulk(ids)
+    followed_by_me = follow_graph.following_ids(request.user.id)
+
+    return JsonResponse({
+        'username': user.username,
+        'count': user.ext.following_count if relation == follow_graph.FOLLOWING else user.ext.follower_count,
+        'users': [{
+            'id': users[user_id].id,
+            'username': users[user_id].username,
+            'first_name': users[user_id].first_name,
+            'last_name': users[user_id].last_name,
+            'avatar': users[user_id].ext.avatar_url('comment'),
+            'is_following': user_id in followed_by_me
+        } for user_id in ids if user_id in users],  # users deleted in the meantime are skipped
+        'next_cursor': encode_id_cursor(ids[-1]) if has_more else None
+    })
+
+
+# maximum number of users followed / unfollowed in one request
+BULK_FOLLOW_LIMIT = 100
+
+
+@login_required
+@rate_limit('post-follows')
+@require_POST
+@transaction.atomic  # all the changes or none
+def post_follows(request):
+    """
+    API used to follow and / or unfollow many users at once.
+
+    The changes are made through the `following` relation of the current user, so the new
+    relations are inserted with a single bulk INSERT and the removed ones deleted with a single
+    DELETE, and the m2m_changed receivers keep the counters, timelines, following stream
+    subscriptions and the cached follow graph in sync (see signals.py).
+
+    :param request: carries the usernames to follow in `follow`, and those to unfollow in
+                    `unfollow` (each field repeated as needed)
+    :return: a JSON string of the usernames actually followed / unfollowed (the others were
+             followed / not followed already), the unknown usernames, and the new number of
+             users the current user is following
+    """
+    follow = set(request.POST.getlist('follow'))
+    unfollow = set(request.POST.getlist('unfollow'))
+    if not follow and not unfollow:
+        return HttpResponseBadRequest('Nobody to follow or unfollow.')
+    if len(follow) + len(unfollow) > BULK_FOLLOW_LIMIT:
+        return HttpResponseBadRequest('At most {0} users can be followed / unfollowed at once.'.format(
+            BULK_FOLLOW_LIMIT))
+    if follow & unfollow:
+        return HttpResponseBadRequest('Cannot both follow and unfollow the same user.')
+
+    ids = dict(User.objects.filter(username__in=follow | unfollow).values_list('username', 'id'))
+    follow_ids = {ids[username] for username in follow if username in ids} - {request.user.id}
+    unfollow_ids = {ids[username] for username in unfollow if username in ids}
+
+    # what's changing, from the relations of the current user as they are in this transaction
+    following = request.user.ext.following
+    existing = set(following.filter(id__in=follow_ids | unfollow_ids).values_list('id', flat=True))
+    added = follow_ids - existing
+    removed = unfollow_ids & existing
+    if added:
+        following.add(*added)
+    if removed:
+        following.remove(*removed)
+
+    usernames = {user_id: username for username, user_id in ids.items()}
+    return JsonResponse({
+        'followed': sorted(usernames[user_id] for user_id in added),
+        'unfollowed': sorted(usernames[user_id] for user_id in removed),
+        'unknown': sorted((follow | unfollow) - set(ids)),
+        # as updated by the receivers within this transaction
+        'following_count': UserExtended.objects.values_list('following_count', flat=True).get(pk=request.user.id)
+    })
+
+
+def __is_staff(request):
+    return request.user.is_authenticated and request.user.is_staff
+
+
+def metrics_view(request):
+    """
+    Exposes the metrics of this process (see metrics.py) in the Prometheus text format.
+    Only available to staff users, or to scrapers sending the token in settings.METRICS_TOKEN
+    as an "Authorization: Bearer <token>" header.
+    """
+    token = request.META.get('HTTP_AUTHORIZATION', '')
+    authorized = __is_staff(request) or \
+        (settings.METRICS_TOKEN and constant_time_compare(token, 'Bearer ' + settings.METRICS_TOKEN))
+    if not authorized:
+        return HttpResponseForbidden()
+    # shared by all the processes, so read from the channel layer
+    broadcast.report_queue_depth()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def profiles_view(request):
+    """
+    Lists the latest request / consumer profiles (see profiling.py) as JSON. Staff only.
+    """
+    if not __is_staff(request):
+        return HttpResponseForbidden()
+    profiles = RequestProfile.objects.order_by('-id').values('id', 'label', 'created', 'duration', 'query_count',
+                                                             'query_time', 'user__username')
+    return JsonResponse({'profiles': [dict(profile,
+                                           stats=reverse('profile-download', args=[profile['id'], 'prof']),
+                                           report=reverse('profile-download', args=[profile['id'], 'txt']))
+                                      for profile in profiles]})
 
-    return render(request, 'comments_template.json', context, content_type='application/json')
+
+def profile_download(request, profile_id, ext):
+    """
+    Downloads a profile: 'prof' for the raw cProfile stats, 'txt' for a readable report
+    with the SQL executed. Staff only.
+    """
+    if not __is_staff(request):
+        return HttpResponseForbidden()
+    try:
+        profile = RequestProfile.objects.get(id=profile_id)
+    except RequestProfile.DoesNotExist:
+        raise Http404
+
+    if ext == 'prof':
+        response = HttpResponse(bytes(profile.stats), content_type='application/octet-stream')
+    else:
+        lines = [str(profile), '', profile.report, 'SQL ({0} queries, {1:.3f}s):'.format(
+            profile.query_count, profile.query_time)]
+        lines.extend('[{time:.4f}s] {sql}'.format(**query) for query in json.loads(profile.queries))
+        response = HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="profile-{0}.{1}"'.format(profile.id, ext)
+    return response
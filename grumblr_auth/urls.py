@@ -1,6 +1,7 @@
 from django.conf.urls import url
 from django.contrib.auth import views as auth_views
 
+from global_resources.forms import OutboxPasswordResetForm
 from . import views
 
 urlpatterns = [
@@ -10,7 +11,9 @@ urlpatterns = [
     url(r'^password_reset$',
         auth_views.PasswordResetView.as_view(
             template_name='grumblr_auth/password_reset_form.html',
-            email_template_name='grumblr_auth/password_reset_email.html'),
+            email_template_name='grumblr_auth/password_reset_email.html',
+            # queue the reset emails in the outbox rather than sending them within the request
+            form_class=OutboxPasswordResetForm),
         name='password_reset'),
     url(r'^password_reset/done/$',
         auth_views.PasswordResetDoneView.as_view(
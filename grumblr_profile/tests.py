@@ -1,3 +1,39 @@
-from django.test import TestCase
+"""
+Tests of the profile page.
 
-# Create your tests here.
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.0.0
+"""
+from unittest import mock
+
+from global_resources.models import UserExtended
+from global_resources.tests import GrumblrTestCase, make_user
+
+
+class ProfileFollowTests(GrumblrTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+        self.client.force_login(self.alice)
+        self.url = '/profile/bob/'
+
+    def counts(self):
+        return (UserExtended.objects.get(pk=self.alice.pk).following_count,
+                UserExtended.objects.get(pk=self.bob.pk).follower_count)
+
+    def test_follow_and_unfollow(self):
+        self.assertRedirects(self.client.post(self.url, {'follow': ''}), self.url, fetch_redirect_response=False)
+        self.assertTrue(self.alice.ext.following.filter(pk=self.bob.pk).exists())
+        self.assertEqual(self.counts(), (1, 1))
+
+        self.assertRedirects(self.client.post(self.url, {'unfollow': ''}), self.url, fetch_redirect_response=False)
+        self.assertFalse(self.alice.ext.following.filter(pk=self.bob.pk).exists())
+        self.assertEqual(self.counts(), (0, 0))
+
+    def test_follow_is_atomic(self):
+        # a failure in the signal handlers after the relation is inserted takes the relation back out too
+        with mock.patch('global_resources.follow_graph.check_fan_out_limit', side_effect=RuntimeError('Boom')):
+            with self.assertRaises(RuntimeError):
+                self.client.post(self.url, {'follow': ''})
+        self.assertFalse(self.alice.ext.following.filter(pk=self.bob.pk).exists())
+        self.assertEqual(self.counts(), (0, 0))
@@ -2,7 +2,7 @@
 View controller for the profile page.
 
 Author: Stephen Xie <[redacted]@cmu.edu>
-Version: 1.1.0
+Version: 1.3.1
 """
 import logging
 
@@ -14,8 +14,9 @@ from django.shortcuts import render, redirect
 from django.urls import reverse
 from django.views.decorators.csrf import ensure_csrf_cookie
 
+from global_resources import follow_graph
 from global_resources.forms import UserPasswordForm, UserInfoForm, UserExtInfoForm
-from global_resources.models import Message
+from global_resources.routers import read_from_replica
 
 
 # used for printing debugging info in console
@@ -23,6 +24,7 @@ logger = logging.getLogger(__name__)
 
 
 @login_required
+@read_from_replica  # for GET requests only; the form posts read from the primary
 @ensure_csrf_cookie
 def profile_view(request, username=None):
     """
@@ -57,14 +59,14 @@ def profile_view(request, username=None):
     context['user'] = user
 
     # if the current user is viewing other user's profile page, check if he / she is following
-    # this other user
+    # this other user (a lookup in the cached follow graph, rather than loading everyone they follow)
     if user != request.user:
-        context['is_following'] = user in request.user.ext.following.all()
+        context['is_following'] = follow_graph.is_following(request.user.id, user.id)
 
     # total number of grumbles of this user
-    context['total_grumbles'] = len(Message.objects.filter(user=user))
+    context['total_grumbles'] = user.ext.message_count
     # total number of followers this user has
-    context['total_followers'] = len(user.followed_by.all())
+    context['total_followers'] = user.ext.follower_count
 
     # form for changing user password
     context['pw_form'] = UserPasswordForm(auto_id=False)
@@ -105,12 +107,16 @@ def profile_view(request, username=None):
             # of checking confirmation email.
             return redirect(reverse('profile'))
 
+    # the relation and the counters / timelines updated by its signals change together or not at all,
+    # as in the post_follows API
     if 'follow' in request.POST:
-        request.user.ext.following.add(user)
+        with transaction.atomic():
+            request.user.ext.following.add(user)
         return redirect(request.path_info)
 
     if 'unfollow' in request.POST:
-        request.user.ext.following.remove(user)
+        with transaction.atomic():
+            request.user.ext.following.remove(user)
         return redirect(request.path_info)
 
     return render(request, 'grumblr_profile/profile.html', context)
@@ -1,3 +1,49 @@
-from django.test import TestCase
+"""
+Tests of the registration page.
 
-# Create your tests here.
+Author: Stephen Xie <[redacted]@cmu.edu>
+Version: 1.0.0
+"""
+from django.contrib.auth.models import User
+from django.core import mail
+from django.test import override_settings
+
+from global_resources import outbox
+from global_resources.models import OutgoingEmail
+from global_resources.tests import GrumblrTestCase
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class RegisterViewTests(GrumblrTestCase):
+    def register(self, username='newbie'):
+        return self.client.post('/register/', {
+            'first_name': 'New',
+            'last_name': 'Grumbler',
+            'email': '{0}@example.com'.format(username),
+            'username': username,
+            'password': 'a long password',
+            'password_confirm': 'a long password'
+        })
+
+    def test_confirmation_email_is_queued(self):
+        response = self.register()
+        self.assertEqual(response.status_code, 200)
+        user = User.objects.get(username='newbie')
+        self.assertFalse(user.is_active)
+        self.assertTrue(user.ext)
+
+        # written to the outbox, not sent within the request
+        self.assertEqual(mail.outbox, [])
+        email = OutgoingEmail.objects.get()
+        self.assertEqual((email.recipients, email.status), ('newbie@example.com', OutgoingEmail.STATUS_PENDING))
+
+        self.assertEqual(outbox.send_pending(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['newbie@example.com'])
+        self.assertIn('/user_verify/?username=newbie&token=', mail.outbox[0].body)
+
+    def test_invalid_registration_queues_nothing(self):
+        self.register()
+        self.register()  # the username is taken
+        self.assertEqual(User.objects.filter(username='newbie').count(), 1)
+        self.assertEqual(OutgoingEmail.objects.count(), 1)
@@ -2,19 +2,19 @@
 View controller for the registration page.
 
 Author: Stephen Xie <[redacted]@cmu.edu>
-Version: 1.1.0
+Version: 1.2.0
 """
 import logging
 
 from django.contrib.auth.models import User
 from django.contrib.auth.tokens import default_token_generator
-from django.core.mail import send_mail
 from django.db import transaction
 from django.shortcuts import render, redirect
 from django.urls import reverse
 
 from global_resources.forms import UserRegisterForm
 from global_resources.models import UserExtended
+from global_resources.outbox import queue_mail
 
 
 # used for printing debugging info in console
@@ -118,10 +118,12 @@ def __send_confirmation_email(request, new_user, errors):
                      reverse('user_verify'),
                      "?username=" + new_user.username + "&token=" + token)
 
-    send_mail(subject='Verify your email address',
-              message=email_body,
-              from_email='admin@grumblr.com',  # for dummy SMTP server
-              recipient_list=[new_user.email]
-              )
+    # the email is sent by the outbox worker once the registration is committed, so that a slow
+    # mail server doesn't hold up the request (and its transaction); see global_resources/outbox.py
+    queue_mail(subject='Verify your email address',
+               message=email_body,
+               from_email='admin@grumblr.com',  # for dummy SMTP server
+               recipient_list=[new_user.email]
+               )
 
     errors.append('Thank you for registering! Please check your email for confirmation email.')
@@ -1,5 +1,8 @@
 from channels import route
-from global_resources.consumers import connect_global_stream, disconnect_global_stream
+from global_resources.broadcast import COMMENT_QUEUE_CHANNEL, QUEUE_CHANNEL
+from global_resources.consumers import connect_comments_stream, connect_following_stream, connect_global_stream, \
+    disconnect_comments_stream, disconnect_following_stream, disconnect_global_stream, publish_comments, \
+    publish_messages, receive_comments_stream, receive_following_stream, receive_global_stream
 
 # The channel routing defines what channels get handled by what consumers,
 # including optional matching on message attributes. WebSocket messages of all
@@ -7,6 +10,24 @@ from global_resources.consumers import connect_global_stream, disconnect_global_
 channel_routing = [
     # called when incoming WebSockets connect
     route("websocket.connect", connect_global_stream, path=r'^/api/get-messages-stream/$'),
+    # called when the client sends in a heartbeat
+    route("websocket.receive", receive_global_stream, path=r'^/api/get-messages-stream/$'),
     # called when the client closes the socket
-    route("websocket.disconnect", disconnect_global_stream, path=r'^/api/get-messages-stream/$')
+    route("websocket.disconnect", disconnect_global_stream, path=r'^/api/get-messages-stream/$'),
+
+    # the following stream: messages from the users the current user is following
+    route("websocket.connect", connect_following_stream, path=r'^/api/get-messages-stream/following/$'),
+    route("websocket.receive", receive_following_stream, path=r'^/api/get-messages-stream/following/$'),
+    route("websocket.disconnect", disconnect_following_stream, path=r'^/api/get-messages-stream/following/$'),
+
+    # the comments stream: new comments of the messages each socket has subscribed to
+    route("websocket.connect", connect_comments_stream, path=r'^/api/get-comments-stream/$'),
+    # called when the client sends in subscription changes
+    route("websocket.receive", receive_comments_stream, path=r'^/api/get-comments-stream/$'),
+    route("websocket.disconnect", disconnect_comments_stream, path=r'^/api/get-comments-stream/$'),
+
+    # new messages queued by Message.save(), to be broadcast to the streams above
+    route(QUEUE_CHANNEL, publish_messages),
+    # new comments queued by Comment.save(), to be pushed to the comments stream
+    route(COMMENT_QUEUE_CHANNEL, publish_comments)
 ]
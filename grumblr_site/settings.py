@@ -77,13 +77,23 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # records latency, queries and response sizes of each request for the /metrics endpoint
+    'global_resources.middleware.RequestMetricsMiddleware',
+    # keeps the reads of a browser on the primary database right after it wrote to it
+    'global_resources.middleware.PrimaryStickinessMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # profiles the requests of staff users that ask for it (see global_resources/profiling.py)
+    'global_resources.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # reports the number of database queries of each request in the X-Query-Count header
+    'global_resources.middleware.QueryCountMiddleware',
+    # attributes queries to the views in the slow query log
+    'global_resources.middleware.SlowQueryMiddleware',
     # WhiteNoise is used to serve static files locally in production mode;
     # check its documentation for setup details
     # 'whitenoise.middleware.WhiteNoiseMiddleware'
@@ -141,6 +151,72 @@ CHANNEL_LAYERS = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+# used for rendered message cards, the window of the latest global messages, etc.
+
+# a per-process in-memory cache is enough for a single node; supply a Redis URL (e.g.
+# redis://localhost:6379/1) to the `CACHE_URL` environment variable to share the cache between
+# nodes (requires django-redis); the cache API is the same either way
+CACHE_URL = config('CACHE_URL', default='')
+if CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': CACHE_URL,
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            }
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'grumblr',
+            'OPTIONS': {
+                'MAX_ENTRIES': 10000
+            }
+        }
+    }
+
+# sessions are read from the cache and written through to the database, if the cache is shared
+# between the processes; a per-process cache can't be used for sessions, as logging out in one
+# process wouldn't end the session in the others
+if CACHE_URL:
+    SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# keep the latest messages of the global stream in the cache (see global_resources/global_window.py);
+# only when the cache is shared, as every process has to see the changes made by the others
+GLOBAL_WINDOW_ENABLED = bool(CACHE_URL)
+# how many of the latest messages of the global stream are kept in the cache
+GLOBAL_WINDOW_SIZE = 100
+# how long (in seconds) the window is kept in the cache at most
+GLOBAL_WINDOW_TIMEOUT = 60 * 5
+# how long (in seconds) a request waits for the window to be filled by another one
+GLOBAL_WINDOW_WAIT = 0.5
+
+
+# maximum number of new messages published to the streams in one WebSocket frame
+# (see global_resources/broadcast.py)
+BROADCAST_BATCH_SIZE = 20
+# maximum number of messages a comments stream socket can subscribe to at a time
+COMMENT_SUBSCRIPTIONS_PER_SOCKET = 50
+
+# the sockets of the global stream are spread over this many Channels groups, which new messages
+# are sent to in parallel by this many threads (see global_resources/stream_shards.py)
+GLOBAL_STREAM_SHARDS = 8
+GLOBAL_STREAM_PUBLISH_THREADS = 4
+# how often (in seconds) the clients send a heartbeat over the global and following streams; this
+# is also set in grumbles_control.js
+GLOBAL_STREAM_HEARTBEAT = 30
+# prune the sockets without a recent heartbeat from the groups of both streams (see also
+# global_resources/subscriptions.py), at most this often (in seconds);
+# only when the cache is shared, as every worker process has to see all the heartbeats
+GLOBAL_STREAM_PRUNE = bool(CACHE_URL)
+GLOBAL_STREAM_PRUNE_INTERVAL = 60
+
+
 # Database
 # https://docs.djangoproject.com/en/1.11/ref/settings/#databases
 
@@ -157,6 +233,129 @@ DATABASES = {
     # )
 }
 
+# read replicas: the reads of the polling APIs and the profile page go to these (see
+# global_resources/routers.py); supply their database URLs, comma-separated, to the
+# `REPLICA_DATABASE_URLS` environment variable. To try it out locally, a copy of the SQLite
+# database can stand in for a replica: cp db.sqlite3 replica.sqlite3, then set
+# REPLICA_DATABASE_URLS=sqlite:////<absolute path to>/replica.sqlite3
+for number, replica_url in enumerate(filter(None, config('REPLICA_DATABASE_URLS', default='').split(',')), 1):
+    DATABASES['replica{0}'.format(number)] = dict(dj_database_url.parse(replica_url.strip()),
+                                                  TEST={'MIRROR': 'default'})
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['global_resources.routers.ReplicaRouter']
+
+# how long (in seconds) the reads of a browser stick to the primary database after it wrote to
+# it, so that its user sees their own writes even if the replicas lag behind
+REPLICA_STICKY_SECONDS = 5
+REPLICA_STICKY_COOKIE = 'primary_until'
+
+
+# Home timelines (see TimelineEntry in global_resources/models.py)
+
+# authors with more followers than this are not fanned out on write; their messages are
+# merged into the following view of their followers on read instead
+TIMELINE_FANOUT_LIMIT = 1000
+# the messages of a newly followed user are copied into the follower's timeline this many at a time
+TIMELINE_BACKFILL_BATCH = 1000
+
+# the ids of the users each user is following / followed by are cached (see
+# global_resources/follow_graph.py) for this long (in seconds) at most; changes are seen right
+# away by every process if the cache is shared (see CACHE_URL), by the others within this time
+FOLLOW_GRAPH_CACHE_TIMEOUT = 60
+# how many ids a process keeps decoded in memory at most
+FOLLOW_GRAPH_CACHE_IDS = 1000000
+
+
+# rate limits of the APIs (see global_resources/ratelimit.py), per user and per client IP address;
+# '10/m' is a bucket of 10 requests, refilled at 10 requests a minute. The buckets are kept in
+# the default cache, so they're per process unless CACHE_URL is set
+RATE_LIMITS_ENABLED = True
+RATE_LIMITS = {
+    # each new message is sent to every socket of the global stream
+    'post-message': {'user': '10/m', 'ip': '30/m'},
+    'post-comment': {'user': '20/m', 'ip': '60/m'},
+    # the polling APIs (the pages poll while their WebSocket is down)
+    'get-messages': {'user': '120/m', 'ip': '600/m'},
+    'get-comments': {'user': '300/m', 'ip': '1500/m'},
+    'get-follows': {'user': '120/m', 'ip': '600/m'},
+    'post-follows': {'user': '30/m', 'ip': '120/m'},
+}
+# number of proxies in front of the site (e.g. 1 for the Heroku router) whose X-Forwarded-For
+# header is trusted for the client IP address; 0 to use the address of the connection
+RATE_LIMIT_TRUSTED_PROXIES = config('RATE_LIMIT_TRUSTED_PROXIES', default=0, cast=int)
+
+
+# add the number of database queries taken by each request to the X-Query-Count response header
+# (see global_resources/middleware.py)
+QUERY_COUNT_HEADER = DEBUG
+
+# record the latency, database queries and response size of every request (see
+# global_resources/middleware.py); exposed along with the other metrics on /metrics
+REQUEST_METRICS = True
+# token that lets a metrics scraper (e.g. Prometheus) read /metrics without a staff login, sent as
+# an "Authorization: Bearer <token>" header; leave empty to only allow staff users
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
+# slow query log (see global_resources/querylog.py): queries slower than this many milliseconds
+# are logged, with the view and the line of code they came from and their query plan;
+# None switches the log off
+SLOW_QUERY_MS = 100
+# the log file, rotated when it reaches the size below (in bytes), keeping a few old files
+SLOW_QUERY_LOG = os.path.join(BASE_DIR, 'slow_queries.log')
+SLOW_QUERY_LOG_MAX_BYTES = 10 * 1024 * 1024
+SLOW_QUERY_LOG_BACKUPS = 5
+
+# Logging
+# https://docs.djangoproject.com/en/1.11/topics/logging/
+# Django's defaults, plus the slow query log fed by the query timing cursor
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'slow_queries': {
+            'level': 'WARNING',
+            'class': 'global_resources.querylog.SlowQueryHandler'
+        }
+    },
+    'loggers': {
+        'global_resources.slow_queries': {
+            'handlers': ['slow_queries'],
+            'level': 'WARNING',
+            'propagate': False
+        }
+    }
+}
+
+# on-demand profiling for staff users (see global_resources/profiling.py)
+# number of profiles kept in the database
+PROFILE_KEEP = 100
+# number of consumer calls profiled after a staff user asks for it with ?_profile=consumers
+PROFILE_CONSUMER_CALLS = 20
+
+# how long (in seconds) rendered message / comment cards are kept in the cache
+# (see global_resources/fragments.py)
+CARD_CACHE_TIMEOUT = 60 * 60 * 24
+
+# avatar thumbnails (see global_resources/avatars.py): size name -> width / height in pixels,
+# twice the size the avatar is displayed in for high-DPI screens
+AVATAR_SIZES = {
+    'card': 160,  # message cards
+    'comment': 100,  # comments
+    'profile': 240  # the profile page
+}
+# JPEG / WebP quality of the thumbnails
+AVATAR_QUALITY = 85
+
+
+# the default ModelBackend, plus a per-process cache of the users loaded for the sessions
+# (see global_resources/backends.py)
+AUTHENTICATION_BACKENDS = ['global_resources.backends.CachedModelBackend']
+# how long (in seconds) a process remembers a user at most; changes made through another process
+# may go unnoticed for this long when the cache isn't shared (see CACHE_URL)
+AUTH_USER_CACHE_TIMEOUT = 30
+# maximum number of users remembered by a process
+AUTH_USER_CACHE_SIZE = 10000
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
@@ -217,6 +416,9 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'global_resources/media')
 # AWS_ACCESS_KEY_ID = config('AWS_ACCESS_KEY_ID')
 # AWS_SECRET_ACCESS_KEY = config('AWS_SECRET_ACCESS_KEY')
 # DEFAULT_FILE_STORAGE = 'grumblr_site.custom_storages.MediaStorage'
+# media files are never overwritten (avatar thumbnails live under content-hashed names, see
+# global_resources/avatars.py), so browsers may cache them for good
+# AWS_S3_OBJECT_PARAMETERS = {'CacheControl': 'public, max-age=31536000, immutable'}
 # ref for the two lines below: https://github.com/jschneier/django-storages/issues/28#issuecomment-265876674
 # AWS_S3_REGION_NAME = 'us-east-2'
 # AWS_S3_SIGNATURE_VERSION = 's3v4'
@@ -240,3 +442,13 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 # EMAIL_HOST_USER = config('ADMIN_EMAIL')
 # EMAIL_HOST_PASSWORD = config('ADMIN_EMAIL_PASS')
 # EMAIL_PORT = 587
+
+# emails are queued in an outbox and sent by a worker (see global_resources/outbox.py)
+# number of emails the worker sends at a time
+OUTBOX_BATCH_SIZE = 50
+# an email that fails to send is tried again after this many seconds, doubling on every failure
+OUTBOX_RETRY_DELAY = 30
+# number of attempts to send an email before giving up on it
+OUTBOX_MAX_ATTEMPTS = 8
+# how long (in seconds) an email being sent by a worker is hidden from other workers
+OUTBOX_LEASE = 60 * 5
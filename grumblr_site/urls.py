@@ -18,7 +18,15 @@ from django.conf.urls import url, include
 from django.conf.urls.static import static
 from django.contrib import admin
 
+from global_resources import views as global_views
+
 urlpatterns = [
+    # request / WebSocket metrics in the Prometheus text format (staff or token only)
+    url(r'^metrics$', global_views.metrics_view, name='metrics'),
+    # on-demand profiles of requests / consumers (staff only; see global_resources/profiling.py)
+    url(r'^profiles/$', global_views.profiles_view, name='profiles'),
+    url(r'^profiles/(?P<profile_id>\d+)\.(?P<ext>prof|txt)$', global_views.profile_download,
+        name='profile-download'),
     url(r'^auth/', include('grumblr_auth.urls')),
     url(r'^register/', include('grumblr_register.urls')),
     url(r'^api/', include('global_resources.urls')),
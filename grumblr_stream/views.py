@@ -12,7 +12,6 @@ from django.shortcuts import render
 from django.views.decorators.csrf import ensure_csrf_cookie
 
 from global_resources.forms import MessageForm
-from global_resources.models import Message
 
 
 # used for printing debugging info in console
@@ -39,9 +38,9 @@ def home_view(request):
     context['errors'] = errors
 
     # total number of grumbles of this user
-    context['total_grumbles'] = len(Message.objects.filter(user=current_user))
+    context['total_grumbles'] = current_user.ext.message_count
     # total number of followers the current user has
-    context['total_followers'] = len(current_user.followed_by.all())
+    context['total_followers'] = current_user.ext.follower_count
 
     # just display the page if this is a GET request
     if request.method == 'GET':
@@ -69,8 +68,8 @@ def following_view(request):
     context['errors'] = errors
 
     # total number of grumbles of this user
-    context['total_grumbles'] = len(Message.objects.filter(user=current_user))
+    context['total_grumbles'] = current_user.ext.message_count
     # total number of followers the current user has
-    context['total_followers'] = len(current_user.followed_by.all())
+    context['total_followers'] = current_user.ext.follower_count
 
     return render(request, 'grumblr_stream/grumble_stream.html', context)